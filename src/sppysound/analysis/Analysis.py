@@ -5,6 +5,7 @@ import logging
 import pdb
 
 from fileops import pathops
+from AnalysisTools import analysis_cache
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +43,13 @@ class Analysis(object):
         analysis_function: The function used to create the analysis. returned
         data will be stored in the HDF5 file.
         """
+        if self.analysis_group.file.mode == 'r':
+            # Analyses can only be read from read-only files.
+            if self.name not in self.analysis_group:
+                raise IOError("{0} analysis doesn't exist in read-only analysis "
+                              "file: {1}".format(self.name, self.analysis_group.file.filename))
+            self.analysis = self.analysis_group[self.name]
+            return
 
         try:
             self.analysis = self.analysis_group.create_group(self.name)
@@ -64,6 +72,7 @@ class Analysis(object):
                 self.analysis.create_dataset(key, data=value, chunks=True)
             for key, value in attrs_dict.iteritems():
                 self.analysis.attrs[key] = value
+            self.update_version()
         else:
 
             if self.analysis.keys():
@@ -78,34 +87,103 @@ class Analysis(object):
                     self.analysis.create_dataset(key, data=value, chunks=True)
                 for key, value in attrs_dict.iteritems():
                     self.analysis.attrs[key] = value
+                self.update_version()
+
+    def update_version(self):
+        """
+        Increment the version counters of the audio file's analysis group and
+        of the analysis file it is stored in.
+
+        Version counters are used to invalidate data derived from analyses
+        (such as search indexes) when analyses are regenerated.
+        """
+        for group in (self.analysis_group, self.analysis_group.file):
+            group.attrs["version"] = group.attrs.get("version", 0) + 1
 
     def get_analysis_grains(self, start, end):
         """
         Retrieve analysis frames for period specified in start and end times.
         arrays of start and end time pairs will produce an array of equivelant
         size containing frames for these times.
+
+        Returns the analysis frames and an array of the first and last
+        (exclusive) frame indexes of each grain.
         """
-        times = self.analysis_group[self.name]["times"][:]
+        times = self.read_dataset("times")
         start = start / 1000
         end = end / 1000
-        vtimes = times.reshape(-1, 1)
 
-        selection = np.transpose((vtimes >= start) & (vtimes <= end))
-        # If there are no frames for this grain, take the two closest frames
-        # from the adjacent grains.
-        if not selection.any():
-            frame_center = start + (end-start)/2.
-            closest_frames = np.abs(vtimes-frame_center).argsort()[:2]
-            selection[closest_frames] = True
+        selection = self.grain_frame_ranges(times, start, end)
 
-        #start_ind = np.min(selection)
-        #end_ind = np.argmax(selection)
-        frames = self.analysis_group[self.name]["frames"][:]
+        frames = self.read_dataset("frames")
 
         grain_data = (frames, selection)
 
         return grain_data
 
+    def read_dataset(self, dataset, group_name=None):
+        """
+        Read a dataset of the analysis through the shared analysis cache.
+
+        Arrays returned are read-only as they may be shared with other
+        callers.
+
+        Arguments:
+
+        - dataset: the name of the dataset to read. ie. "frames"
+
+        - group_name: the name of the analysis group storing the dataset.
+          Defaults to the group of this analysis.
+        """
+        if not group_name:
+            group_name = self.name
+        # The version counter changes when analyses are regenerated, so
+        # arrays cached for previous analyses won't be returned.
+        key = (
+            self.analysis_group.file.filename,
+            self.analysis_group.name,
+            self.analysis_group.attrs.get("version", 0),
+            group_name,
+            dataset
+        )
+        return analysis_cache.get(
+            key,
+            lambda: self.analysis_group[group_name][dataset][:]
+        )
+
+    @staticmethod
+    def grain_frame_ranges(times, start, end):
+        """
+        Find the range of analysis frames that lie within each grain.
+
+        Frame times are sorted, so the first and last frames of each grain are
+        found by binary search rather than by comparing every frame time with
+        every grain.
+
+        Arguments:
+
+        - times: sorted times of the analysis frames.
+
+        - start: the start times of the grains.
+
+        - end: the end times of the grains.
+
+        Returns a (grains x 2) array of the first frame index and the index
+        after the last frame of each grain.
+        """
+        start = np.atleast_1d(start)
+        end = np.atleast_1d(end)
+        first = np.searchsorted(times, start, side='left')
+        last = np.maximum(np.searchsorted(times, end, side='right'), first)
+        # If there are no frames for any grain, take the two closest frames
+        # to the center of each grain.
+        if times.size and not np.any(last > first):
+            frame_center = start + (end-start)/2.
+            first = np.searchsorted(times, frame_center) - 1
+            first = np.clip(first, 0, max(times.size-2, 0))
+            last = np.minimum(first+2, times.size)
+        return np.column_stack((first, last))
+
     def hdf5_dataset_formatter(analysis_method, *args, **kwargs):
         '''
         Note: This is a generic formatter designed as a template to be
@@ -123,39 +201,98 @@ class Analysis(object):
     # Formatting functions
     ################################################################################
 
+    @staticmethod
+    def log2_scale(x):
+        return 1000 * np.log2(1+x/1000)
+
     def log2_median(self, x):
-        return np.median(1000 * np.log2(1+x/1000))
+        return np.median(self.log2_scale(x))
 
     def log2_mean(self, x):
-        return np.mean(1000 * np.log2(1+x/1000))
+        return np.mean(self.log2_scale(x))
 
-    def formatter_func(self, selection, frames, valid_inds, formatter=None):
-        # get all valid frames from current grain
-        frames = frames[selection & valid_inds]
+    @staticmethod
+    def grain_mean(values, valid_inds, selection):
+        """
+        Calculate the mean of the valid values in each grain.
 
-        return formatter(frames)
-        #if less than half the frames are valid then the grain is not valid.
-        if frames.size < valid_inds[selection].nonzero()[0].size/2:
-            return np.nan
+        Means are calculated from cumulative sums of the values, so each
+        grain's sum is the difference of two table entries.
+        """
+        first, last = selection.T
+        sums = np.concatenate(([0.], np.cumsum(np.where(valid_inds, values, 0.))))
+        counts = np.concatenate(([0], np.cumsum(valid_inds)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (sums[last]-sums[first]) / (counts[last]-counts[first])
 
-    def analysis_formatter(self, frames, selection, format):
-        """Calculate the average analysis value of the grain using the match format specified."""
-        valid_inds = np.isfinite(frames)
+    @staticmethod
+    def grain_median(values, valid_inds, selection, block_size=2**20):
+        """
+        Calculate the median of the valid values in each grain.
 
+        The valid values of each grain are gathered into rows of a matrix,
+        padded to the length of the longest grain, which is sorted along its
+        rows so that medians can be taken from the middle of each row.
+        """
+        valid_values = values[valid_inds]
+        counts = np.concatenate(([0], np.cumsum(valid_inds)))
+        first = counts[selection[:, 0]]
+        lengths = counts[selection[:, 1]] - first
+
+        output = np.empty(len(selection))
+        output.fill(np.nan)
+        max_length = np.max(lengths)
+        if not max_length:
+            return output
+        columns = np.arange(max_length)
+        # Limit the size of the matrix sorted at once.
+        grains_per_block = max(block_size // max_length, 1)
+        for block_start in xrange(0, len(selection), grains_per_block):
+            block = slice(block_start, block_start+grains_per_block)
+            block_lengths = lengths[block]
+            inds = np.minimum(first[block, None]+columns, valid_values.size-1)
+            rows = valid_values[inds]
+            # Pad rows with inf so that padding is sorted after grain values.
+            rows[columns >= block_lengths[:, None]] = np.inf
+            rows.sort(axis=1)
+            row_inds = np.arange(rows.shape[0])
+            lower = rows[row_inds, np.maximum(block_lengths-1, 0)//2]
+            upper = rows[row_inds, block_lengths//2]
+            output[block] = np.where(block_lengths > 0, (lower+upper)/2., np.nan)
+        return output
+
+    def grain_average(self, frames, valid_inds, selection, format):
+        """
+        Calculate the average of the valid frames in each grain using the
+        format specified.
+        """
         format_style_dict = {
-            'mean': np.mean,
-            'median': np.median,
-            'log2_mean': self.log2_mean,
-            'log2_median': self.log2_median,
+            'mean': (None, self.grain_mean),
+            'median': (None, self.grain_median),
+            'log2_mean': (self.log2_scale, self.grain_mean),
+            'log2_median': (self.log2_scale, self.grain_median),
         }
-        output = np.empty(len(selection))
+        scale, average = format_style_dict[format]
+        if scale:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                frames = scale(frames)
+        # Values that can't be scaled make the average of their grain
+        # invalid.
+        invalid_inds = valid_inds & ~np.isfinite(frames)
+        valid_inds = valid_inds & ~invalid_inds
+        output = average(frames, valid_inds, selection)
+        if invalid_inds.any():
+            invalid_counts = np.concatenate(([0], np.cumsum(invalid_inds)))
+            first, last = selection.T
+            output[invalid_counts[last] > invalid_counts[first]] = np.nan
+        return output
+
+    def analysis_formatter(self, frames, selection, format):
+        """Calculate the average analysis value of the grain using the match format specified."""
+        valid_inds = np.isfinite(frames)
 
         if not selection.size:
             # TODO: Add warning here
             return np.nan
-        # For debugging apply_along_axis:
-        #for ind, i in enumerate(selection):
-        #    output[ind] = self.formatter_func(i, frames, valid_inds, formatter=format_style_dict[format])
 
-        output = np.apply_along_axis(self.formatter_func, 1, selection, frames, valid_inds, formatter=format_style_dict[format])
-        return output
+        return self.grain_average(frames, valid_inds, selection, format)
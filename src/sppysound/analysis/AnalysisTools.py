@@ -1,7 +1,10 @@
 """A collection of useful tools for multiple audio analyses."""
 
 from __future__ import division
+import collections
 from scipy.signal import butter, lfilter
+import numpy as np
+from numpy.lib import stride_tricks
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,3 +38,295 @@ class ButterFilter:
         # Filter audio using coefficients generated
         y = lfilter(self.filtervalues[0], self.filtervalues[1], data)
         return y
+
+
+class FrameCache(object):
+    """
+    Decodes audio once and caches the framed views of it used by analyses.
+
+    Calling the object returns the decoded samples, so it can be used in
+    place of the AudioFile.read_grain method when creating analyses.
+    Framed views are created once for each distinct window size, hop size
+    and window function requested, then shared between all analyses that
+    use them. Arrays returned are read-only as they may be shared.
+
+    Arguments:
+
+    - samples: an array of samples, or a callable returning an array of
+      samples. Callables are not called until the samples are first needed.
+    """
+
+    def __init__(self, samples):
+        self.logger = logging.getLogger(__name__ + '.FrameCache')
+        self._samples = samples
+        self._padded = {}
+        self._frames = {}
+
+    @property
+    def samples(self):
+        if hasattr(self._samples, '__call__'):
+            self._samples = self._samples()
+            self._samples.flags.writeable = False
+        return self._samples
+
+    def __call__(self):
+        return self.samples
+
+    def frames(self, window_size, overlapFac=0.5, window=None, centre=True):
+        """
+        Return overlapping frames of the samples.
+
+        Arguments:
+
+        - window_size: the size of each frame in samples.
+
+        - overlapFac: the overlap of frames as a fraction of the window size.
+
+        - window: a window function to apply to each frame. (ie. np.hanning)
+
+        - centre: if True the samples are zero padded so that the centre of
+          the first frame is the first sample.
+        """
+        window_size = int(window_size)
+        hopSize = int(window_size - np.floor(overlapFac * window_size))
+        key = (window_size, hopSize, window, centre)
+        if key in self._frames:
+            return self._frames[key]
+
+        if window:
+            # Windowed frames are created from the shared un-windowed view.
+            frames = self.frames(window_size, overlapFac, centre=centre) * window(window_size)
+        else:
+            samples = self.samples
+            if centre:
+                # zeros at beginning (thus center of 1st window should be for sample nr. 0)
+                samples = np.concatenate((np.zeros(window_size//2), samples))
+            # cols for windowing
+            cols = int(np.ceil((len(samples) - window_size) / float(hopSize)) + 1)
+            # zeros at end (thus samples can be fully covered by frames)
+            samples = np.concatenate((samples, np.zeros(window_size)))
+            # Keep a reference to the padded samples the view is created from.
+            self._padded[key] = samples
+
+            frames = stride_tricks.as_strided(
+                samples,
+                shape=(cols, window_size),
+                strides=(samples.strides[0]*hopSize, samples.strides[0])
+            )
+        frames.flags.writeable = False
+        self._frames[key] = frames
+        return frames
+
+
+class ArrayCache(object):
+    """
+    A least recently used cache of arrays, bounded by the total size of the
+    arrays stored.
+
+    Cached arrays are made read-only as they are shared between callers.
+
+    Arguments:
+
+    - max_bytes: the maximum total size of arrays to store. When exceeded, the
+      least recently used arrays are discarded.
+    """
+
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        Return the array stored for the key. If it isn't stored then it is
+        loaded by calling load and stored.
+        """
+        try:
+            array = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            array = np.array(load())
+            array.flags.writeable = False
+            self.entries[key] = array
+            self.size += array.nbytes
+            self.evict()
+            return array
+        self.hits += 1
+        # Re-insert to mark as the most recently used array.
+        self.entries[key] = array
+        return array
+
+    def evict(self):
+        """Discard least recently used arrays until the cache is within size."""
+        while self.size > self.max_bytes and self.entries:
+            key, array = self.entries.popitem(last=False)
+            self.size -= array.nbytes
+
+    def resize(self, max_bytes):
+        """Set the maximum size of the cache."""
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def clear(self):
+        """Discard all arrays and reset hit and miss counters."""
+        self.entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return a dictionary of cache usage statistics."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_bytes
+        }
+
+    def __repr__(self):
+        return ("ArrayCache(hits={hits}, misses={misses}, entries={entries}, "
+                "size={size}, max_size={max_size})".format(**self.stats()))
+
+
+# Cache of analysis arrays read from HDF5 files, shared by all analyses in the
+# process.
+analysis_cache = ArrayCache()
+
+
+def frame_signal(samples, window_size, overlapFac=0.5, window=None, centre=True):
+    """
+    Return overlapping frames of the samples provided.
+
+    If samples is a FrameCache, frames are taken from the cache. Otherwise
+    samples may be an array or a callable returning an array. See
+    FrameCache.frames for details of the arguments.
+    """
+    if not isinstance(samples, FrameCache):
+        samples = FrameCache(samples)
+    return samples.frames(window_size, overlapFac, window=window, centre=centre)
+
+
+# Analysis names of the descriptors calculated by spectral_descriptors.
+SPECTRAL_DESCRIPTORS = {'spccntr', 'spcsprd', 'spcflux', 'spccf', 'spcflatness'}
+
+
+def spectral_descriptors(
+    fft,
+    descriptors,
+    samplerate=None,
+    output_format="ind",
+    spectral_centroid=None,
+    block_size=1024
+):
+    """
+    Calculate multiple spectral descriptors from FFT frames in a single pass.
+
+    FFT frames are read in blocks and the magnitudes of each block are
+    calculated once, then used for all descriptors requested.
+
+    Arguments:
+
+    - fft: FFT frames. This can be an HDF5 dataset, so that frames are only
+      read from file once.
+
+    - descriptors: the analysis names of the descriptors to calculate. See
+      SPECTRAL_DESCRIPTORS for valid names.
+
+    - samplerate: the samplerate of the audio analysed. Only needed for
+      "freq" output.
+
+    - output_format: Choose either "freq" for spectral centroid and spread
+      output in Hz or "ind" for bin index output.
+
+    - spectral_centroid: pre-calculated spectral centroid frames to use for
+      the spectral spread. If not provided they are calculated.
+
+    Returns a dictionary of descriptor arrays.
+    """
+    if not hasattr(fft, 'shape'):
+        fft = np.asarray(fft)
+    descriptors = set(descriptors)
+    invalid = descriptors - SPECTRAL_DESCRIPTORS
+    if invalid:
+        raise ValueError("{0} are not valid spectral descriptors.".format(list(invalid)))
+    frame_count, bin_count = fft.shape
+
+    # Calculate the centre frequency or index of each rfft bin.
+    if output_format == "freq":
+        freqs = np.fft.rfftfreq((bin_count*2)-1, 1.0/samplerate)
+    elif output_format == "ind":
+        freqs = np.arange(bin_count)
+    else:
+        raise ValueError("\'{0}\' is not a valid output "
+                         "format.".format(output_format))
+
+    output = {name: np.empty(frame_count) for name in descriptors}
+    # Flux is the difference between consecutive frames so has one less
+    # frame.
+    if 'spcflux' in descriptors:
+        output['spcflux'] = np.empty(max(frame_count-1, 0))
+    need_centroid = descriptors & {'spccntr', 'spcsprd'}
+    if spectral_centroid is not None:
+        spectral_centroid = spectral_centroid[:]
+
+    mag_max = 0.
+    previous_mags = None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in xrange(0, frame_count, block_size):
+            end = min(start+block_size, frame_count)
+            # Get the positive magnitudes of each bin.
+            magnitudes = np.abs(fft[start:end])
+            mag_max = max(mag_max, np.max(magnitudes))
+            mag_sum = np.sum(magnitudes, axis=1)
+
+            if need_centroid:
+                if spectral_centroid is not None and 'spccntr' not in descriptors:
+                    centroid = spectral_centroid[start:end]
+                else:
+                    # Calculate the weighted mean
+                    centroid = np.sum(magnitudes*freqs, axis=1) / mag_sum
+                if 'spccntr' in descriptors:
+                    output['spccntr'][start:end] = centroid
+
+            if 'spcsprd' in descriptors:
+                a = (freqs-np.vstack(centroid))**2
+                mag_sqrd = magnitudes**2
+                output['spcsprd'][start:end] = np.sqrt(
+                    np.sum(a*mag_sqrd, axis=1) / np.sum(mag_sqrd, axis=1)
+                )
+
+            if 'spccf' in descriptors:
+                # Ratio of the highest magnitude of each frame to the sum of
+                # magnitudes.
+                output['spccf'][start:end] = np.max(magnitudes, axis=1) / mag_sum
+
+            if 'spcflatness' in descriptors:
+                # Ratio of the geometric mean of magnitudes to the arithmetic
+                # mean of magnitudes.
+                geo_mean = np.e**np.mean(np.log(magnitudes), axis=1)
+                arith_mean = np.mean(magnitudes, axis=1)
+                output['spcflatness'][start:end] = geo_mean / arith_mean
+
+            if 'spcflux' in descriptors:
+                # Include the last frame of the previous block so the
+                # difference to the first frame of this block is calculated.
+                if previous_mags is not None:
+                    flux_mags = np.vstack((previous_mags, magnitudes))
+                    flux_start = start-1
+                else:
+                    flux_mags = magnitudes
+                    flux_start = start
+                sum_of_squares = np.sum((flux_mags[1:]-flux_mags[:-1])**2., axis=1)
+                output['spcflux'][flux_start:end-1] = np.sqrt(sum_of_squares) / bin_count
+                previous_mags = magnitudes[-1:]
+
+    # If there is no spectral content then no descriptors can be calculated.
+    if not mag_max:
+        for name in descriptors:
+            output[name] = np.empty(frame_count)
+            output[name].fill(np.nan)
+
+    return output
@@ -4,11 +4,10 @@ import os
 import numpy as np
 import logging
 from scipy import signal
-from numpy.lib import stride_tricks
 import pdb
 
 
-from AnalysisTools import ButterFilter
+from AnalysisTools import ButterFilter, frame_signal
 from fileops import pathops
 
 from Analysis import Analysis
@@ -52,8 +51,6 @@ class CentroidAnalysis(Analysis):
         Calculate the Centroid values of windowed segments of the audio file and
         save to disk.
         """
-        if hasattr(frames, '__call__'):
-            frames = frames()
 
         # Calculate the period of the window in hz
         # lowest_freq = 1.0 / window_size
@@ -63,25 +60,7 @@ class CentroidAnalysis(Analysis):
         # TODO: Fix filter
         # frames = filter.filter_butter(frames)
 
-        # Generate a window function to apply to centroid windows before analysis
-        win = window(window_size)
-        hopSize = int(window_size - np.floor(overlapFac * window_size))
-
-        # zeros at beginning (thus center of 1st window should be for sample nr. 0)
-        samples = np.append(np.zeros(np.floor(window_size/2.0)), frames)
-
-        # cols for windowing
-        cols = np.ceil((len(samples) - window_size) / float(hopSize)) + 1
-        # zeros at end (thus samples can be fully covered by frames)
-        samples = np.append(samples, np.zeros(window_size))
-
-        frames = stride_tricks.as_strided(
-            samples,
-            shape=(cols, window_size),
-            strides=(samples.strides[0]*hopSize, samples.strides[0])
-        ).copy()
-
-        frames *= win
+        frames = frame_signal(frames, window_size, overlapFac, window=window)
         weighted_sum = np.sum((np.arange(frames.shape[1])+1) * frames, axis=1)
 
         centroid = weighted_sum / np.sum(frames, axis=1)
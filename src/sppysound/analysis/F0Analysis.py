@@ -3,8 +3,8 @@ import numpy as np
 import logging
 import pdb
 import numpy as np
-from numpy.lib import stride_tricks
 from Analysis import Analysis
+from AnalysisTools import frame_signal
 from scipy import signal
 from numpy.fft import fft, ifft, fftshift
 from sppysound import multirate
@@ -64,21 +64,16 @@ class F0Analysis(Analysis):
         arrays of start and end time pairs will produce an array of equivelant
         size containing frames for these times.
         """
-        times = self.analysis_group["F0"]["times"][:]
-        frames = self.analysis_group["F0"]["frames"][:]
-        hr = self.analysis_group["F0"]["harmonic_ratio"][:]
+        times = self.read_dataset("times")
+        frames = self.read_dataset("frames")
+        hr = self.read_dataset("harmonic_ratio")
         start = start / 1000
         end = end / 1000
-        vtimes = times.reshape(-1, 1)
         nan_inds = hr < self.threshold
-        hr[nan_inds] = np.nan
-        frames[nan_inds] = np.nan
+        hr = np.where(nan_inds, np.nan, hr)
+        frames = np.where(nan_inds, np.nan, frames)
 
-        selection = np.transpose((vtimes >= start) & (vtimes <= end))
-        if not selection.any():
-            frame_center = start + (end-start)/2.
-            closest_frames = np.abs(vtimes-frame_center).argsort()[:2]
-            selection[closest_frames] = True
+        selection = self.grain_frame_ranges(times, start, end)
 
         return ((frames, times, hr), selection)
 
@@ -91,35 +86,23 @@ class F0Analysis(Analysis):
         threshold=0.0,
         m0=None,
         M=None,
+        batched=True
     ):
         """
         Generate F0 contour analysis.
 
         Calculate the frequency and harmonic ratio values of windowed segments
         of the audio file and save to disk.
+
+        If batched is True, all frames are analysed at once using
+        batch_f0. Otherwise each frame is analysed individually using direct
+        autocorrelation.
         """
-        if hasattr(frames, '__call__'):
-            frames = frames()
         if not M:
             M=int(round(0.016*samplerate))
 
-
-        hopSize = int(window_size - np.floor(overlapFac * window_size))
-
-        # zeros at beginning (thus center of 1st window should be for sample nr. 0)
-        samples = frames
-        #samples = np.concatenate((np.zeros(np.floor(window_size/2.0)), frames))
-
-        # cols for windowing
-        cols = np.ceil((len(samples) - window_size) / float(hopSize)) + 1
-        # zeros at end (thus samples can be fully covered by frames)
-        samples = np.concatenate((samples, np.zeros(window_size)))
-
-        frames = stride_tricks.as_strided(
-            samples,
-            shape=(cols, window_size),
-            strides=(samples.strides[0]*hopSize, samples.strides[0])
-        ).copy()
+        # Frames start at the first sample rather than being centred on it.
+        frames = frame_signal(frames, window_size, overlapFac, centre=False)
 
         # TODO: Replace this with zero crossing object.
         def feature_zcr(window):
@@ -210,6 +193,9 @@ class F0Analysis(Analysis):
                 HR = 1
             return (f0, HR)
 
+        if batched:
+            return F0Analysis.batch_f0(frames, samplerate, m0=m0, M=M)
+
         output = np.apply_along_axis(per_frame_f0, 1, frames, m0, M)
         # output = np.empty((frames.shape[0], 2))
         # for ind, i in enumerate(frames):
@@ -217,6 +203,121 @@ class F0Analysis(Analysis):
 
         return output
 
+    @staticmethod
+    def batch_f0(frames, samplerate, m0=None, M=None, block_size=256):
+        """
+        Calculate the frequency and harmonic ratio of every row of a frame
+        matrix.
+
+        This is a vectorized equivalent of analysing each frame individually.
+        Autocorrelations are calculated for blocks of frames at a time using
+        real FFTs, then the normalized autocorrelation (Gamma), it's maximum
+        and the parabolic interpolation of the maximum are calculated for
+        every frame in the block at once.
+
+        Arguments:
+
+        - frames: a (frames x window size) array of audio frames.
+
+        - samplerate: the samplerate of the audio analysed.
+
+        - m0: the shortest lag to search for the period at. If not provided
+          the first zero crossing of each frame's autocorrelation is used.
+
+        - M: the longest lag to search for the period at.
+
+        - block_size: the number of frames to process at once. This limits
+          the memory used by the FFTs.
+
+        Returns a (frames x 2) array of frequencies and harmonic ratios.
+        """
+        frame_count, window_size = frames.shape
+        if not M:
+            M = int(round(0.016*samplerate))
+        M = min(M, window_size)
+        # Zero pad FFTs to avoid circular correlation.
+        fft_size = int(2**np.ceil(np.log2(2*window_size-1)))
+        lags = np.arange(M)
+        output = np.empty((frame_count, 2))
+
+        for start in xrange(0, frame_count, block_size):
+            block = frames[start:start+block_size]
+            rows = np.arange(block.shape[0])
+
+            # Calculate autocorrelations for lags 0 to the window size.
+            spectrum = np.fft.rfft(block, fft_size, axis=1)
+            R = np.fft.irfft(spectrum * np.conj(spectrum), fft_size, axis=1)
+            R = R[:, :window_size]
+            # Rounding errors of the FFTs give small positive or negative
+            # values where the autocorrelation is zero, and break ties
+            # between equal values, which changes the zero crossings and
+            # peaks found. Autocorrelations are rounded to a precision above
+            # these errors. The precision is a power of 2, so integer values
+            # are exact.
+            error = window_size * np.finfo(float).eps * np.abs(R[:, :1])
+            precision = 2**np.ceil(np.log2(np.maximum(error, np.finfo(float).tiny)))
+            R = np.round(R / precision) * precision
+            g = R[:, 1]
+
+            if not m0:
+                # estimate m0 (as the first zero crossing of R)
+                block_m0 = np.argmin(np.diff(np.sign(R[:, 1:]), axis=1), axis=1)+1
+            else:
+                block_m0 = np.empty(block.shape[0], dtype=int)
+                block_m0.fill(m0)
+            block_m0[block_m0 == 1] = window_size
+
+            # Energy of the frame, excluding the samples shifted out at each
+            # lag.
+            CSum = np.cumsum(block*block, axis=1)
+            energy = CSum[:, np.clip(window_size-lags, 0, window_size-1)]
+            search_range = lags >= np.vstack(block_m0)
+
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                norm_energy = np.vstack(g) * energy
+                Gamma = R[:, :M] / (np.sqrt(norm_energy)+np.finfo(float).eps)
+                Gamma[~search_range] = 0.
+                # Frames with invalid normalizations can't be estimated.
+                invalid = np.any((norm_energy < 0) & search_range, axis=1)
+                Gamma[invalid] = 0.
+
+                # compute T0 and harmonic ratio:
+                blag = np.argmax(Gamma, axis=1)
+                HR = Gamma[rows, blag]
+
+                # Parabolic interpolation of peaks that aren't at the edges of
+                # Gamma.
+                interp = blag.astype(float)
+                inner = (blag < M-1) & (blag > 2)
+                x = blag[inner]
+                inner_rows = rows[inner]
+                f_prev = Gamma[inner_rows, x-1]
+                f_x = Gamma[inner_rows, x]
+                f_next = Gamma[inner_rows, x+1]
+                interp[inner] = 1/2. * (f_prev - f_next) / (f_prev - 2 * f_x + f_next) + x
+                HR[inner] = f_x - 1/4. * (f_prev - f_next) * (interp[inner] - x)
+
+                # get fundamental frequency:
+                f0 = samplerate / interp
+
+            no_estimate = (interp == 0) | np.isnan(Gamma).any(axis=1)
+            # Silent frames have no f0
+            no_estimate |= ~block.any(axis=1)
+            f0[no_estimate] = np.nan
+            HR[no_estimate] = np.nan
+
+            with np.errstate(invalid='ignore'):
+                if np.any(f0 > samplerate/2):
+                    raise ValueError("F0 value ({0}) is above the nyquist rate "
+                                     "({1}). This shouldn't happen...".format(
+                                         np.nanmax(f0), samplerate/2))
+                HR[HR >= 1] = 1
+
+            output[start:start+block_size, 0] = f0
+            output[start:start+block_size, 1] = HR
+
+        return output
+
     def hdf5_dataset_formatter(self, *args, **kwargs):
         '''
         Formats the output from the analysis method to save to the HDF5 file.
@@ -255,31 +356,11 @@ class F0Analysis(Analysis):
         # Get indexes of all valid frames (that aren't nan)
         valid_inds = np.isfinite(frames) & np.isfinite(harm_ratio)
 
-        format_style_dict = {
-            'mean': np.mean,
-            'median': np.median,
-            'log2_mean': self.log2_mean,
-            'log2_median': self.log2_median,
-        }
-
         if not selection.size:
             # TODO: Add warning here
             return np.nan
 
-        #for ind, i in enumerate(selection):
-        #    output[ind] = self.formatter_func(i, frames, valid_inds, harm_ratio, formatter=format_style_dict[format])
-
-        try:
-            output = np.apply_along_axis(
-                self.formatter_func,
-                1,
-                selection,
-                frames,
-                valid_inds,
-                formatter=format_style_dict[format]
-            )/self.nyquist_rate
-        except IndexError:
-            pdb.set_trace()
+        output = self.grain_average(frames, valid_inds, selection, format)/self.nyquist_rate
 
         return output
 
@@ -44,20 +44,15 @@ class F0HarmRatioAnalysis(Analysis):
         arrays of start and end time pairs will produce an array of equivelant
         size containing frames for these times.
         """
-        times = self.analysis_group["F0"]["times"][:]
-        hr = self.analysis_group["F0"]["harmonic_ratio"][:]
+        times = self.read_dataset("times", group_name="F0")
+        hr = self.read_dataset("harmonic_ratio", group_name="F0")
         start = start / 1000
         end = end / 1000
-        vtimes = times.reshape(-1, 1)
 
         nan_inds = hr < self.threshold
-        hr[nan_inds] = np.nan
+        hr = np.where(nan_inds, np.nan, hr)
 
-        selection = np.transpose((vtimes >= start) & (vtimes <= end))
-        if not selection.any():
-            frame_center = start + (end-start)/2.
-            closest_frames = np.abs(vtimes-frame_center).argsort()[:2]
-            selection[closest_frames] = True
+        selection = self.grain_frame_ranges(times, start, end)
 
         return ((hr, times), selection)
 
@@ -86,29 +81,11 @@ class F0HarmRatioAnalysis(Analysis):
         # Get indexes of all valid frames (that aren't nan)
         valid_inds = np.isfinite(harm_ratio)
 
-        format_style_dict = {
-            'mean': np.mean,
-            'median': np.median,
-            'log2_mean': self.log2_mean,
-            'log2_median': self.log2_median,
-        }
-
-        # For debugging apply along axis:
-        #for ind, i in enumerate(selection):
-        #    output[ind] = self.formatter_func(i, frames, valid_inds, harm_ratio, formatter=format_style_dict[format])
-
         if not selection.size:
             # TODO: Add warning here
             return np.nan
 
-        output = np.apply_along_axis(
-            self.formatter_func,
-            1,
-            selection,
-            harm_ratio,
-            valid_inds,
-            formatter=format_style_dict[format]
-        )
+        output = self.grain_average(harm_ratio, valid_inds, selection, format)
 
         return output
 
@@ -8,9 +8,8 @@ from __future__ import print_function, division
 import logging
 from fileops import pathops
 import numpy as np
-from numpy.lib import stride_tricks
 import os
-from AnalysisTools import ButterFilter
+from AnalysisTools import ButterFilter, frame_signal, spectral_descriptors, SPECTRAL_DESCRIPTORS
 from Analysis import Analysis
 import pdb
 
@@ -44,17 +43,40 @@ class FFTAnalysis(Analysis):
         else:
             window_size = 2048
         self.analysis_group = analysis_group
+        # Spectral descriptors calculated from the FFT frames. These are
+        # calculated on first request by spectral_descriptor.
+        self.spectral_data = None
         self.logger.info("Creating FFT analysis for {0}".format(self.AnalysedAudioFile.name))
         self.create_analysis(frames, window_size=window_size)
         self.fft_window_count = None
 
+    def spectral_descriptor(self, name):
+        """
+        Return the frames of the spectral descriptor specified.
+
+        All spectral descriptors to be generated for the audio file are
+        calculated together the first time one is requested, so that FFT
+        frames only need to be read and converted to magnitudes once.
+        """
+        if self.spectral_data is None:
+            self.spectral_data = {}
+        if name not in self.spectral_data:
+            descriptors = SPECTRAL_DESCRIPTORS.intersection(
+                self.AnalysedAudioFile.available_analyses or []
+            )
+            descriptors.add(name)
+            self.spectral_data = spectral_descriptors(
+                self.analysis['frames'],
+                descriptors,
+                self.AnalysedAudioFile.samplerate
+            )
+        return self.spectral_data[name]
+
 
 
     def create_fft_analysis(self, frames, window_size=512, window_overlap=2,
                             window_type='hanning'):
         """Create a spectral analysis for overlapping frames of audio."""
-        if hasattr(frames, '__call__'):
-            frames = frames()
         # Calculate the period of the window in hz
         lowest_freq = 1.0 / window_size
         # Filter frequencies lower than the period of the window
@@ -76,18 +98,20 @@ class FFTAnalysis(Analysis):
         arrays of start and end time pairs will produce an array of equivelant
         size containing frames for these times.
         """
-        times = self.analysis_group["FFT"]["times"][:]
+        times = self.read_dataset("times")
         start = start / 1000
         end = end / 1000
-        vtimes = times.reshape(-1, 1)
-
-        selection = np.transpose((vtimes >= start) & (vtimes <= end))
 
-        np.set_printoptions(threshold=np.nan)
+        # Frames of each grain are contiguous, so can be read as slices.
+        first = np.searchsorted(times, start, side='left')
+        last = np.searchsorted(times, end, side='right')
 
         grain_data = []
-        for grain in selection:
-            grain_data.append((self.analysis_group["FFT"]["frames"][grain, :], times[grain]))
+        for grain_start, grain_end in zip(np.atleast_1d(first), np.atleast_1d(last)):
+            grain_data.append((
+                self.analysis_group["FFT"]["frames"][grain_start:grain_end, :],
+                times[grain_start:grain_end]
+            ))
 
         return grain_data
 
@@ -114,24 +138,7 @@ class FFTAnalysis(Analysis):
     @staticmethod
     def stft(sig, frameSize, overlapFac=0.5, window=np.hanning):
         """Short time fourier transform of audio signal."""
-        win = window(frameSize)
-        hopSize = int(frameSize - np.floor(overlapFac * frameSize))
-
-        # zeros at beginning (thus center of 1st window should be for sample nr. 0)
-        samples = np.append(np.zeros(np.floor(frameSize/2).astype(int)), sig)
-        # cols for windowing
-
-        cols = np.ceil((len(samples) - frameSize) / float(hopSize)) + 1
-        # zeros at end (thus samples can be fully covered by frames)
-        samples = np.append(samples, np.zeros(frameSize))
-
-        frames = stride_tricks.as_strided(
-            samples,
-            shape=(cols, frameSize),
-            strides=(samples.strides[0]*hopSize, samples.strides[0])
-        ).copy()
-
-        frames *= win
+        frames = frame_signal(sig, frameSize, overlapFac, window=window)
 
         return np.fft.rfft(frames)
 
@@ -3,11 +3,11 @@ import os
 import numpy as np
 import logging
 from scipy import signal
-from numpy.lib import stride_tricks
 import pdb
 
 from fileops import pathops
 
+from AnalysisTools import frame_signal
 from Analysis import Analysis
 
 logger = logging.getLogger(__name__)
@@ -62,8 +62,6 @@ class KurtosisAnalysis(Analysis):
         Calculate the Kurtosis values of windowed segments of the audio file and
         save to disk.
         """
-        if hasattr(frames, '__call__'):
-            frames = frames()
         # Calculate the period of the window in hz
         # lowest_freq = 1.0 / window_size
         # Filter frequencies lower than the period of the window
@@ -72,25 +70,7 @@ class KurtosisAnalysis(Analysis):
         # TODO: Fix filter
         # frames = filter.filter_butter(frames)
 
-        hopSize = int(window_size - np.floor(overlapFac * window_size))
-
-        # zeros at beginning (thus center of 1st window should be for sample nr. 0)
-        samples = np.append(np.zeros(np.floor(window_size/2.0)), frames)
-
-        # cols for windowing
-        cols = np.ceil((len(samples) - window_size) / float(hopSize)) + 1
-        # zeros at end (thus samples can be fully covered by frames)
-        samples = np.append(samples, np.zeros(window_size))
-
-        frames = stride_tricks.as_strided(
-            samples,
-            shape=(cols, window_size),
-            strides=(samples.strides[0]*hopSize, samples.strides[0])
-        ).copy()
-
-        if window:
-            win = window(window_size)
-            frames *= win
+        frames = frame_signal(frames, window_size, overlapFac, window=window)
 
         frame_mean = np.mean(frames, axis=1)
 
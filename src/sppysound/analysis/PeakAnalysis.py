@@ -3,12 +3,12 @@ import os
 import numpy as np
 import logging
 from scipy import signal
-from numpy.lib import stride_tricks
 import pdb
 
 
 from fileops import pathops
 
+from AnalysisTools import frame_signal
 from Analysis import Analysis
 
 logger = logging.getLogger(__name__)
@@ -49,8 +49,6 @@ class PeakAnalysis(Analysis):
         Calculate the Peak values of windowed segments of the audio file and
         save to disk.
         """
-        if hasattr(frames, '__call__'):
-            frames = frames()
         # Calculate the period of the window in hz
         # lowest_freq = 1.0 / window_size
         # Filter frequencies lower than the period of the window
@@ -59,22 +57,7 @@ class PeakAnalysis(Analysis):
         # TODO: Fix filter
         # frames = filter.filter_butter(frames)
 
-        # Generate a window function to apply to peak windows before analysis
-        hopSize = int(window_size - np.floor(overlapFac * window_size))
-
-        # zeros at beginning (thus center of 1st window should be for sample nr. 0)
-        samples = np.append(np.zeros(np.floor(window_size/2.0)), frames)
-
-        # cols for windowing
-        cols = np.ceil((len(samples) - window_size) / float(hopSize)) + 1
-        # zeros at end (thus samples can be fully covered by frames)
-        samples = np.append(samples, np.zeros(window_size))
-
-        frames = stride_tricks.as_strided(
-            samples,
-            shape=(cols, window_size),
-            strides=(samples.strides[0]*hopSize, samples.strides[0])
-        ).copy()
+        frames = frame_signal(frames, window_size, overlapFac)
 
         peak = np.max(np.abs(frames), axis=1)
 
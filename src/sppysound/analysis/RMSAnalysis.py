@@ -3,12 +3,11 @@ import os
 import numpy as np
 import logging
 from scipy import signal
-from numpy.lib import stride_tricks
 import pdb
 from scipy.signal import butter, lfilter
 
 
-from AnalysisTools import ButterFilter
+from AnalysisTools import ButterFilter, frame_signal
 from fileops import pathops
 
 from Analysis import Analysis
@@ -85,25 +84,7 @@ class RMSAnalysis(Analysis):
 
 
         # Generate a window function to apply to rms windows before analysis
-        hopSize = int(window_size - np.floor(overlapFac * window_size))
-
-        # zeros at beginning (thus center of 1st window should be for sample nr. 0)
-        samples = np.append(np.zeros(np.floor(window_size/2.0)), frames)
-
-        # cols for windowing
-        cols = np.ceil((len(samples) - window_size) / float(hopSize)) + 1
-        # zeros at end (thus samples can be fully covered by frames)
-        samples = np.append(samples, np.zeros(window_size))
-
-        frames = stride_tricks.as_strided(
-            samples,
-            shape=(cols, window_size),
-            strides=(samples.strides[0]*hopSize, samples.strides[0])
-        ).copy()
-
-        if window:
-            win = window(window_size)
-            frames *= win
+        frames = frame_signal(frames, window_size, overlapFac, window=window)
         rms = np.sqrt(np.mean(np.square(np.abs(frames)), axis=1))
 
         return rms
@@ -4,6 +4,7 @@ import logging
 import pdb
 
 from Analysis import Analysis
+from AnalysisTools import spectral_descriptors
 
 class SpectralCentroidAnalysis(Analysis):
     """
@@ -37,19 +38,18 @@ class SpectralCentroidAnalysis(Analysis):
 
         self.analysis_group = analysis_group
         self.logger.info("Creating Spectral Centroid analysis for {0}".format(self.AnalysedAudioFile.name))
-        self.create_analysis(
-            self.create_spccntr_analysis,
-            fft.analysis['frames'],
-            self.AnalysedAudioFile.samplerate
-        )
+        self.create_analysis(fft)
         self.spccntr_window_count = None
 
-    def hdf5_dataset_formatter(self, analysis_method, *args, **kwargs):
+    def hdf5_dataset_formatter(self, fft):
         '''
         Formats the output from the analysis method to save to the HDF5 file.
+
+        Spectral centroid frames are taken from the spectral descriptors
+        calculated in a single pass by the FFT analysis.
         '''
         samplerate = self.AnalysedAudioFile.samplerate
-        output = self.create_spccntr_analysis(*args, **kwargs)
+        output = fft.spectral_descriptor("spccntr")
         times = self.calc_spccntr_frame_times(output, self.AnalysedAudioFile.frames, samplerate)
         return ({'frames': output, 'times': times}, {})
 
@@ -62,27 +62,12 @@ class SpectralCentroidAnalysis(Analysis):
         output_format = Choose either "freq" for output in Hz or "ind" for bin
         index output
         '''
-        fft = fft[:]
-        # Get the positive magnitudes of each bin.
-        magnitudes = np.abs(fft)
-        # Get the highest magnitude.
-        mag_max = np.max(magnitudes)
-        if not mag_max:
-            y = np.empty(magnitudes.shape[0])
-            y.fill(np.nan)
-            return y
-        # Calculate the centre frequency of each rfft bin.
-        if output_format == "freq":
-            freqs = np.fft.rfftfreq((np.size(fft, axis=1)*2)-1, 1.0/samplerate)
-        elif output_format == "ind":
-            freqs = np.arange(np.size(fft, axis=1))
-        else:
-            raise ValueError("\'{0}\' is not a valid output "
-                             "format.".format(output_format))
-        # Calculate the weighted mean
-        y = np.sum(magnitudes*freqs, axis=1) / (np.sum(magnitudes, axis=1))
-
-        return y
+        return spectral_descriptors(
+            fft,
+            ["spccntr"],
+            samplerate,
+            output_format=output_format
+        )["spccntr"]
 
     @staticmethod
     def calc_spccntr_frame_times(spccntr_frames, sample_frame_count, samplerate):
@@ -2,9 +2,9 @@ from __future__ import print_function, division
 import numpy as np
 import logging
 import pdb
-import warnings
 
 from Analysis import Analysis
+from AnalysisTools import spectral_descriptors
 
 class SpectralCrestFactorAnalysis(Analysis):
     """
@@ -38,18 +38,18 @@ class SpectralCrestFactorAnalysis(Analysis):
 
         self.analysis_group = analysis_group
         self.logger.info("Creating Spectral CrestFactor analysis for {0}".format(self.AnalysedAudioFile.name))
-        self.create_analysis(
-            self.create_spccf_analysis,
-            fft.analysis['frames'],
-        )
+        self.create_analysis(fft)
         self.spccf_window_count = None
 
-    def hdf5_dataset_formatter(self, analysis_method, *args, **kwargs):
+    def hdf5_dataset_formatter(self, fft):
         '''
         Formats the output from the analysis method to save to the HDF5 file.
+
+        Spectral crest factor frames are taken from the spectral descriptors
+        calculated in a single pass by the FFT analysis.
         '''
         samplerate = self.AnalysedAudioFile.samplerate
-        output = self.create_spccf_analysis(*args, **kwargs)
+        output = fft.spectral_descriptor("spccf")
         times = self.calc_spccf_frame_times(output, self.AnalysedAudioFile.frames, samplerate)
         return ({'frames': output, 'times': times}, {})
 
@@ -58,22 +58,7 @@ class SpectralCrestFactorAnalysis(Analysis):
         '''
         Calculate the spectral crest factor of the fft frames.
         '''
-        fft = fft[:]
-        # Get the positive magnitudes of each bin.
-        magnitudes = np.abs(fft)
-        # Get highest magnitude
-        if not np.nonzero(magnitudes)[0].size:
-            y = np.empty(magnitudes.shape[0])
-            y.fill(np.nan)
-            return y
-            # Get the highest magnitude value for each spectral frame
-        max_bins = np.max(magnitudes, axis=1)
-        mag_sum = np.sum(magnitudes, axis=1)
-        with warnings.catch_warnings():
-            warnings.filterwarnings('ignore')
-            spectral_cf = max_bins / mag_sum
-
-        return spectral_cf
+        return spectral_descriptors(fft, ["spccf"])["spccf"]
 
     @staticmethod
     def calc_spccf_frame_times(spccf_frames, sample_frame_count, samplerate):
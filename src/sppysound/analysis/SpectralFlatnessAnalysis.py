@@ -3,9 +3,9 @@ import scipy.stats as stats
 import numpy as np
 import logging
 import pdb
-import warnings
 
 from Analysis import Analysis
+from AnalysisTools import spectral_descriptors
 
 class SpectralFlatnessAnalysis(Analysis):
     """
@@ -39,18 +39,18 @@ class SpectralFlatnessAnalysis(Analysis):
 
         self.analysis_group = analysis_group
         self.logger.info("Creating Spectral Flatness analysis for {0}".format(self.AnalysedAudioFile.name))
-        self.create_analysis(
-            self.create_spcflatness_analysis,
-            fft.analysis['frames'],
-        )
+        self.create_analysis(fft)
         self.spcflatness_window_count = None
 
-    def hdf5_dataset_formatter(self, analysis_method, *args, **kwargs):
+    def hdf5_dataset_formatter(self, fft):
         '''
         Formats the output from the analysis method to save to the HDF5 file.
+
+        Spectral flatness frames are taken from the spectral descriptors
+        calculated in a single pass by the FFT analysis.
         '''
         samplerate = self.AnalysedAudioFile.samplerate
-        output = self.create_spcflatness_analysis(*args, **kwargs)
+        output = fft.spectral_descriptor("spcflatness")
         times = self.calc_spcflatness_frame_times(output, self.AnalysedAudioFile.frames, samplerate)
         return ({'frames': output, 'times': times}, {})
 
@@ -59,24 +59,7 @@ class SpectralFlatnessAnalysis(Analysis):
         '''
         Calculate the spectral flatness of the fft frames.
         '''
-        fft = fft[:]
-        # Get the positive magnitudes of each bin.
-        magnitudes = np.abs(fft)
-        if not np.nonzero(magnitudes)[0].size:
-            y = np.empty(magnitudes.shape[0])
-            y.fill(np.nan)
-            return y
-
-        # Calculate the ratio between the two.
-        with warnings.catch_warnings():
-            warnings.filterwarnings('ignore')
-            # Calculate the geometric mean of magnitudes
-            geo_mean = np.e**np.mean(np.log(magnitudes), axis=1)
-            # Calculate the arithmetic mean of magnitudes
-            arith_mean = np.mean(magnitudes, axis=1)
-            spectral_flatness = geo_mean / arith_mean
-
-        return spectral_flatness
+        return spectral_descriptors(fft, ["spcflatness"])["spcflatness"]
 
     @staticmethod
     def calc_spcflatness_frame_times(spcflatness_frames, sample_frame_count, samplerate):
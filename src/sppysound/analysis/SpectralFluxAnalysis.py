@@ -4,6 +4,7 @@ import logging
 import pdb
 
 from Analysis import Analysis
+from AnalysisTools import spectral_descriptors
 
 class SpectralFluxAnalysis(Analysis):
     """
@@ -37,18 +38,18 @@ class SpectralFluxAnalysis(Analysis):
 
         self.analysis_group = analysis_group
         self.logger.info("Creating Spectral Flux analysis for {0}".format(self.AnalysedAudioFile.name))
-        self.create_analysis(
-            self.create_spcflux_analysis,
-            fft.analysis['frames'],
-        )
+        self.create_analysis(fft)
         self.spcflux_window_count = None
 
-    def hdf5_dataset_formatter(self, analysis_method, *args, **kwargs):
+    def hdf5_dataset_formatter(self, fft):
         '''
         Formats the output from the analysis method to save to the HDF5 file.
+
+        Spectral flux frames are taken from the spectral descriptors
+        calculated in a single pass by the FFT analysis.
         '''
         samplerate = self.AnalysedAudioFile.samplerate
-        output = self.create_spcflux_analysis(*args, **kwargs)
+        output = fft.spectral_descriptor("spcflux")
         times = self.calc_spcflux_frame_times(output, self.AnalysedAudioFile.frames, samplerate)
         return ({'frames': output, 'times': times}, {})
 
@@ -61,21 +62,7 @@ class SpectralFluxAnalysis(Analysis):
         output_format = Choose either "freq" for output in Hz or "ind" for bin
         index output
         '''
-        fft = fft[:]
-        # Get the positive magnitudes of each bin.
-        magnitudes = np.abs(fft)
-        if not np.nonzero(magnitudes)[0].size:
-            y = np.empty(magnitudes.shape[0])
-            y.fill(np.nan)
-            return y
-        # Roll magnitudes as flux is calculated using the difference between
-        # consecutive magnitudes. Rolling allows for quick access to previous
-        # magnitude.
-        rolled_mags = np.roll(magnitudes, 1, axis=0)[1:]
-        sum_of_squares = np.sum((magnitudes[1:]-rolled_mags)**2., axis=1)
-        spectral_flux = np.sqrt(sum_of_squares) / (np.size(fft, axis=1))
-
-        return spectral_flux
+        return spectral_descriptors(fft, ["spcflux"])["spcflux"]
 
     @staticmethod
     def calc_spcflux_frame_times(spcflux_frames, sample_frame_count, samplerate):
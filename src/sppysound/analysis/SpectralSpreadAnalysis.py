@@ -4,6 +4,7 @@ import logging
 import pdb
 
 from Analysis import Analysis
+from AnalysisTools import spectral_descriptors
 
 class SpectralSpreadAnalysis(Analysis):
     """
@@ -41,19 +42,18 @@ class SpectralSpreadAnalysis(Analysis):
 
         self.analysis_group = analysis_group
         self.logger.info("Creating Spectral Spread analysis for {0}".format(self.AnalysedAudioFile.name))
-        self.create_analysis(
-            fft.analysis['frames'],
-            spccntr.analysis['frames'],
-            self.AnalysedAudioFile.samplerate
-        )
+        self.create_analysis(fft)
         self.spccntr_window_count = None
 
-    def hdf5_dataset_formatter(self, *args, **kwargs):
+    def hdf5_dataset_formatter(self, fft):
         '''
         Formats the output from the analysis method to save to the HDF5 file.
+
+        Spectral spread frames are taken from the spectral descriptors
+        calculated in a single pass by the FFT analysis.
         '''
         samplerate = self.AnalysedAudioFile.samplerate
-        output = self.create_spcsprd_analysis(*args, **kwargs)
+        output = fft.spectral_descriptor("spcsprd")
         times = self.calc_spcsprd_frame_times(output, self.AnalysedAudioFile.frames, samplerate)
         return ({'frames': output, 'times': times}, {})
 
@@ -67,32 +67,13 @@ class SpectralSpreadAnalysis(Analysis):
         length: the length of the window used to calculate the FFT.
         samplerate: the samplerate of the audio analysed.
         '''
-        fft = fft[:]
-        spectral_centroid = spectral_centroid[:]
-        # Get the positive magnitudes of each bin.
-        magnitudes = np.abs(fft)
-        mag_max = np.max(magnitudes)
-        if not mag_max:
-            y = np.empty(magnitudes.shape[0])
-            y.fill(np.nan)
-            return y
-        # Get the index for each bin
-        if output_format == "ind":
-            freqs = np.arange(np.size(fft, axis=1))
-        elif output_format == "freq":
-            freqs = np.fft.rfftfreq((np.size(fft, axis=1)*2)-1, 1.0/samplerate)
-        else:
-            raise ValueError("\'{0}\' is not a valid output "
-                             "format.".format(output_format))
-
-        spectral_centroid = np.vstack(spectral_centroid)
-
-        a = (freqs-spectral_centroid)**2
-        mag_sqrd = magnitudes**2
-        # Calculate the weighted mean
-        y = np.sqrt(np.sum(a*mag_sqrd, axis=1) / (np.sum(mag_sqrd, axis=1)))
-
-        return y
+        return spectral_descriptors(
+            fft,
+            ["spcsprd"],
+            samplerate,
+            output_format=output_format,
+            spectral_centroid=spectral_centroid
+        )["spcsprd"]
 
     @staticmethod
     def calc_spcsprd_frame_times(spcsprd_frames, sample_frame_count, samplerate):
@@ -3,11 +3,10 @@ import os
 import numpy as np
 import logging
 from scipy import signal
-from numpy.lib import stride_tricks
 import pdb
 
 
-from AnalysisTools import ButterFilter
+from AnalysisTools import ButterFilter, frame_signal
 from fileops import pathops
 
 from Analysis import Analysis
@@ -63,23 +62,7 @@ class VarianceAnalysis(Analysis):
         # TODO: Fix filter
         # frames = filter.filter_butter(frames)
 
-        if hasattr(frames, '__call__'):
-            frames = frames()
-        hopSize = int(window_size - np.floor(overlapFac * window_size))
-
-        # zeros at beginning (thus center of 1st window should be for sample nr. 0)
-        samples = np.append(np.zeros(np.floor(window_size/2.0)), frames)
-
-        # cols for windowing
-        cols = np.ceil((len(samples) - window_size) / float(hopSize)) + 1
-        # zeros at end (thus samples can be fully covered by frames)
-        samples = np.append(samples, np.zeros(window_size))
-
-        frames = stride_tricks.as_strided(
-            samples,
-            shape=(cols, window_size),
-            strides=(samples.strides[0]*hopSize, samples.strides[0])
-        ).copy()
+        frames = frame_signal(frames, window_size, overlapFac)
 
         frame_mean = np.mean(frames, axis=1)
         variance = (1 / window_size) * np.sum((frames-np.vstack(frame_mean))**2, axis=1)
@@ -1,7 +1,7 @@
 from __future__ import print_function, division
 import numpy as np
 import logging
-from numpy.lib import stride_tricks
+from AnalysisTools import frame_signal
 from Analysis import Analysis
 import pdb
 
@@ -42,28 +42,12 @@ class ZeroXAnalysis(Analysis):
         **kwargs
     ):
         """Generate zero crossing value for window of the signal"""
-        if hasattr(frames, '__call__'):
-            frames = frames()
-        hopSize = int(window_size - np.floor(overlapFac * window_size))
-
-        # zeros at beginning (thus center of 1st window should be for sample nr. 0)
-        samples = np.append(np.zeros(np.floor(window_size/2.0)), frames)
-
-        # cols for windowing
-        cols = np.ceil((len(samples) - window_size) / float(hopSize)) + 1
-        # zeros at end (thus samples can be fully covered by frames)
-        samples = np.append(samples, np.zeros(window_size))
+        frames = frame_signal(frames, window_size, overlapFac)
 
         # TODO: Better handeling of zeros based on previous sign would improve
         # accuracy.
         epsilon = np.finfo(float).eps
-        samples[samples == 0.] += epsilon
-
-        frames = stride_tricks.as_strided(
-            samples,
-            shape=(cols, window_size),
-            strides=(samples.strides[0]*hopSize, samples.strides[0])
-        ).copy()
+        frames = np.where(frames == 0., epsilon, frames)
         zero_crossing = np.sum(np.abs(np.diff(np.sign(frames))), axis=1)
         return zero_crossing
 
@@ -89,7 +73,6 @@ class ZeroXAnalysis(Analysis):
         '''
         Formats the output from the analysis method to save to the HDF5 file.
         '''
-        samples = self.AnalysedAudioFile.read_grain()
         samplerate = self.AnalysedAudioFile.samplerate
         output = self.create_zerox_analysis(*args, **kwargs)
         times = self.calc_zerox_frame_times(output, args[0], samplerate)
@@ -0,0 +1,415 @@
+"""
+Module for building, storing and querying approximate nearest neighbour
+indexes of grain features, for source databases too large to search exactly.
+"""
+from __future__ import print_function, division
+import os
+import time
+import json
+import logging
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from search_index import SearchIndex, atomic_write, remove_stale
+
+logger = logging.getLogger(__name__)
+
+
+def squared_distances(x, y, y_norms=None):
+    """
+    Calculate the squared euclidean distance between each row of x and each
+    row of y.
+
+    The squared norms of the rows of y can be provided when y is reused for
+    many calls.
+    """
+    if y_norms is None:
+        y_norms = np.einsum('ij,ij->i', y, y)
+    distances = np.einsum('ij,ij->i', x, x)[:, np.newaxis] - 2 * np.dot(x, y.T) + y_norms
+    # Rounding errors can give small negative distances.
+    return np.maximum(distances, 0)
+
+
+def fold_matches(best_distances, best_indexes, distances, indexes, k):
+    """
+    Combine the best k matches found so far for each row with a new set of
+    candidate matches, keeping the best k of both.
+    """
+    distances = np.hstack((best_distances, distances))
+    indexes = np.hstack((best_indexes, indexes))
+    if distances.shape[1] > k:
+        best = np.argpartition(distances, k-1, axis=1)[:, :k]
+        rows = np.arange(distances.shape[0])[:, np.newaxis]
+        distances = distances[rows, best]
+        indexes = indexes[rows, best]
+    return distances, indexes
+
+
+class ApproximateIndex(object):
+
+    """
+    An approximate nearest neighbour index over the grain features of a
+    source database, using an inverted file.
+
+    Weighted grain features are partitioned into lists using k-means
+    clustering. A query is only compared to the grains of the lists with the
+    centroids closest to it, so query time is roughly proportional to the
+    number of lists probed over the number of lists. Probing more lists
+    increases the recall of the search (the proportion of the true nearest
+    neighbours found) at the cost of speed. Probing all lists is exact.
+
+    As with SearchIndex, rows of the feature matrix are the global grain
+    indexes of the source database, and weightings are applied as a scaling
+    of both the indexed features and the query. Unlike SearchIndex, the
+    partitioning depends on the weighting, so the index must be rebuilt when
+    the weighting changes. Saved indexes are stored separately for each
+    weighting, so indexes of several weightings can be kept.
+
+    Arguments:
+
+    - features: a (grains x analyses) array of grain features.
+
+    - weights: the weighting of each feature. Features are unweighted if not
+      provided.
+
+    - lists: the number of lists to partition grains into. Defaults to
+      sqrt(grains).
+
+    - probes: the number of lists searched for each query.
+
+    - iterations: the number of k-means iterations used to train the
+      centroids of the lists.
+
+    - tile_size: the number of queries and grains compared at once. Memory
+      used is proportional to the square of this value.
+
+    - seed: the seed of the random number generator used for training.
+
+    - grain_indexes: the global grain index of each row of the features, for
+      indexes of a subset of the source database's grains. Rows are the
+      global grain indexes if not provided.
+    """
+
+    def __init__(
+        self,
+        features,
+        weights=None,
+        lists=None,
+        probes=8,
+        iterations=10,
+        tile_size=2048,
+        seed=0,
+        grain_indexes=None
+    ):
+        self.logger = logging.getLogger(__name__ + '.ApproximateIndex')
+        if weights is None:
+            weights = np.ones(features.shape[1])
+        self.weights = np.asarray(weights, dtype=float)
+        if features is not None:
+            if not lists:
+                lists = int(np.sqrt(features.shape[0]))
+            lists = min(lists, features.shape[0])
+        self.lists = int(max(1, lists))
+        self.probes = probes
+        self.iterations = iterations
+        self.tile_size = tile_size
+        self.seed = seed
+        # Set by build or load.
+        self.centroids = None
+        # Weighted features sorted by list, and the global grain index of
+        # each sorted row.
+        self.sorted_features = None
+        self.sorted_indexes = None
+        # The start of each list in the sorted features, with the end of the
+        # last list appended.
+        self.list_starts = None
+        # The position of each grain in the sorted features, in order of
+        # global grain index. Calculated when first needed.
+        self.grain_order = None
+        if features is not None:
+            self.build(features, grain_indexes)
+
+    def __len__(self):
+        """Return the number of grains in the index."""
+        return self.sorted_indexes.size
+
+    def grains(self):
+        """Return the global grain index of every grain in the index."""
+        return self.sorted_indexes
+
+    def grain_features(self, grains):
+        """
+        Return the weighted features of grains in the index, from their
+        sorted global grain indexes.
+        """
+        if self.grain_order is None:
+            self.grain_order = np.argsort(self.sorted_indexes)
+        positions = self.grain_order[np.searchsorted(
+            self.sorted_indexes[self.grain_order],
+            grains
+        )]
+        return self.sorted_features[positions]
+
+    def build(self, features, grain_indexes=None):
+        """Partition the features into lists."""
+        weighted = np.asarray(features, dtype=float) * self.weights
+        grain_count = weighted.shape[0]
+        self.logger.info("Building approximate index of {0} grains with {1} "
+                         "lists...".format(grain_count, self.lists))
+        rng = np.random.RandomState(self.seed)
+
+        # Train centroids on a sample of the grains. 64 grains per list is
+        # plenty for a stable clustering.
+        sample_size = min(grain_count, self.lists * 64)
+        sample = weighted[np.sort(rng.choice(grain_count, sample_size, replace=False))]
+        centroids = sample[rng.choice(sample_size, self.lists, replace=False)]
+        for i in xrange(self.iterations):
+            assignments = self.assign(sample, centroids)
+            counts = np.bincount(assignments, minlength=self.lists)
+            sums = np.column_stack([
+                np.bincount(assignments, weights=column, minlength=self.lists)
+                for column in sample.T
+            ])
+            empty = counts == 0
+            centroids = sums / np.maximum(counts, 1)[:, np.newaxis]
+            # Restart empty lists at random grains.
+            centroids[empty] = sample[rng.choice(sample_size, np.sum(empty))]
+        self.centroids = centroids
+
+        assignments = self.assign(weighted, centroids)
+        order = np.argsort(assignments, kind='mergesort')
+        self.sorted_features = weighted[order]
+        if grain_indexes is not None:
+            order = np.asarray(grain_indexes)[order]
+        self.sorted_indexes = order
+        counts = np.bincount(assignments, minlength=self.lists)
+        self.list_starts = np.hstack(([0], np.cumsum(counts)))
+
+    def assign(self, x, centroids):
+        """Find the index of the closest centroid to each row of x."""
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        block_size = max(1, self.tile_size**2 // centroids.shape[0])
+        assignments = np.empty(x.shape[0], dtype=int)
+        for start in xrange(0, x.shape[0], block_size):
+            block = x[start:start+block_size]
+            assignments[start:start+block_size] = np.argmin(
+                squared_distances(block, centroids, centroid_norms),
+                axis=1
+            )
+        return assignments
+
+    def query(self, x, k, probes=None, n_jobs=1):
+        """
+        Find approximately the k closest grains to each row of x, using the
+        index's weighting.
+
+        Queries are split between n_jobs parallel threads. If n_jobs is -1,
+        all processors are used.
+
+        Returns an array of distances and an array of global grain indexes,
+        each with a row for each row of x and a column for each match, sorted
+        by distance.
+        """
+        if n_jobs == -1:
+            n_jobs = mp.cpu_count()
+        x = np.atleast_2d(x)
+        if n_jobs > 1 and x.shape[0] > 1:
+            # NumPy releases the GIL for distance calculations, so threads
+            # searching separate blocks of queries run in parallel.
+            pool = ThreadPool(n_jobs)
+            try:
+                results = pool.map(
+                    lambda block: self.query(block, k, probes=probes),
+                    np.array_split(x, min(n_jobs, x.shape[0]))
+                )
+            finally:
+                pool.close()
+            return (
+                np.vstack([result[0] for result in results]),
+                np.vstack([result[1] for result in results])
+            )
+
+        if probes is None:
+            probes = self.probes
+        probes = int(max(1, min(probes, self.lists)))
+        x = x * self.weights
+        grain_count = self.sorted_indexes.size
+        k = min(k, grain_count)
+        if not x.shape[0]:
+            return np.empty((0, k)), np.empty((0, k), dtype=int)
+
+        # Find the lists to probe for each query.
+        centroid_distances = squared_distances(x, self.centroids)
+        if probes < self.lists:
+            probed = np.argpartition(centroid_distances, probes-1, axis=1)[:, :probes]
+        else:
+            probed = np.tile(np.arange(self.lists), (x.shape[0], 1))
+
+        # Search each list for all of the queries probing it at once.
+        best_distances = np.full((x.shape[0], k), np.inf)
+        best_indexes = np.full((x.shape[0], k), -1, dtype=int)
+        pairs = np.argsort(probed.ravel(), kind='mergesort')
+        pair_lists = probed.ravel()[pairs]
+        pair_queries = pairs // probes
+        bounds = np.searchsorted(pair_lists, np.arange(self.lists+1))
+        for list_ind in xrange(self.lists):
+            queries = pair_queries[bounds[list_ind]:bounds[list_ind+1]]
+            start, end = self.list_starts[list_ind], self.list_starts[list_ind+1]
+            if not queries.size or start == end:
+                continue
+            members = self.sorted_features[start:end]
+            member_norms = np.einsum('ij,ij->i', members, members)
+            member_indexes = self.sorted_indexes[start:end]
+            tile_queries = max(1, self.tile_size**2 // members.shape[0])
+            for tile_start in xrange(0, queries.size, tile_queries):
+                tile = queries[tile_start:tile_start+tile_queries]
+                distances = squared_distances(x[tile], members, member_norms)
+                best_distances[tile], best_indexes[tile] = fold_matches(
+                    best_distances[tile],
+                    best_indexes[tile],
+                    distances,
+                    np.broadcast_to(member_indexes, distances.shape),
+                    k
+                )
+
+        # Queries whose probed lists held fewer than k grains are searched
+        # exactly.
+        incomplete = np.any(best_indexes < 0, axis=1)
+        if np.any(incomplete):
+            best_distances[incomplete], best_indexes[incomplete] = self.exact_squared(x[incomplete], k)
+
+        return self.sort_matches(best_distances, best_indexes)
+
+    def exact_query(self, x, k):
+        """
+        Find the exact k closest grains to each row of x by comparing x to
+        every grain in the index.
+
+        Returns the same as query.
+        """
+        x = np.atleast_2d(x) * self.weights
+        k = min(k, self.sorted_indexes.size)
+        return self.sort_matches(*self.exact_squared(x, k))
+
+    def exact_squared(self, x, k):
+        """
+        Find the squared distances and indexes of the k closest grains to
+        each row of weighted queries x.
+        """
+        best_distances = np.full((x.shape[0], k), np.inf)
+        best_indexes = np.full((x.shape[0], k), -1, dtype=int)
+        for start in xrange(0, self.sorted_indexes.size, self.tile_size):
+            members = self.sorted_features[start:start+self.tile_size]
+            distances = squared_distances(x, members)
+            best_distances, best_indexes = fold_matches(
+                best_distances,
+                best_indexes,
+                distances,
+                np.broadcast_to(self.sorted_indexes[start:start+self.tile_size], distances.shape),
+                k
+            )
+        return best_distances, best_indexes
+
+    @staticmethod
+    def sort_matches(squared, indexes):
+        """Sort matches of each row by distance and return the distances."""
+        order = np.argsort(squared, axis=1)
+        rows = np.arange(squared.shape[0])[:, np.newaxis]
+        return np.sqrt(squared[rows, order]), indexes[rows, order]
+
+    def measure_recall(self, x, k, probes=None):
+        """
+        Measure the recall of the index against an exact search for the
+        queries given.
+
+        Recall is the proportion of the exact k nearest neighbours of each
+        query that are found by the approximate search.
+
+        Returns the recall and the time taken by the approximate and exact
+        searches.
+        """
+        k = min(k, self.sorted_indexes.size)
+        start_time = time.time()
+        approximate_indexes = self.query(x, k, probes=probes)[1]
+        approximate_time = time.time() - start_time
+        start_time = time.time()
+        exact_indexes = self.exact_query(x, k)[1]
+        exact_time = time.time() - start_time
+        found = sum(
+            np.intersect1d(a, e).size
+            for a, e in zip(approximate_indexes, exact_indexes)
+        )
+        recall = found / max(exact_indexes.size, 1)
+        return recall, approximate_time, exact_time
+
+    @staticmethod
+    def index_paths(directory, key, weights=None):
+        """
+        Return the paths of the files used to store the index for a key and
+        weighting.
+        """
+        prefix = os.path.join(directory, "ann_index_{0}_{1}".format(key, SearchIndex.weights_key(weights)))
+        return {
+            "features": prefix + ".npy",
+            "lists": prefix + ".npz",
+            "info": prefix + ".json"
+        }
+
+    def save(self, directory, key, info=None):
+        """
+        Save the index to the directory specified.
+
+        As with SearchIndex.save, files are moved into place once written,
+        and the manifest is written last. Approximate indexes saved for other
+        keys are then removed, but indexes saved for the same key with other
+        weightings are kept. Arguments are the same as SearchIndex.save.
+        """
+        paths = self.index_paths(directory, key, self.weights)
+        with atomic_write(paths["features"]) as features_file:
+            np.save(features_file, self.sorted_features)
+        # The lists are only valid for the weighting they were built with, so
+        # the weighting is saved with them.
+        with atomic_write(paths["lists"]) as lists_file:
+            np.savez(
+                lists_file,
+                weights=self.weights,
+                centroids=self.centroids,
+                sorted_indexes=self.sorted_indexes,
+                list_starts=self.list_starts
+            )
+        with atomic_write(paths["info"]) as info_file:
+            json.dump({"info": info or {}, "files": ["features", "lists"]}, info_file, sort_keys=True, indent=4)
+        remove_stale(directory, "ann_index_", key)
+        self.logger.info("Saved approximate index to: {0}".format(paths["features"]))
+
+    @classmethod
+    def load(cls, directory, key, weights=None, probes=8, tile_size=2048):
+        """
+        Load the index saved for the key and weighting from the directory
+        specified.
+
+        Returns None if no complete index has been saved for the key with
+        the weighting given.
+        """
+        paths = cls.index_paths(directory, key, weights)
+        try:
+            with open(paths["info"], 'r') as info_file:
+                if json.load(info_file).get("files") != ["features", "lists"]:
+                    return None
+            with np.load(paths["lists"]) as lists:
+                if weights is None:
+                    weights = np.ones(lists["centroids"].shape[1])
+                if not np.array_equal(lists["weights"], np.asarray(weights, dtype=float)):
+                    return None
+                index = cls(None, weights=weights, lists=lists["centroids"].shape[0],
+                            probes=probes, tile_size=tile_size)
+                index.centroids = lists["centroids"]
+                index.sorted_indexes = lists["sorted_indexes"]
+                index.list_starts = lists["list_starts"]
+            index.sorted_features = np.load(paths["features"], mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            # As with SearchIndex.load, files of the index are missing or
+            # were removed by another process.
+            return None
+        logger.info("Loaded approximate index from: {0}".format(paths["features"]))
+        return index
@@ -34,6 +34,7 @@ import analysis.VarianceAnalysis as VarianceAnalysis
 import analysis.KurtosisAnalysis as KurtosisAnalysis
 import analysis.SkewnessAnalysis as SkewnessAnalysis
 import analysis.F0HarmRatioAnalysis as F0HarmRatioAnalysis
+from analysis.AnalysisTools import FrameCache
 
 logger = logging.getLogger(__name__).addHandler(logging.NullHandler())
 
@@ -896,7 +897,9 @@ class AnalysedAudioFile(AudioFile):
         ]
 
         self.analyses = defaultdict(None)
-        frames = self.read_grain
+        # Audio is decoded once and framed views of it are shared between
+        # analyses.
+        frames = FrameCache(self.read_grain)
 
         # Create the analysis objects for analyses that have been specified in
         # the analyses member variable.
@@ -904,6 +907,12 @@ class AnalysedAudioFile(AudioFile):
             if analysis.name in self.available_analyses:
                 self.analyses[analysis.name] = analysis.analysis_object(self, frames, self.analysis_storage, config=self.config)
 
+        # Record the analyses that have been created for the file.
+        if self.analysis_storage.file.mode != 'r':
+            created_analyses = set(self.analysis_storage.attrs.get("analyses", []))
+            created_analyses.update(self.analyses.keys())
+            self.analysis_storage.attrs["analyses"] = sorted(created_analyses)
+
     def create_analysis_group(self, analysis_file):
         """
         Create HDF5 group for object to store analyses for this audio file.
@@ -928,6 +937,11 @@ class AnalysedAudioFile(AudioFile):
                 analysis_file = h5py.File(datapath, 'a')
         # Create a group to store analyses for this file in
         group_name = ''.join(("analysis/", self.name))
+        if analysis_file.mode == 'r':
+            # Existing analyses can only be read from read-only files.
+            if group_name not in analysis_file:
+                raise IOError("{0} has not been analysed.".format(self.name))
+            return analysis_file[group_name]
         try:
             analysis_file.create_group(group_name)
         except ValueError:
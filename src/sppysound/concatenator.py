@@ -201,7 +201,7 @@ def parse_arguments():
         metavar='',
         help="R|Choose the algorithm to use when matching analyses. Available "
         "algorithms are:\nBrute force: \'bruteforce\'\nK-d Tree Search: "
-        "'kdtree'",
+        "'kdtree'\nApproximate Nearest Neighbour Search: 'ann'",
     )
 
     parser.add_argument(
@@ -303,7 +303,8 @@ def main():
 
     match_method_dict = {
         'bruteforce': matcher.brute_force_matcher,
-        'kdtree': matcher.kdtree_matcher
+        'kdtree': matcher.kdtree_matcher,
+        'ann': matcher.ann_matcher
     }
 
     # Perform matching on databases using the method specified.
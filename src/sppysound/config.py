@@ -90,7 +90,14 @@ analysis = {
     # Force the deletion of any pre-existing analyses to create new ones. This
     # is needed for overwriting old analyses generated with different
     # parameters to the current ones.
-    "reanalyse": False
+    "reanalyse": False,
+    # The number of processes used to analyse files in a database. Values
+    # greater than 1 analyse files in parallel.
+    "processes": 1,
+    # The maximum size (in megabytes) of analysis data kept in memory after
+    # being read from the database, to avoid re-reading analyses during
+    # matching and synthesis.
+    "cache_size": 256
 }
 
 matcher = {
@@ -105,8 +112,70 @@ matcher = {
     # also be specified in the synthesis config
     "match_quantity": 2,
     # Choose the algorithm used to perform matching. kdtree is recommended for
-    # larger datasets.
-    "method": 'kdtree'
+    # larger datasets. ann (approximate nearest neighbour) is much faster for
+    # very large source databases, but may not find the closest grains.
+    "method": 'kdtree',
+    # Save the search index built for the source database in it's data
+    # directory, so that later runs with the same database and matcher
+    # settings can load it rather than rebuilding it.
+    "persist_index": True,
+    # The number of target and source grains compared at once by the brute
+    # force matcher. Memory used is proportional to the square of this value.
+    "tile_size": 2048,
+    # Standardize grain features using the mean and standard deviation of
+    # each analysis over the source database, so that analyses with
+    # different units are compared on the same scale.
+    "standardize_features": True,
+    # The number of parallel jobs used to query the search index with the
+    # grains of all target entries. Set to -1 to use all processors.
+    "n_jobs": 1,
+    # The number of lists source grains are partitioned into by the ann
+    # method. Defaults to the square root of the number of source grains when
+    # set to None.
+    "ann_lists": None,
+    # The number of lists searched for each target grain by the ann method.
+    # Searching more lists finds more of the closest grains (higher recall),
+    # but is slower.
+    "ann_probes": 8,
+    # The number of target grains used to measure the recall of the ann
+    # method against an exact search. Set to 0 to disable.
+    "ann_recall_sample": 200,
+    # Grains with a mean RMS or peak level (in dBFS) below these thresholds
+    # are treated as silence. Silent source grains are left out of the search
+    # index, and silent target grains aren't matched and are synthesized as
+    # silence. Set to None to disable. Only used by the kdtree and ann
+    # methods.
+    "silence_rms_threshold": None,
+    "silence_peak_threshold": None,
+    # Restrict the source grains each target grain can be matched to using
+    # ranges of analysis values. Ranges are in the units grain values are
+    # matched in, after formatting with analysis_dict, not in Hz. Spectral
+    # centroid and spread are FFT bin indexes (each bin is the samplerate
+    # divided by the FFT window size wide), and f0 is divided by the Nyquist
+    # rate of the file. Each of the matched analyses can be given either an
+    # absolute range of values, for example a spectral centroid between 500
+    # and 2000Hz with a 4096 sample FFT of 44.1kHz audio:
+    #     "spccntr": {"absolute": [500*4096/44100., 2000*4096/44100.]}
+    # or a range relative to the value of the target grain, for example
+    # within 1 semitone of the target's f0 (when f0 is formatted with
+    # "median" or "mean", as log2 formats don't preserve frequency ratios):
+    #     "f0": {"relative": [2**(-1/12.), 2**(1/12.)]}
+    # Tighter ranges make matching faster. Target grains without any source
+    # grains in range are synthesized as silence. Only used by the kdtree
+    # and ann methods.
+    "constraints": {},
+    # Project weighted grain features onto their principal components before
+    # searching, to reduce the number of dimensions searched. Either the
+    # number of components to keep, or the proportion of the variance of the
+    # source grains to keep if less than 1 (for example 0.99). Set to None to
+    # search all analyses. Only used by the kdtree and ann methods.
+    "projection_components": None,
+    # Scale each projected component to unit variance, so that all components
+    # contribute equally to the distance between grains.
+    "projection_whiten": False,
+    # The number of source grains used to measure the query speedup of the
+    # projection when the search index is built. Set to 0 to disable.
+    "projection_benchmark_sample": 1000
 }
 
 synthesizer = {
@@ -127,7 +196,19 @@ synthesizer = {
     "normalize" : False,
     # Defines the number of potential grains to choose from matches when
     # synthesizing output.
-    "match_quantity": 2
+    "match_quantity": 2,
+    # The maximum number of source audio files kept open while reading
+    # grains for synthesis.
+    "max_open_files": 32,
+    # Decode the source database once into a memory mapped sample pool and
+    # read grains from it, rather than reading grains from the audio files.
+    "sample_pool": True,
+    # The number of grains synthesized at once. Memory used is proportional
+    # to this value multiplied by the grain size.
+    "batch_size": 1024,
+    # The number of worker processes used to synthesize outputs for
+    # different targets at once.
+    "processes": 1
 }
 
 # Specifies the format for the output file. Changing this has not been tested
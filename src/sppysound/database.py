@@ -2,6 +2,9 @@ from __future__ import print_function, division
 import os
 import shutil
 import collections
+import hashlib
+import argparse
+import multiprocessing as mp
 from scipy import signal, spatial
 import numpy as np
 import pysndfile
@@ -9,9 +12,17 @@ import pdb
 import sys
 import traceback
 import logging
+import time
 import h5py
 import pitch_shift
-from sklearn.preprocessing import Imputer
+from search_index import SearchIndex
+from ann_index import ApproximateIndex, squared_distances, fold_matches
+from range_index import RangeIndex
+from projection import Projection
+from grain_reader import GrainReader
+from sample_pool import SamplePool
+from overlap_add import OverlapAddWriter
+from feature_store import FeatureStore
 
 from fileops import pathops
 from audiofile import AnalysedAudioFile, AudioFile
@@ -24,6 +35,7 @@ import analysis.SpectralCentroidAnalysis as SpectralCentroidAnalysis
 import analysis.SpectralSpreadAnalysis as SpectralSpreadAnalysis
 import analysis.F0Analysis as F0Analysis
 import analysis.CentroidAnalysis as CentroidAnalysis
+from analysis.AnalysisTools import analysis_cache
 
 logger = logging.getLogger(__name__).addHandler(logging.NullHandler())
 
@@ -106,8 +118,21 @@ class AudioDatabase:
         """
         return self.analysed_audio[key]
 
-    def load_database(self, reanalyse=False):
-        """Create/Read from a pre-existing database"""
+    def load_database(self, reanalyse=False, read_only=False):
+        """
+        Create/Read from a pre-existing database
+
+        If read_only is True, the analyses of the files in the audio file
+        list are read from an existing database without modifying it. This
+        allows multiple processes to read the same database.
+        """
+        if read_only:
+            subdir_paths = {
+                key: os.path.join(self.db_dir, key) for key in ('audio', 'data')
+            }
+            self.subdirs = subdir_paths
+            self.analyse_database(subdir_paths, False, processes=1, read_only=True)
+            return
 
         subdir_paths = self.create_subdirs()
 
@@ -120,7 +145,7 @@ class AudioDatabase:
 
         self.analyse_database(subdir_paths, reanalyse)
 
-    def analyse_database(self, subdir_paths, reanalyse):
+    def analyse_database(self, subdir_paths, reanalyse, processes=None, read_only=False):
         """
         create selected analyses for audio files in the database.
 
@@ -129,11 +154,24 @@ class AudioDatabase:
         - subdir_paths: a dictionary containing paths to the 'audio' directory and 'data' directory of the database.
 
         - reanalyse: If previous analyses are found this can be set to True to overwrite them.
+
+        - processes: The number of worker processes used to generate
+          analyses. If more than one, files are analysed in parallel and
+          their analyses are written to the database by this process. If not
+          provided, the value in the analysis config is used.
+
+        - read_only: If True, the analysis file is opened read-only and
+          existing analyses are used. Files without analyses are skipped.
         """
+        if not processes:
+            processes = 1
+            if self.config:
+                processes = self.config.analysis.get("processes", 1)
+
         # Create data file for storing analysis data for the database
         datapath = os.path.join(subdir_paths['data'], 'analysis_data.hdf5')
         try:
-            self.data = h5py.File(datapath, 'a')
+            self.data = h5py.File(datapath, 'r' if read_only else 'a')
         except IOError:
             raise IOError("Unable to create/append to file: {0}\nThis may be "
                           "due to another instance of this program running or a "
@@ -142,7 +180,16 @@ class AudioDatabase:
                           "neccesary.".format(datapath))
         self.analysed_audio = []
 
+        failed_items = set()
+        if processes > 1:
+            failed_items = self.analyse_parallel(subdir_paths, reanalyse, processes)
+            # Analyses generated by the workers are now in the database, so
+            # they only need to be loaded below.
+            reanalyse = False
+
         for item in self.audio_file_list:
+            if item in failed_items:
+                continue
             filepath = os.path.join(subdir_paths['audio'], os.path.basename(item))
             # if there is no wav file then skip
             try:
@@ -168,6 +215,83 @@ class AudioDatabase:
                 continue
         self.logger.debug("Analysis Finished.")
 
+    def analyse_parallel(self, subdir_paths, reanalyse, processes):
+        """
+        Generate analyses for audio files in the database using a pool of
+        worker processes.
+
+        Each worker analyses a file into a temporary HDF5 file in the data
+        directory. Results are then copied into the database's analysis file
+        by this process, so that only one process ever writes to it. Files
+        that already have all analyses are skipped unless re-analysing.
+
+        Returns a set of the files that couldn't be analysed.
+        """
+        jobs = []
+        for ind, item in enumerate(self.audio_file_list):
+            name = os.path.basename(item)
+            group_name = ''.join(("analysis/", name))
+            if not reanalyse and group_name in self.data:
+                group = self.data[group_name]
+                # Files analysed without a record of their analyses are left
+                # for the serial pass, which reuses any existing analyses.
+                if "analyses" not in group.attrs or self.analysis_list <= set(group.attrs["analyses"]):
+                    continue
+            jobs.append((
+                item,
+                os.path.join(subdir_paths['audio'], name),
+                name,
+                os.path.join(subdir_paths['data'], ".analysis_worker_{0}.hdf5".format(ind)),
+                self.analysis_list,
+                self.db_dir,
+                config_namespace(self.config)
+            ))
+
+        failed_items = set()
+        if not jobs:
+            return failed_items
+
+        self.logger.info("Analysing {0} files using {1} processes...".format(len(jobs), processes))
+        pool = mp.Pool(processes)
+        try:
+            results = pool.imap_unordered(analyse_file_worker, jobs)
+            for count, (item, worker_path, err) in enumerate(results, 1):
+                if err:
+                    # Skip any audio file objects that can't be analysed
+                    self.logger.warning("File cannot be analysed: {0}\nReason: {1}\n"
+                          "Skipping...".format(item, err))
+                    failed_items.add(item)
+                else:
+                    self.store_worker_analyses(worker_path, os.path.basename(item))
+                self.logger.info("Analysed file {0} of {1}: {2}".format(count, len(jobs), item))
+        finally:
+            pool.close()
+            pool.join()
+            for job in jobs:
+                if os.path.exists(job[3]):
+                    os.remove(job[3])
+        self.data.flush()
+        return failed_items
+
+    def store_worker_analyses(self, worker_path, name):
+        """
+        Copy analyses generated by a worker process into the database's
+        analysis file, replacing any previous analyses of the file.
+        """
+        group_name = ''.join(("analysis/", name))
+        group = self.data.require_group(group_name)
+        with h5py.File(worker_path, 'r') as worker_data:
+            worker_group = worker_data[group_name]
+            for key in worker_group:
+                if key in group:
+                    del group[key]
+                self.data.copy(worker_group[key], group)
+            for key, value in worker_group.attrs.iteritems():
+                if key != "version":
+                    group.attrs[key] = value
+        for g in (group, self.data):
+            g.attrs["version"] = g.attrs.get("version", 0) + 1
+
     def add_file(self, file_object):
         '''Add an AnalysedAudioFile object to the database'''
         if type(file_object) is AnalysedAudioFile:
@@ -294,15 +418,153 @@ class AudioDatabase:
                         os.path.join(subdir_paths["audio"], os.path.basename(item))
                     )
 
+    def corpus_version(self):
+        """
+        Return a string identifying the current state of the database.
+
+        The version changes whenever files are added to or removed from the
+        database, or when any of it's analyses are regenerated.
+        """
+        hasher = hashlib.sha1()
+        hasher.update(str(self.data.attrs.get("version", 0)))
+        for entry in self.analysed_audio:
+            hasher.update(entry.name)
+            hasher.update(str(entry.frames))
+        return hasher.hexdigest()
+
     def close(self):
         self.data.close()
 
+    def reload(self, read_only=False):
+        """
+        Reopen the analysis file of a database that has been closed, and
+        reload the analyses of it's current entries.
+
+        Entries are reloaded in their current order, so any entries removed
+        from the database since it was loaded (for example by the matcher)
+        aren't added back.
+        """
+        audio_file_list = self.audio_file_list
+        self.audio_file_list = OrderedSet([entry.filepath for entry in self.analysed_audio])
+        try:
+            self.analyse_database(self.subdirs, False, processes=1, read_only=read_only)
+        finally:
+            self.audio_file_list = audio_file_list
+
     def __enter__(self):
         return self
 
     def __exit__(self):
         self.close()
 
+def config_namespace(config):
+    """
+    Create a picklable copy of the configuration dictionaries in a config
+    module, for use in worker processes.
+    """
+    if not config:
+        return None
+    return argparse.Namespace(**{
+        key: value for key, value in vars(config).iteritems()
+        if not key.startswith("__") and isinstance(value, dict)
+    })
+
+
+def analyse_file_worker(job):
+    """
+    Analyse a single audio file in a worker process.
+
+    Analyses are written to a new HDF5 file at the worker path provided.
+    Returns the database item, the worker path and an error message if the
+    file couldn't be analysed.
+    """
+    item, filepath, name, worker_path, analysis_list, db_dir, config = job
+    try:
+        with h5py.File(worker_path, 'w') as worker_data:
+            with AnalysedAudioFile(
+                filepath,
+                'r',
+                data_file=worker_data,
+                analyses=analysis_list,
+                name=name,
+                db_dir=db_dir,
+                reanalyse=True,
+                config=config
+            ) as AAF:
+                AAF.create_analysis()
+    except IOError:
+        return item, worker_path, traceback.format_exc()
+    return item, worker_path, None
+
+
+def database_spec(database):
+    """
+    Create a picklable description of a loaded database that can be used to
+    open it read-only in a worker process.
+
+    The files of the database's current entries are used, in order, so that
+    entry indexes (for example in match data) refer to the same files in the
+    worker.
+    """
+    if not database:
+        return None
+    audio_file_list = [entry.filepath for entry in database.analysed_audio]
+    return database.db_dir, audio_file_list, database.analysis_list
+
+
+def open_database_read_only(spec, config):
+    """Open a database described by database_spec without modifying it."""
+    if not spec:
+        return None
+    db_dir, audio_file_list, analysis_list = spec
+    database = AudioDatabase(db_dir=db_dir, analysis_list=analysis_list, config=config)
+    database.audio_file_list = OrderedSet(audio_file_list)
+    database.load_database(read_only=True)
+    return database
+
+
+def synthesize_job_worker(job):
+    """
+    Synthesize the output for a single target in a worker process.
+
+    The databases are opened read-only, so that multiple workers can read
+    them at once. Returns the job index, the number of grains synthesized and
+    the time taken, or an error message if synthesis failed.
+    """
+    (job_ind, name, grain_size, overlap, database_specs, enforce_intensity,
+     enforce_f0, config) = job
+    databases = []
+    try:
+        databases = [open_database_read_only(spec, config) for spec in database_specs]
+        match_db, output_db, target_db = databases
+        synthesizer = Synthesizer(
+            match_db,
+            output_db,
+            target_db=target_db,
+            config=config,
+            enforce_intensity=enforce_intensity,
+            enforce_f0=enforce_f0
+        )
+        if config.synthesizer.get("sample_pool", True):
+            sample_pool = SamplePool(match_db).load()
+        else:
+            sample_pool = None
+        grain_count, elapsed_time = synthesizer.synthesize_job(job_ind, name, grain_size, overlap, sample_pool)
+    except Exception:
+        return job_ind, None, None, traceback.format_exc()
+    finally:
+        for database in databases:
+            if database and database.data:
+                database.close()
+    return job_ind, grain_count, elapsed_time, None
+
+
+def set_cache_size(config):
+    """Set the size of the shared analysis cache from the configuration."""
+    cache_size = config.analysis.get("cache_size", 256)
+    analysis_cache.resize(int(cache_size * 2**20))
+
+
 class Matcher:
 
     """
@@ -326,6 +588,8 @@ class Matcher:
         # Store a dictionary of analyses to perform matching on.
         self.analysis_dict = self.config.analysis_dict
 
+        set_cache_size(self.config)
+
         self.logger.debug("Initialised Matcher")
 
     def match(
@@ -355,6 +619,7 @@ class Matcher:
 
         # Run matching
         match_function(grain_size, overlap)
+        self.logger.info("Analysis cache usage: {0}".format(analysis_cache))
 
     def count_grains(self, database, grain_length, overlap):
         '''Calculate the number of grains in the database'''
@@ -369,21 +634,41 @@ class Matcher:
         grain_indexes[:, 0] = grain_indexes[:, 1] - grain_indexes[:, 0]
         return grain_indexes
 
-    def kdtree_matcher(self, grain_size, overlap):
-        invalid_inds = []
-        for i, entry in enumerate(self.target_db.analysed_audio):
-            entry.generate_grain_times(grain_size, overlap, save_times=True)
-            if not entry.times.size:
-                invalid_inds.append(i)
-        for i in sorted(invalid_inds, reverse=True):
-            del self.target_db.analysed_audio[i]
-        invalid_inds = []
-        for i, entry in enumerate(self.source_db.analysed_audio):
-            entry.generate_grain_times(grain_size, overlap, save_times=True)
-            if not entry.times.size:
-                invalid_inds.append(i)
-        for i in sorted(invalid_inds, reverse=True):
-            del self.source_db.analysed_audio[i]
+    def prune_empty_entries(self, grain_size, overlap):
+        """
+        Generate grain times for all source and target entries and remove
+        entries that are too short to contain any grains.
+        """
+        for database in (self.target_db, self.source_db):
+            invalid_inds = []
+            for i, entry in enumerate(database.analysed_audio):
+                entry.generate_grain_times(grain_size, overlap, save_times=True)
+                if not entry.times.size:
+                    invalid_inds.append(i)
+            for i in sorted(invalid_inds, reverse=True):
+                del database.analysed_audio[i]
+
+    def kdtree_matcher(self, grain_size, overlap, approximate=False):
+        """
+        Searches for matches to each grain using a search index of all source
+        grains.
+
+        A k-d tree is used for an exact search. If approximate is True, an
+        approximate index is used instead (see ann_matcher).
+
+        Grain features of every target entry that needs matching are stacked
+        into a single matrix and queried at once, using the number of
+        parallel jobs set by the "n_jobs" matcher configuration. Results are
+        then split back into match data for each target entry.
+
+        If constraints are set in the matcher configuration, each target
+        grain is only matched to source grains with analysis values in range
+        (see constrained_query).
+
+        If a projection is set in the matcher configuration, target features
+        are projected in the same way as the indexed source features.
+        """
+        self.prune_empty_entries(grain_size, overlap)
         # Count grains of the source database
         source_sample_indexes = self.count_grains(self.source_db, grain_size, overlap)
         try:
@@ -400,9 +685,19 @@ class Matcher:
             weightings = {x: 1. for x in self.matcher_analyses}
 
 
-        # Create an imputer object for handeling Nan values.
-        imp = Imputer(axis=0, strategy='median')
+        # Features of both the source and target are normalized using
+        # statistics of the source database.
+        statistics = self.feature_store(self.source_db, grain_size, overlap).statistics()
 
+        source_index, projection = self.load_source_index(grain_size, overlap, weightings, statistics, approximate)
+        source_grain_count = int(source_sample_indexes[-1, 1]) if source_sample_indexes.size else 0
+        target_store = self.feature_store(self.target_db, grain_size, overlap)
+        # Target grains sampled to measure the recall of approximate searches.
+        recall_samples = []
+        recall_sample_size = self.config.matcher.get("ann_recall_sample", 200)
+
+        target_entries = []
+        target_features = []
         for tind, target_entry in enumerate(self.target_db.analysed_audio):
             # Check if match data already exists and use it rather than
             # regenerating if it does.
@@ -412,92 +707,519 @@ class Matcher:
                                  "overwrite.".format(self.output_db))
                 continue
 
-            # Create an array of grain times for target sample
-            target_times = target_entry.times
-            x_size = target_times.shape[0]
-            match_indexes = np.empty((x_size, self.match_quantity))
-            match_vals = np.empty((x_size, self.match_quantity))
-            match_vals.fill(np.inf)
+            all_target_analyses = self.grain_features(target_entry, target_store, statistics)
+            if projection is not None:
+                all_target_analyses = projection.transform(all_target_analyses)
+            if approximate and recall_sample_size:
+                recall_samples.append(all_target_analyses[np.random.choice(
+                    all_target_analyses.shape[0],
+                    min(recall_sample_size, all_target_analyses.shape[0]),
+                    replace=False
+                )])
+            target_entries.append(target_entry)
+            target_features.append(all_target_analyses)
+
+        if not target_entries:
+            return
+
+        # Query grains of all target entries at once.
+        target_bounds = np.cumsum([features.shape[0] for features in target_features])[:-1]
+        target_features = np.vstack(target_features)
+
+        # Silent target grains aren't searched for. They are given match
+        # indexes of -1, and are synthesized as silence.
+        target_silent = self.silent_grains(self.target_db, grain_size, overlap, target_entries)
+        if target_silent is None:
+            target_silent = np.zeros(target_features.shape[0], dtype=bool)
+        self.report_silence(
+            source_grain_count - len(source_index),
+            source_grain_count,
+            np.sum(target_silent),
+            target_silent.size
+        )
 
-            # Allocate memory for target analyses.
-            all_target_analyses = np.empty((len(self.matcher_analyses), target_times.shape[0]))
+        self.logger.info("{0} matching {1} grains of {2} target entries...".format(
+            "Approximate" if approximate else "K-d Tree",
+            target_features.shape[0],
+            len(target_entries)
+        ))
+        constraints = self.match_constraints()
+        if constraints:
+            constraint_inds = [self.matcher_analyses.index(analysis) for analysis, constraint in constraints]
+            range_index = RangeIndex(
+                self.feature_store(self.source_db, grain_size, overlap).features()[:, constraint_inds],
+                grain_indexes=source_index.grains()
+            )
+            target_values = target_store.features(target_entries)[:, constraint_inds]
+            lows, highs = self.constraint_bounds(constraints, target_values[~target_silent])
+            match_vals, match_indexes = self.constrained_query(
+                source_index,
+                range_index,
+                target_features[~target_silent],
+                lows,
+                highs,
+                self.match_quantity
+            )
+        else:
+            match_vals, match_indexes = source_index.query(
+                target_features[~target_silent],
+                self.match_quantity,
+                n_jobs=self.config.matcher.get("n_jobs", 1)
+            )
+
+        # Target grains without any matches are left as -1.
+        matched = match_indexes[:, 0] >= 0
+        if not np.all(matched):
+            self.logger.info("{0} target grains have no source grains within "
+                             "the matcher constraints.".format(np.sum(~matched)))
+        match_grain_inds = np.full((target_features.shape[0], match_indexes.shape[1], 2), -1, dtype=int)
+        match_grain_inds[np.flatnonzero(~target_silent)[matched]] = self.calculate_db_inds(
+            match_indexes[matched],
+            source_sample_indexes
+        )
 
-            for i, analysis in enumerate(self.matcher_analyses):
-                analysis_formatting = self.analysis_dict[analysis]
+        for target_entry, entry_grain_inds in zip(
+            target_entries,
+            np.split(match_grain_inds, target_bounds)
+        ):
+            datafile_path = ''.join(("match/", target_entry.name))
+            try:
+                self.output_db.data[datafile_path] = entry_grain_inds
+                self.output_db.data[datafile_path].attrs["grain_size"] = grain_size
+                self.output_db.data[datafile_path].attrs["overlap"] = overlap
 
-                target_data, s = target_entry.analysis_data_grains(target_times, analysis, format=analysis_formatting)
-                target_data *= weightings[analysis]
-                all_target_analyses[i] = target_data
+            except RuntimeError as err:
+                raise RuntimeError("Match data couldn't be written to HDF5 "
+                                   "file.\n Match data may already exist in the "
+                                   "file.\n Try running with the '--rematch' flag "
+                                   "to overwrite this data.\n Original error: "
+                                   "{0}".format(err))
 
+        if recall_samples:
+            self.report_recall(source_index, np.vstack(recall_samples), recall_sample_size)
 
-            nan_columns = np.all(np.isnan(all_target_analyses), axis=0)
-            all_target_analyses[:, nan_columns] = 0.
-            # Impute values for Nans
-            all_target_analyses = imp.fit_transform(all_target_analyses)
-            # all_target_analyses[np.isnan(all_target_analyses)] = np.inf
+    def ann_matcher(self, grain_size, overlap):
+        """
+        Searches for matches to each grain using an approximate nearest
+        neighbour index of all source grains.
+
+        Approximate searches are much faster than exact searches for large
+        source databases, but may miss some of the closest grains. The number
+        of lists searched for each grain is set by the "ann_probes" matcher
+        configuration, trading speed for recall. The recall measured against
+        an exact search for a sample of target grains is reported once
+        matching is complete.
+        """
+        self.kdtree_matcher(grain_size, overlap, approximate=True)
 
-            for sind, source_entry in enumerate(self.source_db.analysed_audio):
-                self.logger.info("K-d Tree Matching: {0} to {1}".format(source_entry.name, target_entry.name))
-                # Create an array of grain times for source sample
-                source_times = source_entry.times
-                if not source_times.size:
-                    continue
+    def report_recall(self, source_index, target_features, sample_size):
+        """
+        Measure the recall of an approximate source index against an exact
+        search for a random sample of target grain features, then log it and
+        store it in the attributes of the output database's match group.
+        """
+        if target_features.shape[0] > sample_size:
+            target_features = target_features[np.random.choice(
+                target_features.shape[0],
+                sample_size,
+                replace=False
+            )]
+        recall, approximate_time, exact_time = source_index.measure_recall(
+            target_features,
+            self.match_quantity
+        )
+        speedup = exact_time / max(approximate_time, 1e-9)
+        self.logger.info(
+            "Approximate search recall: {0:.3f} for {1} target grains with {2} "
+            "of {3} lists probed. Search was {4:.1f}x faster than an exact "
+            "search.".format(
+                recall,
+                target_features.shape[0],
+                min(source_index.probes, source_index.lists),
+                source_index.lists,
+                speedup
+            )
+        )
+        self.output_db.data["match"].attrs["recall"] = recall
+        self.output_db.data["match"].attrs["recall_speedup"] = speedup
 
-                all_source_analyses = np.empty((len(self.matcher_analyses), source_times.shape[0]))
+    def match_constraints(self):
+        """
+        Return a list of (analysis, constraint) pairs of the constraints set
+        in the matcher configuration, for analyses that are being matched.
+        """
+        constraints = []
+        for analysis, constraint in sorted(self.config.matcher.get("constraints", {}).iteritems()):
+            if analysis not in self.matcher_analyses:
+                self.logger.warning("Constraint on \"{0}\" ignored as it isn't a "
+                                    "matched analysis.".format(analysis))
+                continue
+            constraints.append((analysis, constraint))
+        return constraints
 
+    @staticmethod
+    def constraint_bounds(constraints, target_values):
+        """
+        Calculate the range of source analysis values allowed for each target
+        grain.
 
-                for i, analysis in enumerate(self.matcher_analyses):
-                    analysis_formatting = self.analysis_dict[analysis]
+        Arguments:
 
-                    source_data, s = source_entry.analysis_data_grains(source_times, analysis, format=analysis_formatting)
-                    source_data *= weightings[analysis]
-                    all_source_analyses[i] = source_data
+        - constraints: a list of (analysis, constraint) pairs, as returned by
+          match_constraints.
 
+        - target_values: a (grains x constraints) array of the target grains'
+          unnormalized values of each constrained analysis, as stored in the
+          feature store. Absolute ranges are in the same units (see the
+          constraints setting of the matcher configuration).
 
-                # Impute values for Nans
-                nan_columns = np.all(np.isnan(all_source_analyses), axis=0)
-                all_source_analyses[:, nan_columns] = 0.
-                all_source_analyses = imp.fit_transform(all_source_analyses)
+        Returns arrays of the low and high values of each constraint for each
+        target grain. Relative constraints of target grains without a value
+        are unconstrained (-inf to inf).
+        """
+        lows = np.full(target_values.shape, -np.inf)
+        highs = np.full(target_values.shape, np.inf)
+        for i, (analysis, constraint) in enumerate(constraints):
+            if "absolute" in constraint:
+                lows[:, i], highs[:, i] = constraint["absolute"]
+            elif "relative" in constraint:
+                values = target_values[:, i]
+                valid = ~np.isnan(values)
+                bounds = np.outer(values[valid], constraint["relative"])
+                lows[valid, i] = np.min(bounds, axis=1)
+                highs[valid, i] = np.max(bounds, axis=1)
+            else:
+                raise ValueError("Constraint on \"{0}\" must have an "
+                                 "\"absolute\" or \"relative\" "
+                                 "range.".format(analysis))
+        return lows, highs
 
-                # all_source_analyses[np.isnan(all_source_analyses)] = np.inf
+    def constrained_query(self, source_index, range_index, x, lows, highs, k):
+        """
+        Find the k closest source grains to each row of x, out of the source
+        grains with analysis values within the bounds given for the row.
 
-                source_tree = spatial.cKDTree(all_source_analyses.T, leafsize=100)
-                results_vals, results_inds = source_tree.query(all_target_analyses.T, k=self.match_quantity, p=2)
+        Candidate grains are found using the range index, then compared to
+        the target grain using the weighted features of the source index.
+        Target grains with the same bounds are searched together.
 
-                if len(results_vals.shape) < 2:
-                    results_vals = np.array([results_vals]).T
-                    results_inds = np.array([results_inds]).T
+        Returns an array of distances and an array of global grain indexes,
+        as with SearchIndex.query. Rows with fewer than k candidates are
+        padded with their closest match, and rows without any candidates
+        have indexes of -1.
+        """
+        tile_size = self.config.matcher.get("tile_size", 2048)
+        k = min(k, len(source_index))
+        distances = np.full((x.shape[0], k), np.inf)
+        indexes = np.full((x.shape[0], k), -1, dtype=int)
+        if not x.shape[0]:
+            return distances, indexes
+
+        # Group target grains with the same bounds.
+        bounds = np.hstack((lows, highs))
+        order = np.lexsort(bounds.T[::-1])
+        changes = np.any(bounds[order][1:] != bounds[order][:-1], axis=1)
+        groups = np.split(order, np.flatnonzero(changes) + 1)
+
+        for group in groups:
+            grains = range_index.candidates(lows[group[0]], highs[group[0]])
+            if grains is None:
+                group_distances, indexes[group] = source_index.query(x[group], k)
+                distances[group] = group_distances ** 2
+                continue
+            for row_start in xrange(0, group.size, tile_size):
+                rows = group[row_start:row_start+tile_size]
+                weighted = x[rows] * source_index.weights
+                for start in xrange(0, grains.size, tile_size):
+                    tile = grains[start:start+tile_size]
+                    tile_distances = squared_distances(weighted, source_index.grain_features(tile))
+                    distances[rows], indexes[rows] = fold_matches(
+                        distances[rows],
+                        indexes[rows],
+                        tile_distances,
+                        np.broadcast_to(tile, tile_distances.shape),
+                        k
+                    )
 
-                vals_append = np.append(match_vals, results_vals, axis=1)
-                vals_sort = np.argsort(vals_append)
-                inds_append = np.append(match_indexes, results_inds+source_sample_indexes[sind][0], axis=1)
+        # Sort matches by distance and pad rows without enough candidates.
+        order = np.argsort(distances, axis=1)
+        row_inds = np.arange(x.shape[0])[:, np.newaxis]
+        distances = distances[row_inds, order]
+        indexes = indexes[row_inds, order]
+        missing = indexes < 0
+        distances = np.where(missing, distances[:, :1], distances)
+        indexes = np.where(missing, indexes[:, :1], indexes)
+        return np.sqrt(distances), indexes
+
+    def silence_thresholds(self):
+        """
+        Return the silence thresholds (in dBFS) of each intensity analysis
+        that has one set in the matcher configuration.
+        """
+        thresholds = {
+            "rms": self.config.matcher.get("silence_rms_threshold", None),
+            "peak": self.config.matcher.get("silence_peak_threshold", None)
+        }
+        return {
+            analysis: threshold
+            for analysis, threshold in thresholds.iteritems()
+            if threshold is not None
+        }
 
-                m = np.arange(len(vals_append))[:, np.newaxis]
-                best_match_inds = inds_append[m, vals_sort]
-                match_indexes = best_match_inds[:, :self.match_quantity]
-                best_match_vals = vals_append[m, vals_sort]
-                match_vals = best_match_vals[:, :self.match_quantity]
+    def silent_grains(self, database, grain_size, overlap, entries=None):
+        """
+        Find the grains of a database with a mean RMS or peak level below the
+        silence thresholds of the matcher configuration.
 
-            match_grain_inds = self.calculate_db_inds(match_indexes, source_sample_indexes)
+        Grain times must already be saved in the entries. If entries aren't
+        provided, all entries in the database are used.
 
-            datafile_path = ''.join(("match/", target_entry.name))
-            try:
-                self.output_db.data[datafile_path] = match_grain_inds
-                self.output_db.data[datafile_path].attrs["grain_size"] = grain_size
-                self.output_db.data[datafile_path].attrs["overlap"] = overlap
+        Each threshold is applied on it's own, so thresholds of analyses the
+        database doesn't have are ignored.
 
-            except RuntimeError as err:
-                raise RuntimeError("Match data couldn't be written to HDF5 "
-                                   "file.\n Match data may already exist in the "
-                                   "file.\n Try running with the '--rematch' flag "
-                                   "to overwrite this data.\n Original error: "
-                                   "{0}".format(err))
+        Returns a boolean array with a value for each grain of the entries,
+        in order, that is True for silent grains. Returns None if no
+        thresholds are set for analyses the database has.
+        """
+        thresholds = self.silence_thresholds()
+        missing = [analysis for analysis in thresholds if analysis not in database.analysis_list]
+        if missing:
+            self.logger.warning("Analyses: {0} not available in {1}. Their silence "
+                                "thresholds won't be used.".format(sorted(missing), database))
+        analyses = sorted(analysis for analysis in thresholds if analysis not in missing)
+        if not analyses:
+            return None
+
+        store = FeatureStore(
+            database,
+            grain_size,
+            overlap,
+            analyses,
+            {analysis: "mean" for analysis in analyses},
+            config=self.config
+        )
+        features = store.features(entries)
+        silent = np.zeros(features.shape[0], dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            levels = 20 * np.log10(features)
+            for i, analysis in enumerate(analyses):
+                # Grains without a value for an analysis aren't silent.
+                silent |= levels[:, i] < thresholds[analysis]
+        return silent
+
+    def report_silence(self, source_pruned, source_count, target_pruned, target_count):
+        """
+        Log the number of silent source and target grains removed from
+        matching, and store them in the attributes of the output database's
+        match group.
+        """
+        if self.silence_thresholds():
+            self.logger.info(
+                "Silence gate removed {0} of {1} source grains and {2} of {3} "
+                "target grains.".format(source_pruned, source_count, target_pruned, target_count)
+            )
+        match_group = self.output_db.data["match"]
+        match_group.attrs["source_grains_pruned"] = source_pruned
+        match_group.attrs["target_grains_pruned"] = target_pruned
+
+    def load_source_index(self, grain_size, overlap, weightings, statistics, approximate=False):
+        """
+        Load or build the search index of the source database's grains.
+
+        Indexes are keyed by the source database's version, the grain size
+        and overlap and the formatting of each analysis. If an index matching
+        the current key has been saved in the source database's data
+        directory it is loaded, otherwise a new index is built and saved for
+        use in later runs. Indexed features are unweighted, and the
+        weightings are applied by the index when it is queried, so changing
+        the weightings doesn't require features to be recalculated.
+
+        If approximate is True, an ApproximateIndex is used in place of a k-d
+        tree. Approximate indexes are partitioned using the weighted
+        features, so an index is built and saved for each weighting.
+
+        Source grains below the silence thresholds of the matcher
+        configuration aren't indexed. The thresholds are part of the index's
+        key.
+
+        If projection components are set in the matcher configuration, a
+        Projection is fitted to the weighted features of the indexed grains
+        and the projected features are indexed. Projections are saved and
+        loaded with the index. As the projection depends on the weightings,
+        they are part of the index's key.
+
+        Returns the index and the projection, or None if features aren't
+        projected.
+        """
+        weights = [weightings[analysis] for analysis in self.matcher_analyses]
+        index_info = {
+            "corpus_version": self.source_db.corpus_version(),
+            "grain_size": grain_size,
+            "overlap": overlap,
+            "analyses": [
+                (analysis, self.analysis_dict[analysis])
+                for analysis in self.matcher_analyses
+            ],
+            "standardize": self.config.matcher.get("standardize_features", True),
+            "silence_thresholds": self.silence_thresholds()
+        }
+        if approximate:
+            index_info["lists"] = self.config.matcher.get("ann_lists", None)
+        projection_components = self.config.matcher.get("projection_components", None)
+        if projection_components:
+            index_info["projection"] = {
+                "components": projection_components,
+                "whiten": self.config.matcher.get("projection_whiten", False),
+                "weights": weights
+            }
+            # Weightings are applied by the projection.
+            index_weights = None
+        else:
+            index_weights = weights
+        index_key = SearchIndex.generate_key(**index_info)
+        index_dir = self.source_db.subdirs["data"]
+        persist_index = self.config.matcher.get("persist_index", True)
+        probes = self.config.matcher.get("ann_probes", 8)
+        tile_size = self.config.matcher.get("tile_size", 2048)
+
+        if persist_index:
+            if approximate:
+                source_index = ApproximateIndex.load(
+                    index_dir,
+                    index_key,
+                    weights=index_weights,
+                    probes=probes,
+                    tile_size=tile_size
+                )
+            else:
+                source_index = SearchIndex.load(index_dir, index_key, weights=index_weights)
+            projection = None
+            if projection_components:
+                projection = Projection.load(index_dir, index_key)
+            if source_index is not None and (projection is not None or not projection_components):
+                if projection is not None:
+                    self.logger.info("Projecting features onto {0} components, keeping "
+                                     "{1:.1%} of their variance.".format(
+                                         projection.components.shape[0],
+                                         projection.explained_variance()
+                                     ))
+                return source_index, projection
+
+        # Stack the grain features of every source entry into a single
+        # corpus-wide matrix so that only one tree needs to be built per run.
+        # Rows are stacked in database order, so the row index of a grain is
+        # it's global grain index as calculated by count_grains.
+        self.logger.info("Building search index for the source database...")
+        source_store = self.feature_store(self.source_db, grain_size, overlap)
+        all_source_analyses = np.vstack([
+            self.grain_features(source_entry, source_store, statistics)
+            for source_entry in self.source_db.analysed_audio
+        ])
+
+        # Leave silent grains out of the index. The global grain index of
+        # each indexed grain is kept so that results can be mapped back to
+        # the source database.
+        source_grain_inds = None
+        source_silent = self.silent_grains(self.source_db, grain_size, overlap)
+        if source_silent is not None:
+            source_grain_inds = np.flatnonzero(~source_silent)
+            if not source_grain_inds.size:
+                raise ValueError("All grains in {0} are below the silence "
+                                 "thresholds. Try lowering the silence "
+                                 "thresholds in the matcher "
+                                 "configuration.".format(self.source_db))
+            all_source_analyses = all_source_analyses[source_grain_inds]
+
+        projection = None
+        if projection_components:
+            projection = Projection.fit(
+                all_source_analyses,
+                weights,
+                projection_components,
+                whiten=index_info["projection"]["whiten"]
+            )
+            index_info["explained_variance"] = projection.explained_variance()
+            self.logger.info("Projecting features onto {0} components, keeping "
+                             "{1:.1%} of their variance.".format(
+                                 projection.components.shape[0],
+                                 index_info["explained_variance"]
+                             ))
+            benchmark_sample = self.config.matcher.get("projection_benchmark_sample", 1000)
+            if benchmark_sample:
+                speedup, agreement = projection.benchmark(
+                    all_source_analyses,
+                    sample_size=benchmark_sample,
+                    k=self.match_quantity
+                )
+                index_info["projection_speedup"] = speedup
+                index_info["projection_agreement"] = agreement
+                self.logger.info("Projected k-d tree queries are {0:.1f}x faster, "
+                                 "finding {1:.1%} of the same matches.".format(speedup, agreement))
+            all_source_analyses = projection.transform(all_source_analyses)
+
+        if approximate:
+            source_index = ApproximateIndex(
+                all_source_analyses,
+                weights=index_weights,
+                lists=index_info["lists"],
+                probes=probes,
+                tile_size=tile_size,
+                grain_indexes=source_grain_inds
+            )
+        else:
+            source_index = SearchIndex(
+                all_source_analyses,
+                weights=index_weights,
+                grain_indexes=source_grain_inds
+            )
+
+        if persist_index:
+            # The projection is saved first, so that an index is never saved
+            # without its projection.
+            if projection is not None:
+                projection.save(index_dir, index_key)
+            source_index.save(index_dir, index_key, info=index_info)
+        return source_index, projection
+
+    def feature_store(self, database, grain_size, overlap):
+        """
+        Get the store of the grain features used by the matcher for a
+        database.
+        """
+        return FeatureStore(
+            database,
+            grain_size,
+            overlap,
+            self.matcher_analyses,
+            self.analysis_dict,
+            config=self.config
+        )
 
+    def grain_features(self, entry, store, statistics):
+        """
+        Generate a matrix of unweighted grain features for an entry.
 
+        Features are read from the feature store for the grain times saved in
+        the entry. The returned array has a row for each grain and a column
+        for each of the matcher's analyses. Nan values are replaced with the
+        medians of the statistics provided, and features are standardized
+        using the statistics if enabled in the matcher configuration.
+        """
+        return FeatureStore.normalize(
+            store.entry_features(entry),
+            statistics,
+            standardize=self.config.matcher.get("standardize_features", True)
+        )
 
     def brute_force_matcher(self, grain_size, overlap):
-        '''Searches for matches to each grain by brute force comparison'''
-
+        '''
+        Searches for matches to each grain by brute force comparison.
+
+        Distances between target and source grains are calculated in tiles,
+        and each tile is folded into the best matches found so far, so memory
+        use is bounded by the tile size set in the matcher configuration.
+        '''
+        self.prune_empty_entries(grain_size, overlap)
         # Count grains of the source database
         source_sample_indexes = self.count_grains(self.source_db, grain_size, overlap)
         try:
@@ -512,6 +1234,18 @@ class Matcher:
             weightings = self.config.matcher_weightings
         else:
             weightings = {x: 1. for x in self.matcher_analyses}
+        tile_size = self.config.matcher.get("tile_size", 2048)
+
+        # Get data for all source grains for each analysis. The grain count
+        # of each source entry is kept as distances involving Nan values
+        # depend on the other values of the entry.
+        grain_counts = (source_sample_indexes[:, 1] - source_sample_indexes[:, 0]).astype(int)
+        source_features = self.feature_store(self.source_db, grain_size, overlap).features()
+        source_data = {
+            analysis: source_features[:, i]
+            for i, analysis in enumerate(self.matcher_analyses)
+        }
+        target_store = self.feature_store(self.target_db, grain_size, overlap)
 
         for tind, target_entry in enumerate(self.target_db.analysed_audio):
             # Check if match data already exists and use it rather than
@@ -521,145 +1255,22 @@ class Matcher:
                                  "data. Run with the \'--rematch\' flag to "
                                  "overwrite.".format(self.output_db))
                 continue
-            # Create an array of grain times for target sample
-            target_times = target_entry.generate_grain_times(grain_size, overlap, save_times=True)
 
-            # Allocate memory for storing accumulated distances between
-            # source and target grains
-            x_size = target_times.shape[0]
-            y_size = int(source_sample_indexes[-1][-1])
-            chunk_size = 8192
-
-
-
-            try:
-                del self.output_db.data["data_distance"]
-            except KeyError:
-                pass
-
-            self.output_db.data.create_dataset("data_distance", (x_size, y_size), dtype=np.float, chunks=True)
-
-            try:
-                del self.output_db.data["distance_accum"]
-            except KeyError:
-                pass
-
-            self.output_db.data.create_dataset("distance_accum", (x_size, y_size), dtype=np.float, chunks=True, fillvalue=0)
-
-            for analysis in self.matcher_analyses:
-                self.logger.info("Current analysis: {0}".format(analysis))
-                analysis_formatting = self.analysis_dict[analysis]
-
-                # Get data for all target grains for each analysis
-                target_data, s = target_entry.analysis_data_grains(target_times, analysis, format=analysis_formatting)
-
-                data_max = 0.
-                for sind, source_entry in enumerate(self.source_db.analysed_audio):
-
-                    # Get the start and end array indexes allocated for the
-                    # current entry's grains.
-                    start_index, end_index = source_sample_indexes[sind]
-
-                    # Create an array of grain times for source sample
-                    source_times = source_entry.generate_grain_times(grain_size, overlap, save_times=True)
-                    self.logger.info("Matching \"{0}\" for: {1} to {2}".format(analysis, source_entry.name, target_entry.name))
-
-                    # Get data for all source grains for each analysis
-                    source_data, s = source_entry.analysis_data_grains(source_times, analysis, format=analysis_formatting)
-                    source_entry.close()
-
-                    # Calculate the euclidean distance between the source and
-                    # source values of each grain and add to array
-                    a = self.distance_calc(target_data, source_data)
-
-                    self.output_db.data["data_distance"][:, int(start_index):int(end_index)] = a
-                    self.output_db.data.flush()
-                    a_max = np.max(a)
-                    if a_max > data_max:
-                        data_max = a_max
-
-                # Normalize and weight the distances. A higher weighting gives
-                # an analysis presedence over others.
-                i = 0
-                membuff = np.zeros((chunk_size, chunk_size))
-                membuff2 = np.zeros((chunk_size, chunk_size))
-                while i < x_size:
-                    j = chunk_size
-                    if i+j > x_size:
-                        j = x_size - i
-
-                    k = 0
-                    while k < y_size:
-                        l = chunk_size
-                        if k+l > y_size:
-                            l = y_size - k
-                        self.logger.info("Calculating weighted "
-                                         "distances:\nSource chunk {0} - {1} of "
-                                         "{2}\nTarget chunk {3} - {4} of "
-                                         "{5}".format(
-                                             i, i+j, x_size, k, k+l, y_size
-                                         ))
-
-                        self.output_db.data["data_distance"].read_direct(membuff, np.s_[i:i+j, k:k+l], np.s_[0:j, 0:l])
-                        self.output_db.data["distance_accum"].read_direct(membuff2, np.s_[i:i+j, k:k+l], np.s_[0:j, 0:l])
-
-                        weighted_mem = membuff[0:j, 0:l] * (1/data_max) * weightings[analysis]
-                        self.output_db.data["data_distance"][i:i+j, k:k+l] = weighted_mem
-                        self.output_db.data["distance_accum"][i:i+j, k:k+l] = membuff2[0:j, 0:l] + weighted_mem
-
-                        k += chunk_size
-
-                    i += chunk_size
-
-            self.logger.info("Calculating the closest {0} overall matches...". format(self.match_quantity))
-            i = 0
-            # Allocate memory for storing chunks.
-            chunk_vals = np.zeros((chunk_size, chunk_size))
-            chunk_inds = np.tile(np.arange(chunk_size), (chunk_size, 1))
-            # Allocate memory for storing the best matches for each target
-            # grain
-            match_indexes = np.empty((x_size, self.match_quantity))
-            match_indexes.fill(np.nan)
-            # Allocate memory for storing the match distance of these grains.
-            match_vals = np.empty((x_size, self.match_quantity))
-            match_vals.fill(np.inf)
-
-
-            while i < x_size:
-                j = chunk_size
-                if i+j > x_size:
-                    j = x_size - i
-
-                k = 0
-                while k < y_size:
-                    l = chunk_size
-                    if k+l > y_size:
-                        l = y_size - k
-                    self.logger.info("Calculating best overall "
-                                        "matches:\nSource chunk {0} - {1} of "
-                                        "{2}\nTarget chunk {3} - {4} of "
-                                        "{5}".format(
-                                            i, i+j, x_size, k, k+l, y_size
-                                        ))
-
-                    # Read the current chunk to memory
-                    self.output_db.data["distance_accum"].read_direct(chunk_vals, np.s_[i:i+j, k:k+l], np.s_[0:j, 0:l])
-
-                    # Append the chunk distances to the best matches so far.
-                    vals_append = np.append(match_vals[i:i+j], chunk_vals[i:i+j], axis=1)
-                    c_inds = chunk_inds[0:j] + i
-
-                    m = np.arange(len(vals_append))[:, np.newaxis]
-                    # Sort all values to intergrate new chunk distances with
-                    # previous best matches.
-                    vals_sort = np.argsort(vals_append, axis=1)
-                    inds_append = np.append(match_indexes[i:i+j], c_inds, axis=1)
-                    best_match_inds = inds_append[m, vals_sort]
-                    match_indexes[i:i+j] = best_match_inds[:, :self.match_quantity]
-                    best_match_vals = vals_append[m, vals_sort]
-                    match_vals[i:i+j] = best_match_vals[:, :self.match_quantity]
-                    k += chunk_size
-                i += chunk_size
+            self.logger.info("Brute force matching: {0}".format(target_entry.name))
+            # Get data for all target grains for each analysis
+            target_features = target_store.entry_features(target_entry)
+            target_data = {
+                analysis: target_features[:, i]
+                for i, analysis in enumerate(self.matcher_analyses)
+            }
+
+            match_indexes = self.brute_force_search(
+                target_data,
+                source_data,
+                grain_counts,
+                weightings,
+                tile_size
+            )
 
             match_grain_inds = self.calculate_db_inds(match_indexes, source_sample_indexes)
 
@@ -679,6 +1290,141 @@ class Matcher:
                                    "to overwrite this data.\n Original error: "
                                    "{0}".format(err))
 
+    def brute_force_search(self, target_data, source_data, grain_counts, weightings, tile_size=2048):
+        """
+        Find the closest source grains to each target grain by comparing
+        every pair of grains.
+
+        The distance between two grains is the sum of the squared distances
+        of each analysis (as calculated by distance_calc), normalized by the
+        largest distance of the analysis and weighted.
+
+        Arguments:
+
+        - target_data: a dictionary of formatted analysis data for each
+          target grain.
+
+        - source_data: a dictionary of formatted analysis data for each
+          source grain.
+
+        - grain_counts: the number of grains of each source entry. Source
+          grains are ordered by entry.
+
+        - weightings: a dictionary of weightings for each analysis.
+
+        - tile_size: the number of target and source grains compared at
+          once.
+
+        Returns a (target grains x matches) array of source grain indexes,
+        ordered from the closest match.
+        """
+        target_count = target_data[self.matcher_analyses[0]].size
+        grain_counts = np.asarray(grain_counts, dtype=int)
+        source_count = int(np.sum(grain_counts))
+        match_quantity = min(self.match_quantity, source_count)
+        entry_ends = np.cumsum(grain_counts)
+        entry_starts = entry_ends - grain_counts
+
+        # Calculate the distance that Nan values are given for each source
+        # entry, and the largest distance used to normalize each analysis.
+        nan_distances = {}
+        scales = {}
+        for analysis in self.matcher_analyses:
+            entry_nan_distances = np.empty(grain_counts.size)
+            data_max = 0.
+            for entry_ind in xrange(grain_counts.size):
+                entry_nan_distances[entry_ind], entry_max = self.distance_limits(
+                    target_data[analysis],
+                    source_data[analysis][entry_starts[entry_ind]:entry_ends[entry_ind]]
+                )
+                data_max = max(data_max, entry_max)
+            nan_distances[analysis] = np.repeat(entry_nan_distances, grain_counts)
+            if not data_max:
+                data_max = 1.
+            scales[analysis] = weightings[analysis] / data_max
+
+        match_indexes = np.empty((target_count, match_quantity), dtype=int)
+        for target_start in xrange(0, target_count, tile_size):
+            target_end = min(target_start + tile_size, target_count)
+            rows = np.arange(target_end - target_start)[:, np.newaxis]
+            best_vals = np.empty((rows.size, 0))
+            best_inds = np.empty((rows.size, 0), dtype=int)
+            for source_start in xrange(0, source_count, tile_size):
+                source_end = min(source_start + tile_size, source_count)
+                self.logger.debug("Calculating distances:\n"
+                                  "Target grains {0} - {1} of {2}\n"
+                                  "Source grains {3} - {4} of {5}".format(
+                                      target_start, target_end, target_count,
+                                      source_start, source_end, source_count
+                                  ))
+                distances = np.zeros((rows.size, source_end - source_start))
+                for analysis in self.matcher_analyses:
+                    target_values = target_data[analysis][target_start:target_end]
+                    source_values = source_data[analysis][source_start:source_end]
+                    analysis_distances = np.abs(np.vstack(target_values)-source_values)**2
+                    # Grains where both the source and target values are Nan
+                    # match.
+                    nan_intersects = np.vstack(~np.isfinite(target_values)) & ~np.isfinite(source_values)
+                    analysis_distances[nan_intersects] = 0.
+                    nan_inds = np.isnan(analysis_distances)
+                    analysis_distances[nan_inds] = np.broadcast_to(
+                        nan_distances[analysis][source_start:source_end],
+                        analysis_distances.shape
+                    )[nan_inds]
+                    analysis_distances *= scales[analysis]
+                    distances += analysis_distances
+
+                # Fold the tile into the best matches found so far.
+                vals = np.hstack((best_vals, distances))
+                if vals.shape[1] > match_quantity:
+                    best = np.argpartition(vals, match_quantity-1, axis=1)[:, :match_quantity]
+                else:
+                    best = np.tile(np.arange(vals.shape[1]), (rows.size, 1))
+                previous_count = best_inds.shape[1]
+                tile_inds = best + source_start - previous_count
+                if previous_count:
+                    previous_inds = best_inds[rows, np.minimum(best, previous_count-1)]
+                    tile_inds = np.where(best < previous_count, previous_inds, tile_inds)
+                best_vals = vals[rows, best]
+                best_inds = tile_inds
+
+            # Order matches from the closest match.
+            order = np.argsort(best_vals, axis=1)
+            match_indexes[target_start:target_end] = best_inds[rows, order]
+
+        return match_indexes
+
+    @staticmethod
+    def distance_limits(data1, data2):
+        """
+        Calculate the distance given to Nan values and the largest distance
+        that distance_calc would produce for two arrays of data, without
+        calculating every distance.
+
+        Returns the Nan distance and the largest distance.
+        """
+        data1_finite = data1[np.isfinite(data1)]
+        data2_finite = data2[np.isfinite(data2)]
+        data1_nans = data1_finite.size < data1.size
+        data2_nans = data2_finite.size < data2.size
+
+        if data1_finite.size and data2_finite.size:
+            # The largest distance is between the extremes of the two arrays.
+            largest_distance = max(
+                (np.max(data1_finite)-np.min(data2_finite))**2,
+                (np.max(data2_finite)-np.min(data1_finite))**2
+            )
+            max_distance = largest_distance
+        else:
+            largest_distance = 1.
+            max_distance = 0.
+        nan_distance = largest_distance + (largest_distance*0.1)
+
+        # Nan values matched to any other value are given the Nan distance.
+        if (data1_nans and data2_finite.size) or (data2_nans and data1_finite.size):
+            max_distance = nan_distance
+
+        return nan_distance, max_distance
 
     def distance_calc(self, data1, data2):
         """
@@ -724,31 +1470,22 @@ class Matcher:
         grain, a dimension for each match of said grain and a dimension
         containing database sample index and the sample's grain index.
         """
-
-        # source_sample_indexes = source_sample_indexes[source_sample_indexes[:, 1] != 0.]
-
-        mi_shape = match_indexes.shape
-        x = match_indexes.flatten()
-        # Find indexes within the range of each source sample index.
-        x = np.logical_and(
-            np.vstack(x)>=source_sample_indexes[:,0],
-            np.vstack(x)<=source_sample_indexes[:,1]
-        )
-
-        if not np.all(np.any(x, axis=1)):
+        match_indexes = np.asarray(match_indexes)
+        sample_ends = source_sample_indexes[:, 1]
+        # Find the first sample whose range of indexes contains each match
+        # index. Ranges are contiguous, so this is the first sample that ends
+        # at or after the index.
+        sample_inds = np.searchsorted(sample_ends, match_indexes, side='left')
+
+        if np.any(sample_inds >= sample_ends.size) or np.any(match_indexes < 0):
             raise ValueError("Not all match indexes have a corresponding sample index. This shouldn't happen...\n"
                              "Check that all database path arguments are correct then try re-running with the --rematch and --reanalyse flags.\n"
                              "If this does'nt work, delete the audio and data directories in all databases and try again...")
 
-        x = x.reshape(mi_shape[0], mi_shape[1], x.shape[1])
-        x = np.argmax(x, axis=2)
-
-        # Calculate sample index in database
-        match_start_inds = source_sample_indexes[x.flatten(), 0].reshape(mi_shape)
         # Calculate grain index offset from the start of the sample
-        match_grain_inds = match_indexes.reshape(mi_shape) - match_start_inds
+        match_grain_inds = match_indexes - source_sample_indexes[sample_inds, 0]
 
-        return np.dstack((x, match_grain_inds)).astype(int)
+        return np.dstack((sample_inds, match_grain_inds)).astype(int)
 
     def swap_databases(self):
         """Convenience method to swap databases, changing the source database into the target and vice-versa"""
@@ -759,6 +1496,9 @@ class Synthesizer:
 
     """An object used for synthesizing output based on grain matching."""
 
+    # The number of samples normalized and written at once.
+    normalize_block_size = 2**16
+
     def __init__(self, database1, database2, *args, **kwargs):
         """Initialize synthesizer instance"""
         self.logger = logging.getLogger(__name__ + '.Matcher')
@@ -772,8 +1512,12 @@ class Synthesizer:
         self.enforce_intensity_bool = self.config.synthesizer["enforce_intensity"]
         # Key word arguments overwrite config file.
         self.enforce_intensity_bool = kwargs.pop("enforce_intensity", self.enforce_intensity_bool)
-        if self.enforce_intensity_bool and ("rms" not in self.target_db.analysis_list or "rms" not in self.match_db.analysis_list):
-            raise RuntimeError("BLARGHHH")
+        if self.enforce_intensity_bool and not all(
+            analysis in database.analysis_list
+            for analysis in ("rms", "peak")
+            for database in (self.target_db, self.match_db)
+        ):
+            raise RuntimeError("Intensity enforcement cannot be enabled if both databases do not have RMS and peak analyses.")
 
         self.enforce_f0_bool = self.config.synthesizer["enforce_f0"]
         # Key word arguments overwrite config file.
@@ -781,10 +1525,12 @@ class Synthesizer:
         if self.enforce_f0_bool and ("f0" not in self.target_db.analysis_list or "f0" not in self.match_db.analysis_list):
             raise RuntimeError("F0 enforcement cannot be enabled if both databases do not have F0 analyses.")
 
-        if self.enforce_intensity:
+        if self.enforce_intensity_bool or self.enforce_f0_bool:
             if not self.target_db:
                 raise ValueError("Target database must be provided if rms or F0 enforcement is enabled.")
 
+        set_cache_size(self.config)
+
     def synthesize(self, grain_size=None, overlap=None):
         """
         Synthesized output from the match data in the output database to create
@@ -799,193 +1545,427 @@ class Synthesizer:
         if not jobs:
             raise RuntimeError("There is no match data to synthesize. The match program may need to be run first.")
 
-        for job_ind, (name, job) in enumerate(jobs):
-            # Generate output file name/path
-            filename, extension = os.path.splitext(name)
-            output_name = ''.join((filename, '_output', extension))
-            output_path = os.path.join(self.output_db.subdirs["audio"], output_name)
-            # Create audio file to save output to.
-            output_config = self.config.output_file
-            grain_matches = self.output_db.data["match"][name]
-            # Get the grain size and overlap used for analysis.
-            match_grain_size = grain_matches.attrs["grain_size"]
-            match_overlap = grain_matches.attrs["overlap"]
-
-            _grain_size = grain_size
-            with AudioFile(
-                output_path,
-                "w",
-                samplerate=output_config["samplerate"],
-                format=output_config["format"],
-                channels=output_config["channels"]
-            ) as output:
-                hop_size = (grain_size / overlap) * output.samplerate/1000
-                _grain_size *= int(output.samplerate / 1000)
-                output_frames = np.zeros(_grain_size*2 + (int(hop_size*len(grain_matches))))
-                offset = 0
-                for target_grain_ind, matches in enumerate(grain_matches):
-                    # If there are multiple matches, choose a match at random
-                    # from available matches.
-                    match_index = np.random.randint(matches.shape[0])
-                    match_db_ind, match_grain_ind = matches[match_index]
-                    with self.match_db.analysed_audio[match_db_ind] as match_sample:
-                        self.logger.info("Synthesizing grain:\n"
-                            "Source sample: {0}\n"
-                            "Source grain index: {1}\n"
-                            "Target output: {2}\n"
-                            "Target grain index: {3} out of {4}".format(
-                                match_sample,
-                                match_grain_ind,
-                                output_name,
-                                target_grain_ind,
-                                len(grain_matches)
-                            ))
-                        match_sample.generate_grain_times(match_grain_size, match_overlap, save_times=True)
-
-                        # TODO: Make proper fix for grain index offset of 1
-                        try:
-                            match_grain = match_sample[match_grain_ind-1]
-                        except:
-                            pdb.set_trace()
-
-
-                        if self.enforce_intensity_bool:
-                            # Get the target sample from the database
-                            target_sample = self.target_db[job_ind]
-
-                            # Calculate garin times for sample to allow for
-                            # indexing.
-                            target_sample.generate_grain_times(match_grain_size, match_overlap, save_times=True)
-
-                            match_grain = self.enforce_intensity(match_grain, match_sample, match_grain_ind, target_sample, target_grain_ind)
-
-                        if self.enforce_f0_bool:
-                            # Get the target sample from the database
-                            target_sample = self.target_db[job_ind]
-
-                            # Calculate grain times for sample to allow for
-                            # indexing.
-                            target_sample.generate_grain_times(match_grain_size, match_overlap, save_times=True)
-
-                            match_grain = self.enforce_pitch(match_grain, match_sample, match_grain_ind, target_sample, target_grain_ind)
-
-                        # Apply hanning window to grain
-                        match_grain *= np.hanning(match_grain.size)
-                        try:
-                            output_frames[offset:offset+match_grain.size] += match_grain
-                        except:
-                            pass
-                    offset += hop_size
-                # If output normalization is active, normalize output.
-                if self.config.synthesizer["normalize"]:
-                    output_frames = (output_frames / np.max(np.abs(output_frames))) * 0.9
-                output.write_frames(output_frames)
-
-    def enforce_pitch(self, grain, source_sample, source_grain_ind, target_sample, target_grain_ind):
-        """
-        Shifts the pitch of the grain by the difference between it's f0 and the f0 of the grain specified.
-
-        This method will fail if either AnalysedAudioFile object does not have an f0 analysis.
-        """
-
-        # Get grain start and finish range to retreive analysis frames from.
-        # TODO: Make proper fix for grain index offset of 1
-        target_times = target_sample.times[target_grain_ind-1]
+        # Memory map the decoded samples of the source database so that
+        # grains can be read without decoding the source files. This also
+        # makes sure the pool is built before any worker processes read it.
+        if self.config.synthesizer.get("sample_pool", True):
+            sample_pool = SamplePool(self.match_db).load()
+        else:
+            sample_pool = None
 
-        # Get mean harmonic ratio of f0 frames in time range specified.
-        target_harmonic_ratio = target_sample.analysis_data_grains(target_times, "harm_ratio", format="mean")[0][0]
+        # Intensities of every grain of the source files, stored by file
+        # index and grain settings so they are only calculated once.
+        intensity_tables = {}
 
+        processes = self.config.synthesizer.get("processes", 1)
+        if processes > 1 and len(jobs) > 1:
+            self.synthesize_parallel(jobs, grain_size, overlap, processes)
+        else:
+            for job_ind, (name, job) in enumerate(jobs):
+                self.synthesize_job(job_ind, name, grain_size, overlap, sample_pool, intensity_tables)
+        self.logger.info("Analysis cache usage: {0}".format(analysis_cache))
 
-        # Get mean of f0 frames in time range specified.
-        target_f0 = target_sample.analysis_data_grains(target_times, "f0", format="median")[0][0]
+    def synthesize_job(self, job_ind, name, grain_size, overlap, sample_pool=None, intensity_tables=None):
+        """
+        Synthesize output for a single target from it's match data.
 
-        # Get grain start and finish range to retreive analysis frames from.
-        # TODO: Make proper fix for grain index offset of 1
-        source_times = source_sample.times[source_grain_ind-1]
+        Arguments:
 
-        # Get mean harmonic ratio of f0 frames in time range specified.
-        source_harmonic_ratio = source_sample.analysis_data_grains(source_times, "harm_ratio", format="mean")[0][0]
-        hr_array = np.array([source_harmonic_ratio, target_harmonic_ratio])
+        - job_ind: the index of the target in the target database.
 
-        if np.any(np.isnan(hr_array)):
-            return grain*0
+        - name: the name of the target's match data in the output database.
 
-        # Get mean of f0 frames in time range specified.
-        source_f0 = source_sample.analysis_data_grains(source_times, "f0", format="median")[0][0]
+        - grain_size: the grain size (in ms) of the output.
 
-        ratio_difference = target_f0 / source_f0
+        - overlap: the overlap factor of output grains.
 
-        if not np.isfinite(ratio_difference):
-            return grain*0
+        - sample_pool: a loaded SamplePool of the source database to read
+          grains from.
 
-        # If the ratio difference is within the limits
-        ratio_limit = self.config.synthesizer["enf_f0_ratio_limit"]
+        - intensity_tables: a dictionary of source grain intensities that
+          have already been calculated.
 
-        if ratio_difference > ratio_limit:
-            self.logger.warning("Grain f0 ratio too large({0}), enforcing f0 at limit ({1})".format(
-                                    ratio_difference,
-                                    ratio_limit,
-                                ))
-            ratio_difference = ratio_limit
-        elif ratio_difference < 1./ratio_limit:
-            self.logger.warning("Grain f0 ratio too large ({0}), enforcing f0 at limit ({1})".format(
-                                    ratio_difference,
-                                    1./ratio_limit,
-                                ))
-            ratio_difference = 1./ratio_limit
+        Returns the number of grains synthesized and the time taken.
+        """
+        if intensity_tables is None:
+            intensity_tables = {}
+
+        # Generate output file name/path
+        filename, extension = os.path.splitext(name)
+        output_name = ''.join((filename, '_output', extension))
+        output_path = os.path.join(self.output_db.subdirs["audio"], output_name)
+        # Create audio file to save output to.
+        output_config = self.config.output_file
+        grain_matches = self.output_db.data["match"][name]
+        # Get the grain size and overlap used for analysis.
+        match_grain_size = grain_matches.attrs["grain_size"]
+        match_overlap = grain_matches.attrs["overlap"]
+
+        _grain_size = grain_size
+        with AudioFile(
+            output_path,
+            "w",
+            samplerate=output_config["samplerate"],
+            format=output_config["format"],
+            channels=output_config["channels"]
+        ) as output:
+            hop_size = (grain_size / overlap) * output.samplerate/1000
+            _grain_size *= int(output.samplerate / 1000)
+            output_size = _grain_size*2 + (int(hop_size*len(grain_matches)))
+
+            # Finished output is written as synthesis progresses. If the
+            # output is normalized it is first rendered to a temporary
+            # file, so that it can be scaled by the peak of the whole
+            # output.
+            normalize = self.config.synthesizer["normalize"]
+            if normalize:
+                render_path = os.path.join(self.output_db.subdirs["data"], ''.join((filename, "_render.npy")))
+                render = np.lib.format.open_memmap(
+                    render_path,
+                    mode="w+",
+                    dtype=np.float64,
+                    shape=(output_size,)
+                )
+
+                def write_block(block_start, samples):
+                    render[block_start:block_start+samples.size] = samples
+            else:
+                def write_block(block_start, samples):
+                    output.write_frames(samples)
+            writer = OverlapAddWriter(write_block, output_size)
+
+            # If there are multiple matches, choose a match at random
+            # from available matches.
+            all_matches = grain_matches[:]
+            grain_count = len(all_matches)
+            match_choices = np.random.randint(all_matches.shape[1], size=grain_count)
+            match_db_inds, match_grain_inds = all_matches[np.arange(grain_count), match_choices].T
+            # Target grains that were silent when matched have no match, and
+            # are left as silence.
+            matched = np.flatnonzero(match_db_inds >= 0)
+
+            # Calculate the sample range of every matched grain so they
+            # can be read from the source files in one pass.
+            grain_starts = np.zeros(grain_count)
+            grain_sizes = np.zeros(grain_count)
+            for match_db_ind in np.unique(match_db_inds[matched]):
+                match_sample = self.match_db.analysed_audio[match_db_ind]
+                match_sample.generate_grain_times(match_grain_size, match_overlap, save_times=True)
+                file_inds = match_db_inds == match_db_ind
+                # TODO: Make proper fix for grain index offset of 1
+                grain_times = match_sample.times[match_grain_inds[file_inds]-1] * (match_sample.samplerate / 1000)
+                grain_starts[file_inds] = grain_times[:, 0]
+                grain_sizes[file_inds] = grain_times[:, 1] - grain_times[:, 0]
+
+            if self.enforce_intensity_bool or self.enforce_f0_bool:
+                # Get the target sample from the database
+                target_sample = self.target_db[job_ind]
+
+                # Calculate grain times for sample to allow for
+                # indexing.
+                target_sample.generate_grain_times(match_grain_size, match_overlap, save_times=True)
+
+            if self.enforce_intensity_bool:
+                intensity_ratios = self.intensity_ratios(
+                    intensity_tables,
+                    match_db_inds,
+                    match_grain_inds,
+                    target_sample,
+                    (match_grain_size, match_overlap)
+                )
+
+            # Calculate the position of every grain in the output.
+            output_starts = (np.arange(grain_count) * hop_size).astype(int)
+            batch_size = self.config.synthesizer.get("batch_size", 1024)
+            start_time = time.time()
+            with GrainReader(
+                self.match_db,
+                max_open=self.config.synthesizer.get("max_open_files", 32),
+                sample_pool=sample_pool
+            ) as grain_reader:
+                for batch_start in xrange(0, matched.size, batch_size):
+                    batch_end = min(batch_start + batch_size, matched.size)
+                    target_grain_inds = matched[batch_start:batch_end]
+                    self.logger.info("Synthesizing grains {0} - {1} out "
+                                     "of {2} for {3}".format(
+                                         target_grain_inds[0],
+                                         target_grain_inds[-1] + 1,
+                                         grain_count,
+                                         output_name
+                                     ))
+                    batch_db_inds = match_db_inds[target_grain_inds]
+                    batch_grain_inds = match_grain_inds[target_grain_inds]
+
+                    grains, grain_lengths = self.grain_block(grain_reader.read_grains(
+                        batch_db_inds,
+                        grain_starts[target_grain_inds],
+                        grain_sizes[target_grain_inds]
+                    ))
+
+                    if self.enforce_intensity_bool:
+                        grains *= intensity_ratios[target_grain_inds, np.newaxis]
+
+                    if self.enforce_f0_bool:
+                        grains = self.enforce_pitch(grains, grain_lengths, batch_db_inds, batch_grain_inds, target_sample, target_grain_inds)
+
+                    # Apply hanning window to grains
+                    grains *= self.grain_windows(grain_lengths, grains.shape[1])
+                    writer.add(grains, output_starts[target_grain_inds], grain_lengths)
+
+                    # Write output that no further grains overlap.
+                    if batch_end < matched.size:
+                        writer.flush(output_starts[matched[batch_end]])
+            writer.close()
+            elapsed_time = time.time() - start_time
+            self.logger.info("Synthesized {0} grains in {1:.2f} seconds "
+                             "({2:.0f} grains/second)".format(
+                                 grain_count,
+                                 elapsed_time,
+                                 grain_count / max(elapsed_time, 1e-6)
+                             ))
+            # If output normalization is active, normalize output.
+            if normalize:
+                self.logger.info("Normalizing output: {0}".format(output_name))
+                for block_start in xrange(0, output_size, self.normalize_block_size):
+                    block = render[block_start:block_start+self.normalize_block_size]
+                    if writer.peak:
+                        block = (block / writer.peak) * 0.9
+                    output.write_frames(block)
+                # Release the memory map before removing the file.
+                render = None
+                os.remove(render_path)
+        return grain_count, elapsed_time
+
+    def synthesize_parallel(self, jobs, grain_size, overlap, processes):
+        """
+        Synthesize output for each target using a pool of worker processes.
+
+        Each worker opens the databases read-only and writes the output of
+        one target at a time. Progress is reported in the order of the jobs.
+        """
+        databases = []
+        for database in (self.match_db, self.output_db, self.target_db):
+            if database and database.data and database not in databases:
+                databases.append(database)
+        database_specs = [
+            database_spec(database)
+            for database in (self.match_db, self.output_db, self.target_db)
+        ]
+        # Workers can't open the HDF5 files while this process has them open
+        # for writing, so they are closed until the workers have finished,
+        # then reloaded.
+        read_only = [database.data.mode == 'r' for database in databases]
+        for database in databases:
+            database.close()
+        worker_jobs = [
+            (
+                job_ind,
+                name,
+                grain_size,
+                overlap,
+                database_specs,
+                self.enforce_intensity_bool,
+                self.enforce_f0_bool,
+                config_namespace(self.config)
+            )
+            for job_ind, (name, job) in enumerate(jobs)
+        ]
+
+        self.logger.info("Synthesizing {0} outputs using {1} processes...".format(len(jobs), processes))
+        pool = mp.Pool(processes)
+        try:
+            for job_ind, grain_count, elapsed_time, err in pool.imap(synthesize_job_worker, worker_jobs):
+                name = jobs[job_ind][0]
+                if err:
+                    raise RuntimeError("Synthesis of {0} failed.\nOriginal "
+                                       "error: {1}".format(name, err))
+                self.logger.info("Synthesized output {0} of {1}: {2} ({3} "
+                                 "grains in {4:.2f} seconds)".format(
+                                     job_ind + 1,
+                                     len(jobs),
+                                     name,
+                                     grain_count,
+                                     elapsed_time
+                                 ))
+        finally:
+            pool.terminate()
+            pool.join()
+            for database, database_read_only in zip(databases, read_only):
+                database.reload(read_only=database_read_only)
+
+    @staticmethod
+    def grain_block(grains):
+        """
+        Stack grains into a (grains x samples) array, padding shorter grains
+        with zeros.
 
-        grain = pitch_shift.shift(grain, ratio_difference)
-        if ratio_difference > ratio_limit or ratio_difference < 1./ratio_limit:
-            grain *= 0
+        Returns the array and the length of each grain.
+        """
+        grain_lengths = np.array([grain.size for grain in grains], dtype=int)
+        block = np.zeros((grain_lengths.size, np.max(grain_lengths) if grain_lengths.size else 0))
+        for i, grain in enumerate(grains):
+            block[i, :grain.size] = grain
+        return block, grain_lengths
+
+    @staticmethod
+    def grain_windows(grain_lengths, block_size):
+        """
+        Create a hanning window for each grain, padded with zeros to the block
+        size.
+        """
+        windows = np.zeros((grain_lengths.size, block_size))
+        for grain_length in np.unique(grain_lengths):
+            windows[grain_lengths == grain_length, :grain_length] = np.hanning(grain_length)
+        return windows
 
-        return grain
+    def grain_analysis(self, sample, grain_inds, analysis, format):
+        """
+        Get formatted analysis data for multiple grains of a sample.
+        """
+        # TODO: Make proper fix for grain index offset of 1
+        return sample.analysis_data_grains(sample.times[grain_inds-1], analysis, format=format)[0]
 
-    def enforce_intensity(self, grain, source_sample, source_grain_ind, target_sample, target_grain_ind):
+    def source_grain_analysis(self, match_db_inds, match_grain_inds, analysis, format):
         """
-        Scales the amplitude of the grain by the difference between it's intensity and the intensity of the grain specified.
+        Get formatted analysis data for grains from multiple samples of the
+        match database.
+        """
+        values = np.empty(match_db_inds.size)
+        for match_db_ind in np.unique(match_db_inds):
+            file_inds = match_db_inds == match_db_ind
+            values[file_inds] = self.grain_analysis(
+                self.match_db.analysed_audio[match_db_ind],
+                match_grain_inds[file_inds],
+                analysis,
+                format
+            )
+        return values
+
+    def enforce_pitch(self, grains, grain_lengths, match_db_inds, match_grain_inds, target_sample, target_grain_inds):
+        """
+        Shifts the pitch of each grain by the difference between it's f0 and
+        the f0 of the target grain it was matched to.
+
+        Grains without a harmonic ratio or f0 are silenced.
 
-        This method will fail if either AnalysedAudioFile object does not have any intensity analyses.
+        This method will fail if either database does not have an f0
+        analysis.
         """
+        # Get mean harmonic ratio and median f0 of the frames of each grain.
+        target_harmonic_ratios = self.grain_analysis(target_sample, target_grain_inds, "harm_ratio", "mean")
+        target_f0s = self.grain_analysis(target_sample, target_grain_inds, "f0", "median")
+        source_harmonic_ratios = self.source_grain_analysis(match_db_inds, match_grain_inds, "harm_ratio", "mean")
+        source_f0s = self.source_grain_analysis(match_db_inds, match_grain_inds, "f0", "median")
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio_differences = target_f0s / source_f0s
+
+        silent = (
+            np.isnan(source_harmonic_ratios) |
+            np.isnan(target_harmonic_ratios) |
+            ~np.isfinite(ratio_differences)
+        )
 
-        # Get grain start and finish range to retreive analysis frames from.
-        # TODO: Make proper fix for grain index offset of 1
-        target_times = target_sample.times[target_grain_ind-1]
+        # Limit ratio differences to within the ratio limit.
+        ratio_limit = self.config.synthesizer["enf_f0_ratio_limit"]
+        with np.errstate(invalid='ignore'):
+            out_of_range = (ratio_differences > ratio_limit) | (ratio_differences < 1./ratio_limit)
+        if np.any(out_of_range):
+            self.logger.warning("{0} grain f0 ratios too large, enforcing f0 at "
+                                "limit ({1})".format(
+                                    np.sum(out_of_range),
+                                    ratio_limit
+                                ))
+        ratio_differences = np.clip(ratio_differences, 1./ratio_limit, ratio_limit)
+        ratio_differences[silent] = 1.
 
-        # Get mean of RMS frames in time range specified.
-        target_rms = target_sample.analysis_data_grains(target_times, "rms", format="mean")[0][0]
-        target_peak = target_sample.analysis_data_grains(target_times, "peak", format="mean")[0][0]
+        for grain_length in np.unique(grain_lengths):
+            rows = grain_lengths == grain_length
+            grains[rows, :grain_length] = pitch_shift.shift_grains(
+                grains[rows, :grain_length],
+                ratio_differences[rows]
+            )
+        grains[silent] = 0.
 
-        target_intensity_value = np.mean([target_rms, target_peak])
+        return grains
 
-        # Get grain start and finish range to retreive analysis frames from.
-        # TODO: Make proper fix for grain index offset of 1
-        source_times = source_sample.times[source_grain_ind-1]
+    def intensity_table(self, database, sample, grain_settings):
+        """
+        Calculate the intensity of every grain of a sample, using the grain
+        times saved in the sample.
+
+        Intensity is the mean of the RMS and peak of the frames of each grain.
+        Grain RMS and peak values are kept in the database's feature store.
+        """
+        store = FeatureStore(
+            database,
+            grain_settings[0],
+            grain_settings[1],
+            ["rms", "peak"],
+            {"rms": "mean", "peak": "mean"},
+            config=self.config
+        )
+        intensities = np.mean(store.entry_features(sample), axis=1)
+        # Grains without any frames of an analysis have no stored value.
+        # Reading these grains on their own uses the closest frames instead.
+        for grain_ind in np.flatnonzero(np.isnan(intensities)):
+            intensities[grain_ind] = np.mean([
+                sample.analysis_data_grains(sample.times[grain_ind], analysis, format="mean")[0][0]
+                for analysis in ("rms", "peak")
+            ])
+        return intensities
+
+    def intensity_ratios(self, intensity_tables, match_db_inds, match_grain_inds, target_sample, grain_settings):
+        """
+        Calculate the ratio to scale the amplitude of each matched grain by,
+        so that it's intensity matches the intensity of the target grain it
+        was matched to.
 
-        # Get mean of RMS frames in time range specified.
-        source_rms = source_sample.analysis_data_grains(source_times, "rms", format="mean")[0][0]
-        source_peak = source_sample.analysis_data_grains(source_times, "peak", format="mean")[0][0]
+        Arguments:
 
-        source_intensity_value = np.mean([source_rms, source_peak])
+        - intensity_tables: a dictionary of intensity tables of source files
+          that have already been calculated. New tables are added to it.
 
-        ratio_difference = target_intensity_value / source_intensity_value
+        - match_db_inds: the source database index of each matched grain.
 
-        if not np.isfinite(ratio_difference):
-            return grain
-        # If the ratio difference is within the limits
-        ratio_limit = self.config.synthesizer["enf_intensity_ratio_limit"]
+        - match_grain_inds: the grain index of each matched grain.
 
-        if ratio_difference > ratio_limit:
-            self.logger.warning(
-                "Grain RMS ratio too large({0}), enforcing RMS at limit ({1})\n".format(
-                ratio_difference,
-                ratio_limit,
-            ))
-            ratio_difference = ratio_limit
+        - target_sample: the target AnalysedAudioFile, with grain times
+          saved.
 
-        grain *= ratio_difference
+        - grain_settings: the grain size and overlap used for matching.
 
+        This method will fail if either database does not have any intensity
+        analyses.
+        """
+        # TODO: Make proper fix for grain index offset of 1
+        target_intensities = self.intensity_table(self.target_db, target_sample, grain_settings)[np.arange(match_grain_inds.size)-1]
+        # Grains without a match (see Matcher.silent_grains) are left
+        # unchanged.
+        source_intensities = np.full(match_grain_inds.size, np.nan)
+        for match_db_ind in np.unique(match_db_inds[match_db_inds >= 0]):
+            key = (match_db_ind,) + tuple(grain_settings)
+            if key not in intensity_tables:
+                intensity_tables[key] = self.intensity_table(
+                    self.match_db,
+                    self.match_db.analysed_audio[match_db_ind],
+                    grain_settings
+                )
+            file_inds = match_db_inds == match_db_ind
+            source_intensities[file_inds] = intensity_tables[key][match_grain_inds[file_inds]-1]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio_differences = target_intensities / source_intensities
 
-        return grain
+        ratio_limit = self.config.synthesizer["enf_intensity_ratio_limit"]
+        over_limit = np.sum(ratio_differences[np.isfinite(ratio_differences)] > ratio_limit)
+        if over_limit:
+            self.logger.warning("{0} grain RMS ratios too large, enforcing RMS "
+                                "at limit ({1})".format(over_limit, ratio_limit))
+
+        # Grains without a valid ratio are left unchanged, and ratios are
+        # limited to the ratio limit.
+        return np.minimum(np.where(np.isfinite(ratio_differences), ratio_differences, 1.), ratio_limit)
 
     def swap_databases(self):
         """Convenience method to swap databases, changing the source database into the target and vice-versa"""
@@ -0,0 +1,170 @@
+"""
+Module for storing per-grain features of a database's files in it's HDF5
+analysis file.
+"""
+from __future__ import print_function, division
+import json
+import hashlib
+import logging
+import warnings
+import numpy as np
+
+# Config dictionaries that change the output of analyses.
+analysis_configs = ("rms", "f0", "variance", "kurtosis", "skewness", "fft")
+
+
+class FeatureStore(object):
+
+    """
+    A store of the aggregated features of every grain of a database's files.
+
+    Features are calculated from the analysis frames of each grain using
+    AnalysedAudioFile.analysis_data_grains, then stored in the database's
+    HDF5 file under "features/<key>/<file name>", where the key identifies
+    the grain size, overlap, analysis formatting and analysis configuration
+    used. Each file's features are stored with the version of it's analyses,
+    so they are recalculated when the file is re-analysed.
+
+    Stored features are a (grains x analyses) array of unweighted values,
+    with Nan values where an analysis has no value for a grain.
+
+    Statistics of the features over all grains of the database can also be
+    stored, for normalizing features of this and other databases.
+
+    Arguments:
+
+    - database: the AudioDatabase to store features of.
+
+    - grain_size: the grain size (in ms) used to generate grain times.
+
+    - overlap: the overlap factor used to generate grain times.
+
+    - analyses: a list of analyses. Each analysis is a column of the
+      features.
+
+    - formatting: a dictionary of the format used to aggregate each
+      analysis' frames over a grain.
+
+    - config: the config module used for analysis settings.
+    """
+
+    def __init__(self, database, grain_size, overlap, analyses, formatting, config=None):
+        self.logger = logging.getLogger(__name__ + '.FeatureStore')
+        self.database = database
+        self.analyses = list(analyses)
+        self.formatting = [formatting[analysis] for analysis in self.analyses]
+        self.info = {
+            "grain_size": grain_size,
+            "overlap": overlap,
+            "analyses": self.analyses,
+            "formatting": self.formatting,
+            "config_hash": self.config_hash(config)
+        }
+        self.key = hashlib.sha1(json.dumps(self.info, sort_keys=True)).hexdigest()
+        self.group_name = "features/{0}".format(self.key)
+        self.writable = database.data.mode != 'r'
+
+    @staticmethod
+    def config_hash(config):
+        """Generate a hash of the configuration settings used by analyses."""
+        settings = {}
+        if config:
+            for name in analysis_configs:
+                settings[name] = getattr(config, name, None)
+        return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+    def entry_features(self, entry):
+        """
+        Get the features of every grain of an entry.
+
+        Grain times must already be saved in the entry. Features are read
+        from the store if they are valid, otherwise they are calculated and
+        stored.
+        """
+        version = entry.analysis_storage.attrs.get("version", 0)
+        grain_count = entry.times.shape[0]
+        dataset_name = "/".join((self.group_name, entry.name))
+
+        if dataset_name in self.database.data:
+            dataset = self.database.data[dataset_name]
+            if dataset.attrs.get("version") == version and dataset.shape[0] == grain_count:
+                return dataset[:]
+
+        features = np.empty((grain_count, len(self.analyses)))
+        for i, (analysis, formatting) in enumerate(zip(self.analyses, self.formatting)):
+            features[:, i] = entry.analysis_data_grains(entry.times, analysis, format=formatting)[0]
+
+        if self.writable:
+            group = self.database.data.require_group(self.group_name)
+            for key, value in self.info.iteritems():
+                group.attrs[key] = json.dumps(value)
+            if entry.name in group:
+                del group[entry.name]
+            group.create_dataset(entry.name, data=features)
+            group[entry.name].attrs["version"] = version
+        return features
+
+    def features(self, entries=None):
+        """
+        Get the features of all grains of the entries given, stacked in
+        order. If entries aren't provided, all entries in the database are
+        used.
+        """
+        if entries is None:
+            entries = self.database.analysed_audio
+        features = [self.entry_features(entry) for entry in entries]
+        if not features:
+            return np.empty((0, len(self.analyses)))
+        return np.vstack(features)
+
+    def statistics(self):
+        """
+        Calculate the median, mean and standard deviation of each analysis
+        over all grains of the database, ignoring Nan values.
+
+        Statistics are stored with the features, and are only recalculated
+        when the files or analyses of the database change.
+
+        Returns a dictionary of arrays with a value for each analysis.
+        """
+        version = self.database.corpus_version()
+        if self.group_name in self.database.data:
+            group = self.database.data[self.group_name]
+            if group.attrs.get("statistics_version") == version:
+                return {name: group.attrs[name] for name in ("median", "mean", "std")}
+
+        features = self.features()
+        with warnings.catch_warnings():
+            # Analyses without any values have Nan statistics.
+            warnings.simplefilter("ignore", RuntimeWarning)
+            statistics = {
+                "median": np.nanmedian(features, axis=0),
+                "mean": np.nanmean(features, axis=0),
+                "std": np.nanstd(features, axis=0)
+            }
+
+        if self.writable:
+            group = self.database.data.require_group(self.group_name)
+            for name, value in statistics.iteritems():
+                group.attrs[name] = value
+            group.attrs["statistics_version"] = version
+        return statistics
+
+    @staticmethod
+    def normalize(features, statistics, standardize=True):
+        """
+        Replace Nan values of a (grains x analyses) feature array with the
+        median of each analysis, then optionally standardize each analysis
+        using it's mean and standard deviation.
+
+        Analyses without statistics are set to 0, and analyses that don't
+        vary aren't scaled.
+        """
+        median = np.nan_to_num(statistics["median"])
+        features = np.where(np.isnan(features), median, features)
+        if standardize:
+            mean = np.nan_to_num(statistics["mean"])
+            std = np.nan_to_num(statistics["std"])
+            std = np.where(std > 0, std, 1.)
+            features = (features - mean) / std
+        return features
@@ -0,0 +1,132 @@
+"""
+Module for reading grains of audio from the files of a database.
+"""
+from __future__ import print_function, division
+import collections
+import logging
+import numpy as np
+
+
+class GrainReader(object):
+
+    """
+    Reads grains of audio from the files of an AudioDatabase.
+
+    A bounded pool of audio files is kept open between reads, so that files
+    aren't re-opened and re-validated for every grain. Grains requested
+    together are grouped by file and sorted by position, so each file is read
+    sequentially and overlapping grains are read as a single block.
+
+    Arguments:
+
+    - database: the AudioDatabase to read grains from.
+
+    - max_open: the maximum number of audio files to keep open. When exceeded,
+      the least recently used file is closed.
+
+    - max_gap: the largest gap (in samples) between grains that will be read
+      as part of the same block rather than seeked over.
+
+    - sample_pool: a loaded SamplePool of the database. If provided, grains
+      are read from the pool rather than the audio files.
+    """
+
+    def __init__(self, database, max_open=32, max_gap=0, sample_pool=None):
+        self.logger = logging.getLogger(__name__ + '.GrainReader')
+        self.database = database
+        self.max_open = max_open
+        self.max_gap = max_gap
+        self.sample_pool = sample_pool
+        self.open_files = collections.OrderedDict()
+
+    def get_file(self, db_ind):
+        """Return the opened audio file for the database entry index."""
+        try:
+            audio_file = self.open_files.pop(db_ind)
+        except KeyError:
+            while len(self.open_files) >= self.max_open:
+                _, lru_file = self.open_files.popitem(last=False)
+                lru_file.close()
+            audio_file = self.database.analysed_audio[db_ind]
+            # Open the file. This also checks that the file is valid.
+            audio_file.__enter__()
+        # Re-insert to mark as the most recently used file.
+        self.open_files[db_ind] = audio_file
+        return audio_file
+
+    def read_grains(self, db_inds, start_indexes, grain_sizes):
+        """
+        Read multiple grains of audio.
+
+        Arguments:
+
+        - db_inds: the database entry index of the file to read each grain
+          from.
+
+        - start_indexes: the index in samples to read each grain from.
+
+        - grain_sizes: the size of each grain in samples.
+
+        Returns a list of grains in the order requested. Grains read from a
+        sample pool may be read-only views of the pool.
+        """
+        db_inds = np.asarray(db_inds, dtype=int)
+        start_indexes = np.asarray(start_indexes, dtype=int)
+        grain_sizes = np.asarray(grain_sizes, dtype=int)
+        if self.sample_pool is not None:
+            return [
+                self.sample_pool.read_grain(db_ind, start_index, grain_size)
+                for db_ind, start_index, grain_size in zip(db_inds, start_indexes, grain_sizes)
+            ]
+        grains = [None] * db_inds.size
+
+        # Order grains by file, then by position in the file.
+        order = np.lexsort((start_indexes, db_inds))
+        file_boundaries = np.flatnonzero(np.diff(db_inds[order])) + 1
+        for file_order in np.split(order, file_boundaries):
+            if not file_order.size:
+                continue
+            audio_file = self.get_file(db_inds[file_order[0]])
+            # Group grains that overlap (or are within the maximum gap of
+            # each other) into blocks that are read at once.
+            block = [file_order[0]]
+            block_end = start_indexes[file_order[0]] + grain_sizes[file_order[0]]
+            for ind in file_order[1:]:
+                if start_indexes[ind] > block_end + self.max_gap:
+                    self.read_block(audio_file, block, start_indexes, grain_sizes, grains)
+                    block = []
+                block.append(ind)
+                block_end = max(block_end, start_indexes[ind] + grain_sizes[ind])
+            self.read_block(audio_file, block, start_indexes, grain_sizes, grains)
+
+        return grains
+
+    @staticmethod
+    def read_block(audio_file, block, start_indexes, grain_sizes, grains):
+        """
+        Read a block of audio covering all grains in the block, then split it
+        into the grains.
+        """
+        block_start = start_indexes[block[0]]
+        block_end = np.max(start_indexes[block] + grain_sizes[block])
+        if block_end <= block_start:
+            samples = np.array([])
+        else:
+            samples = audio_file.read_grain(block_start, block_end - block_start)
+        for ind in block:
+            grain_start = start_indexes[ind] - block_start
+            # Copy so that grains can be modified without affecting
+            # overlapping grains.
+            grains[ind] = samples[grain_start:grain_start+grain_sizes[ind]].copy()
+
+    def close(self):
+        """Close all open audio files."""
+        for audio_file in self.open_files.itervalues():
+            audio_file.close()
+        self.open_files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
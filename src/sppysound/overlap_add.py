@@ -0,0 +1,111 @@
+"""
+Module for overlap-adding grains of audio into an output.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+
+def overlap_add(output, grains, starts, grain_lengths):
+    """
+    Add each grain into the output array at the start index given.
+
+    Grains that don't fit entirely in the output are skipped. All grains are
+    accumulated in a single operation using np.bincount, which sums samples
+    of overlapping grains that land on the same index.
+
+    Arguments:
+
+    - output: the array to add grains to.
+
+    - grains: a (grains x samples) array of grains, with shorter grains
+      padded with zeros.
+
+    - starts: the index in the output to add each grain at.
+
+    - grain_lengths: the length of each grain in samples.
+    """
+    fits = starts + grain_lengths <= output.size
+    grains = grains[fits]
+    starts = starts[fits]
+    if not starts.size:
+        return output
+    region_start = np.min(starts)
+    # Padding of shorter grains is zero, so indexes past the end of the output
+    # can be clipped without changing the sum.
+    inds = np.minimum(starts[:, np.newaxis] + np.arange(grains.shape[1]), output.size-1)
+    region = np.bincount((inds - region_start).ravel(), weights=grains.ravel())
+    output[region_start:region_start+region.size] += region
+    return output
+
+
+class OverlapAddWriter(object):
+
+    """
+    Overlap-adds grains into an output of a fixed length, writing samples as
+    soon as no further grains can overlap them.
+
+    Only samples that grains may still be added to are kept in memory, so
+    memory use doesn't depend on the length of the output. Grains must be
+    added in order of their start index.
+
+    Arguments:
+
+    - write: a function called with the start index and samples of each
+      finished block of output.
+
+    - output_size: the length of the output in samples. Grains that don't
+      fit entirely in the output are skipped.
+    """
+
+    def __init__(self, write, output_size):
+        self.write = write
+        self.output_size = int(output_size)
+        # Samples that haven't been written yet, starting at buffer_start.
+        self.buffer = np.zeros(0)
+        self.buffer_start = 0
+        # The largest absolute value written, for normalization.
+        self.peak = 0.
+
+    def add(self, grains, starts, grain_lengths):
+        """
+        Add a block of grains to the output.
+
+        Arguments are the same as overlap_add.
+        """
+        fits = starts + grain_lengths <= self.output_size
+        if not np.any(fits):
+            return
+        grains = grains[fits]
+        starts = starts[fits]
+        grain_lengths = grain_lengths[fits]
+        if np.min(starts) < self.buffer_start:
+            raise ValueError("Grains can't be added to output that has already been written.")
+        # Extend the buffer to fit all grains.
+        buffer_end = np.max(starts + grain_lengths)
+        if buffer_end > self.buffer_start + self.buffer.size:
+            self.buffer = np.hstack((
+                self.buffer,
+                np.zeros(buffer_end - self.buffer_start - self.buffer.size)
+            ))
+        overlap_add(self.buffer, grains, starts - self.buffer_start, grain_lengths)
+
+    def flush(self, end):
+        """
+        Write all samples before the end index. No grains starting before the
+        end index can be added afterwards.
+        """
+        end = min(int(end), self.output_size)
+        if end <= self.buffer_start:
+            return
+        block = self.buffer[:end-self.buffer_start]
+        if block.size < end - self.buffer_start:
+            block = np.hstack((block, np.zeros(end - self.buffer_start - block.size)))
+        if block.size:
+            self.peak = max(self.peak, np.max(np.abs(block)))
+        self.write(self.buffer_start, block)
+        self.buffer = self.buffer[end-self.buffer_start:].copy()
+        self.buffer_start = end
+
+    def close(self):
+        """Write the remainder of the output."""
+        self.flush(self.output_size)
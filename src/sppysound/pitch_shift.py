@@ -1,33 +1,134 @@
+"""
+Module for shifting the pitch of grains of audio without changing their
+length.
+
+Pitch is shifted using a phase vocoder. Each analysis frame is read from the
+grain at the rate of the pitch shift, so it contains the grain's content
+transposed by the shift ratio, but frames are spaced at the same hop size as
+the output. Phases of the frames are then re-accumulated from each bin's
+instantaneous frequency so that frames overlap-add coherently. As the number
+of frames only depends on the grain length, all operations are vectorized
+over batches of grains with different ratios.
+"""
+from __future__ import division
 import numpy as np
-import pdb
-import subprocess
 
-from audiofile import AudioFile
 
-def shift(sigin, pitch):
+def shift(sigin, pitch, window_size=1024):
+    """
+    Shift the pitch of a grain by the ratio specified.
+
+    Arguments:
+
+    - sigin: the grain of audio to shift.
+
+    - pitch: the ratio to shift the pitch by. ie. 2 shifts up by an octave.
+      NaN ratios return the grain unchanged.
+
+    - window_size: the FFT size used by the phase vocoder.
+    """
     if np.isnan(pitch):
         return sigin
-    input_filepath = "./.shift_input.wav"
-    output_filepath = "./.shift_output.wav"
-
-    shift_input = AudioFile.gen_default_wav(
-        input_filepath,
-        overwrite_existing=True,
-        mode='w',
-        channels=1,
-    )
-    # Write grain to be shifted to file
-    shift_input.write_frames(sigin)
-    # Close file
-    del shift_input
-
-    cents = 1200. * np.log2(pitch)
-    p_shift_args = ["sox", input_filepath, output_filepath, "pitch", str(cents)]
-
-    p = subprocess.Popen(p_shift_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (output, err) = p.communicate()
-
-    with AudioFile(output_filepath, mode='r') as shift_output:
-        # Read result
-        result = shift_output.read_grain()
-    return result
+    return shift_grains(np.atleast_2d(sigin), [pitch], window_size=window_size)[0]
+
+
+def shift_grains(grains, ratios, window_size=1024, overlap=4, block_size=2**22):
+    """
+    Shift the pitch of a batch of grains by the ratios specified.
+
+    Arguments:
+
+    - grains: a (grains x samples) array of audio grains.
+
+    - ratios: the ratio to shift the pitch of each grain by, or a single
+      ratio to shift all grains by. Grains with NaN ratios are returned
+      unchanged.
+
+    - window_size: the FFT size used by the phase vocoder.
+
+    - overlap: the factor by which FFT frames overlap.
+
+    - block_size: the maximum number of FFT samples processed at once.
+
+    Returns a (grains x samples) array of shifted grains.
+    """
+    grains = np.atleast_2d(np.asarray(grains, dtype=float))
+    grain_count, grain_size = grains.shape
+    ratios = np.asarray(ratios, dtype=float)
+    if ratios.ndim == 0:
+        ratios = np.repeat(ratios, grain_count)
+    elif ratios.shape != (grain_count,):
+        raise ValueError("Expected a ratio for each of the {0} grains, got "
+                         "ratios of shape {1}".format(grain_count, ratios.shape))
+    output = grains.copy()
+    shift_inds = np.flatnonzero(np.isfinite(ratios) & (ratios != 1.))
+    if not shift_inds.size or not grain_size:
+        return output
+
+    hop_size = window_size // overlap
+    window = np.hanning(window_size)
+    bin_freqs = 2 * np.pi * np.arange(window_size // 2 + 1) / window_size
+    # Frames are centered on multiples of the hop size, starting from the
+    # first sample.
+    frame_count = int(np.ceil(grain_size / hop_size)) + 1
+    padded_size = window_size + (frame_count - 1) * hop_size
+    pad = window_size // 2
+    frame_centers = np.arange(frame_count) * hop_size
+    window_offsets = np.arange(window_size) - pad
+    # Sum of the squared analysis/synthesis windows, used to normalize
+    # overlap-added frames.
+    window_sum = np.zeros(padded_size)
+    for frame_ind in xrange(frame_count):
+        window_sum[frame_ind*hop_size:frame_ind*hop_size+window_size] += window**2
+    window_sum = window_sum[pad:pad+grain_size]
+
+    grains_per_block = max(block_size // (frame_count * window_size), 1)
+    for block_start in xrange(0, shift_inds.size, grains_per_block):
+        block_inds = shift_inds[block_start:block_start+grains_per_block]
+        block_ratios = ratios[block_inds, None, None]
+        block = np.hstack((grains[block_inds], np.zeros((block_inds.size, 1))))
+
+        # Read each frame from the grain at the rate of the pitch shift.
+        # Samples are linearly interpolated, and samples outside of the
+        # grain are zero.
+        positions = frame_centers[:, None] + window_offsets * block_ratios
+        outside = (positions < 0) | (positions > grain_size - 1)
+        positions[outside] = grain_size
+        lower = positions.astype(int)
+        fraction = positions - lower
+        rows = np.arange(block_inds.size)[:, None, None]
+        frames = block[rows, lower] * (1. - fraction)
+        frames += block[rows, np.minimum(lower + 1, grain_size)] * fraction
+
+        spectrum = np.fft.rfft(frames * window, axis=2)
+        magnitudes = np.abs(spectrum)
+        phases = np.angle(spectrum)
+
+        # Frames are a hop apart in the grain, which is the hop size
+        # divided by the ratio in the transposed content of the frames.
+        analysis_hop = hop_size / block_ratios
+        # Calculate the instantaneous frequency of each bin from the
+        # difference between the expected and measured phase advance.
+        phase_error = phases[:, 1:] - phases[:, :-1] - analysis_hop * bin_freqs
+        phase_error = np.mod(phase_error + np.pi, 2 * np.pi) - np.pi
+        inst_freqs = bin_freqs + phase_error / analysis_hop
+
+        # Accumulate phases, advancing by a hop at each bin's frequency.
+        shifted_phases = np.empty(phases.shape)
+        shifted_phases[:, 0] = phases[:, 0]
+        shifted_phases[:, 1:] = hop_size * inst_freqs
+        shifted_phases = np.cumsum(shifted_phases, axis=1)
+
+        shifted_frames = np.fft.irfft(
+            magnitudes * np.exp(1j * shifted_phases),
+            n=window_size,
+            axis=2
+        ) * window
+
+        # Overlap-add frames.
+        shifted = np.zeros((block_inds.size, padded_size))
+        for frame_ind in xrange(frame_count):
+            frame_start = frame_ind * hop_size
+            shifted[:, frame_start:frame_start+window_size] += shifted_frames[:, frame_ind]
+        output[block_inds] = shifted[:, pad:pad+grain_size] / np.maximum(window_sum, 1e-3)
+    return output
@@ -0,0 +1,177 @@
+"""
+Module for projecting grain features onto their principal components, to
+reduce the number of dimensions searched when matching.
+"""
+from __future__ import print_function, division
+import os
+import time
+import logging
+import numpy as np
+from scipy import spatial
+from search_index import atomic_write, remove_stale
+
+logger = logging.getLogger(__name__)
+
+
+class Projection(object):
+
+    """
+    A principal component projection of weighted grain features.
+
+    Many analyses are strongly correlated (for example spectral centroid and
+    spread), so most of the variation between grains can be described with
+    fewer dimensions than there are analyses. Searching the projected
+    features is faster, especially for k-d trees, whose performance degrades
+    with the number of dimensions.
+
+    Features are weighted before they are projected, so euclidean distances
+    between projected features approximate weighted distances between the
+    original features. If the projection is whitened, each component is
+    scaled to unit variance, so all components contribute equally to
+    distances.
+
+    Arguments:
+
+    - weights: the weighting of each feature.
+
+    - mean: the mean of each weighted feature.
+
+    - components: a (components x features) array of the principal
+      components.
+
+    - variances: the variance of the weighted features along every principal
+      component, in descending order.
+
+    - whiten: if True, projected components are scaled to unit variance.
+    """
+
+    def __init__(self, weights, mean, components, variances, whiten=False):
+        self.weights = np.asarray(weights, dtype=float)
+        self.mean = mean
+        self.components = components
+        self.variances = variances
+        self.whiten = whiten
+        self.scale = np.ones(components.shape[0])
+        if whiten:
+            scale = np.sqrt(variances[:components.shape[0]])
+            self.scale = np.where(scale > 0, scale, 1.)
+
+    @classmethod
+    def fit(cls, features, weights, components, whiten=False):
+        """
+        Fit a projection to a (grains x features) array of features.
+
+        components is either the number of components to keep, or the
+        proportion of the variance of the features to keep if it is less
+        than 1.
+        """
+        weighted = np.asarray(features, dtype=float) * weights
+        mean = np.mean(weighted, axis=0)
+        covariance = np.atleast_2d(np.cov(weighted, rowvar=False))
+        variances, vectors = np.linalg.eigh(covariance)
+        # Sort components by descending variance.
+        order = np.argsort(variances)[::-1]
+        variances = np.maximum(variances[order], 0)
+        vectors = vectors[:, order]
+
+        if components < 1:
+            explained = np.cumsum(variances) / max(np.sum(variances), np.finfo(float).tiny)
+            components = np.searchsorted(explained, components) + 1
+        components = int(max(1, min(components, variances.size)))
+        return cls(weights, mean, vectors[:, :components].T, variances, whiten=whiten)
+
+    def explained_variance(self):
+        """
+        Return the proportion of the variance of the weighted features that
+        is kept by the projection.
+        """
+        total = np.sum(self.variances)
+        if not total:
+            return 1.
+        return np.sum(self.variances[:self.components.shape[0]]) / total
+
+    def transform(self, features):
+        """Weight and project a (grains x features) array of features."""
+        projected = np.dot(np.asarray(features) * self.weights - self.mean, self.components.T)
+        return projected / self.scale
+
+    def benchmark(self, features, sample_size=1000, k=2, seed=0):
+        """
+        Measure the speed of k-d tree queries of projected features against
+        queries of the original weighted features, using a random sample of
+        the features as queries.
+
+        Both trees are built for the benchmark, so this is as slow as
+        building a search index.
+
+        Returns the speedup of projected queries, and the proportion of the
+        nearest neighbours of the original features that are also found
+        using the projected features.
+        """
+        rng = np.random.RandomState(seed)
+        sample = rng.choice(features.shape[0], min(sample_size, features.shape[0]), replace=False)
+        k = min(k, features.shape[0])
+        weighted = np.asarray(features) * self.weights
+        projected = self.transform(features)
+
+        tree = spatial.cKDTree(weighted)
+        start_time = time.time()
+        indexes = tree.query(weighted[sample], k=k)[1].reshape(sample.size, k)
+        original_time = time.time() - start_time
+
+        tree = spatial.cKDTree(projected)
+        start_time = time.time()
+        projected_indexes = tree.query(projected[sample], k=k)[1].reshape(sample.size, k)
+        projected_time = time.time() - start_time
+
+        found = sum(
+            np.intersect1d(a, b).size
+            for a, b in zip(indexes, projected_indexes)
+        )
+        return original_time / max(projected_time, 1e-9), found / max(indexes.size, 1)
+
+    @staticmethod
+    def path(directory, key):
+        """Return the path of the file used to store the projection for a key."""
+        return os.path.join(directory, "projection_{0}.npz".format(key))
+
+    def save(self, directory, key):
+        """
+        Save the projection to the directory specified.
+
+        key is the key of the search index the projection is used with. The
+        projection must be saved before the index, so that a saved index
+        always has its projection. The file is moved into place once
+        written, then projections saved for other keys are removed.
+        """
+        with atomic_write(self.path(directory, key)) as projection_file:
+            np.savez(
+                projection_file,
+                weights=self.weights,
+                mean=self.mean,
+                components=self.components,
+                variances=self.variances,
+                whiten=self.whiten
+            )
+        remove_stale(directory, "projection_", key)
+
+    @classmethod
+    def load(cls, directory, key):
+        """
+        Load the projection saved for the key from the directory specified.
+
+        Returns None if no projection has been saved for the key.
+        """
+        path = cls.path(directory, key)
+        try:
+            with np.load(path) as projection:
+                return cls(
+                    projection["weights"],
+                    projection["mean"],
+                    projection["components"],
+                    projection["variances"],
+                    whiten=bool(projection["whiten"])
+                )
+        except IOError:
+            # Not saved, or removed by another process.
+            return None
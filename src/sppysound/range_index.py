@@ -0,0 +1,85 @@
+"""
+Module for finding source grains with analysis values within ranges, using
+sorted indexes of grain features.
+"""
+from __future__ import print_function, division
+import logging
+import numpy as np
+
+
+class RangeIndex(object):
+
+    """
+    Sorted secondary indexes of the values of a set of analyses over the
+    grains of a source database.
+
+    Values of each analysis are sorted once, so the grains with values in a
+    range can be found with a binary search. When grains are constrained by
+    ranges of several analyses, candidates are taken from the analysis with
+    the fewest grains in range, then filtered by the ranges of the other
+    analyses. The cost of finding candidates is proportional to the number
+    of candidates, so tighter ranges are faster.
+
+    Arguments:
+
+    - values: a (grains x analyses) array of unnormalized analysis values for
+      every grain of the source database, as stored in the FeatureStore.
+
+    - grain_indexes: the global grain indexes of the grains to include. All
+      grains are included if not provided.
+    """
+
+    def __init__(self, values, grain_indexes=None):
+        self.logger = logging.getLogger(__name__ + '.RangeIndex')
+        self.values = np.asarray(values, dtype=float)
+        if grain_indexes is None:
+            grain_indexes = np.arange(self.values.shape[0])
+        self.sorted_values = []
+        self.sorted_grains = []
+        for column in self.values.T:
+            grain_values = column[grain_indexes]
+            # Grains without a value are never in range.
+            valid = ~np.isnan(grain_values)
+            order = np.argsort(grain_values[valid], kind='mergesort')
+            self.sorted_values.append(grain_values[valid][order])
+            self.sorted_grains.append(np.asarray(grain_indexes)[valid][order])
+
+    def search(self, analysis_ind, low, high):
+        """
+        Find the start and end of the grains with values of an analysis
+        between low and high (inclusive), in the analysis' sorted order.
+        """
+        sorted_values = self.sorted_values[analysis_ind]
+        return (
+            np.searchsorted(sorted_values, low, side='left'),
+            np.searchsorted(sorted_values, high, side='right')
+        )
+
+    def candidates(self, lows, highs):
+        """
+        Find the global grain indexes of all grains with values of every
+        analysis between the low and high values given for the analysis.
+
+        Analyses with infinite low and high values are unconstrained. Grains
+        without a value for a constrained analysis are never included.
+
+        Returns a sorted array of global grain indexes, or None if no
+        analyses are constrained.
+        """
+        constrained = [
+            i for i, (low, high) in enumerate(zip(lows, highs))
+            if not (np.isneginf(low) and np.isposinf(high))
+        ]
+        if not constrained:
+            return None
+        bounds = [self.search(i, lows[i], highs[i]) for i in constrained]
+        narrowest = constrained[np.argmin([end - start for start, end in bounds])]
+        start, end = bounds[constrained.index(narrowest)]
+        grains = self.sorted_grains[narrowest][start:end]
+        for i in constrained:
+            if i == narrowest or not grains.size:
+                continue
+            grain_values = self.values[grains, i]
+            with np.errstate(invalid='ignore'):
+                grains = grains[(grain_values >= lows[i]) & (grain_values <= highs[i])]
+        return np.sort(grains)
@@ -0,0 +1,206 @@
+"""
+Module for storing the decoded samples of a database in a single memory
+mapped file.
+"""
+from __future__ import print_function, division
+import os
+import glob
+import uuid
+import fcntl
+import contextlib
+import logging
+import numpy as np
+
+
+class SamplePool(object):
+
+    """
+    A pool of the decoded samples of every file in an AudioDatabase.
+
+    Samples of all files are decoded once and stored contiguously as float32
+    in a single .npy file in the database's data directory. An index of the
+    position of each file in the pool is stored alongside it. The pool is
+    memory mapped when loaded so that grains can be read as slices of the
+    pool without copying, and so that processes reading the same pool share
+    memory.
+
+    Each pool is written to a file named with a unique stamp that is
+    recorded in it's index, so replacing the index switches to the new pool
+    in a single step. A pool and an index written by different builds are
+    never used together, even if a build is interrupted. Builds hold an
+    exclusive lock on a lock file in the data directory, so processes
+    sharing a database build the pool one at a time.
+
+    The pool is rebuilt when loaded if any file in the database has been
+    added, removed or modified since it was built.
+
+    Arguments:
+
+    - database: the AudioDatabase to store the samples of.
+
+    - block_size: the number of samples decoded at once when building the
+      pool.
+    """
+
+    index_dtype = [
+        ("start", np.int64),
+        ("frames", np.int64),
+        ("mtime", np.float64)
+    ]
+
+    def __init__(self, database, block_size=2**20):
+        self.logger = logging.getLogger(__name__ + '.SamplePool')
+        self.database = database
+        self.block_size = block_size
+        self.data_dir = database.subdirs["data"]
+        self.index_path = os.path.join(self.data_dir, "sample_pool_index.npz")
+        self.lock_path = os.path.join(self.data_dir, "sample_pool.lock")
+        self.samples = None
+        # The start and length of each database entry's samples in the pool.
+        self.starts = None
+        self.frames = None
+
+    def file_stats(self):
+        """
+        Return the names and modification times of the files in the
+        database.
+        """
+        names = [entry.name for entry in self.database.analysed_audio]
+        mtimes = [os.path.getmtime(entry.filepath) for entry in self.database.analysed_audio]
+        return names, mtimes
+
+    def pool_path(self, stamp):
+        """Return the path of the pool file written with a stamp."""
+        return os.path.join(self.data_dir, "sample_pool_{0}.npy".format(stamp))
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold an exclusive lock on the pool's lock file."""
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def is_valid(self):
+        """Check that the stored pool matches the files in the database."""
+        if not os.path.exists(self.index_path):
+            return False
+        names, mtimes = self.file_stats()
+        with np.load(self.index_path) as index:
+            # Indexes written before pools were stamped don't record a pool.
+            if "stamp" not in index.files or not os.path.exists(self.pool_path(str(index["stamp"]))):
+                return False
+            if index["names"].size != len(names):
+                return False
+            return (
+                np.all(index["names"] == np.array(names)) and
+                np.all(index["entries"]["mtime"] == np.array(mtimes))
+            )
+
+    def build(self):
+        """
+        Decode all files in the database into the pool.
+
+        This must be called while holding the pool's lock.
+        """
+        self.logger.info("Building sample pool for {0}".format(self.database.db_dir))
+        names, mtimes = self.file_stats()
+        entries = np.zeros(len(names), dtype=self.index_dtype)
+        entries["mtime"] = mtimes
+        for i, entry in enumerate(self.database.analysed_audio):
+            with entry:
+                entries["frames"][i] = entry.get_frames()
+        entries["start"][1:] = np.cumsum(entries["frames"])[:-1]
+        total_frames = int(np.sum(entries["frames"]))
+
+        stamp = uuid.uuid4().hex
+        pool_path = self.pool_path(stamp)
+        # Write to a temporary file first so that the pool is never read
+        # while partially written.
+        temp_path = pool_path + ".tmp"
+        if total_frames:
+            pool = np.lib.format.open_memmap(
+                temp_path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(total_frames,)
+            )
+            for i, entry in enumerate(self.database.analysed_audio):
+                start = entries["start"][i]
+                with entry:
+                    entry.seek(0, 0)
+                    for block_start in xrange(0, entries["frames"][i], self.block_size):
+                        block = entry.read_frames(min(self.block_size, entries["frames"][i] - block_start))
+                        pool[start+block_start:start+block_start+block.size] = block
+            pool.flush()
+            del pool
+        else:
+            # Empty files can't be memory mapped for writing.
+            with open(temp_path, "wb") as pool_file:
+                np.save(pool_file, np.zeros(0, dtype=np.float32))
+        os.rename(temp_path, pool_path)
+
+        # The index is replaced last, so it only ever refers to a complete
+        # pool.
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "wb") as index_file:
+            np.savez(index_file, names=np.array(names), entries=entries, stamp=stamp)
+        os.rename(temp_path, self.index_path)
+
+        # Remove previous pools, and any left by interrupted builds. Other
+        # processes may still be reading previous pools, but files that are
+        # already memory mapped remain readable once removed.
+        for path in glob.glob(os.path.join(self.data_dir, "sample_pool*.npy*")):
+            if path != pool_path:
+                os.remove(path)
+
+    def load(self, retry=True):
+        """
+        Memory map the pool, building it first if it doesn't match the files
+        in the database.
+
+        If the pool is replaced by another process between reading the
+        index and opening the pool, loading is retried once.
+        """
+        if not self.is_valid():
+            with self.lock():
+                # Another process may have built the pool while waiting for
+                # the lock.
+                if not self.is_valid():
+                    self.build()
+        with np.load(self.index_path) as index:
+            stamp = str(index["stamp"])
+            self.starts = index["entries"]["start"]
+            self.frames = index["entries"]["frames"]
+        try:
+            if np.sum(self.frames):
+                self.samples = np.load(self.pool_path(stamp), mmap_mode="r")
+            else:
+                # Empty files can't be memory mapped.
+                self.samples = np.load(self.pool_path(stamp))
+        except IOError:
+            if not retry:
+                raise
+            return self.load(retry=False)
+        return self
+
+    def read_grain(self, db_ind, start_index, grain_size):
+        """
+        Read a grain of audio from the pool.
+
+        Grains that lie within the file are returned as read-only views of
+        the pool. Grains that extend past the end of the file are padded with
+        zeros, as with AudioFile.read_grain.
+        """
+        start_index = int(start_index)
+        grain_size = int(grain_size)
+        frames = self.frames[db_ind]
+        pool_start = self.starts[db_ind] + start_index
+        if start_index + grain_size <= frames:
+            return self.samples[pool_start:pool_start+grain_size]
+        grain = np.zeros(grain_size, dtype=np.float32)
+        available = max(frames - start_index, 0)
+        grain[:available] = self.samples[pool_start:pool_start+available]
+        return grain
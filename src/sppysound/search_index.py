@@ -0,0 +1,293 @@
+"""
+Module for building, storing and querying nearest neighbour indexes of grain
+features.
+"""
+from __future__ import print_function, division
+import os
+import glob
+import json
+import uuid
+import hashlib
+import logging
+import contextlib
+import cPickle as pickle
+import numpy as np
+from scipy import spatial
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """
+    Open a temporary file to write, which is moved to the path given once
+    it has been written.
+
+    Readers of the path only ever see a complete file. Temporary files are
+    named uniquely, so processes writing the same path don't interfere, and
+    are removed if writing fails.
+    """
+    temp_path = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            yield temp_file
+        os.rename(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def remove_stale(directory, prefix, key):
+    """
+    Remove files in the directory saved with the prefix given for any key
+    other than key.
+
+    Manifests are removed first, so that a stale index is never loaded
+    while its files are being removed. Temporary files are left for the
+    processes writing them.
+    """
+    current = prefix + key
+    paths = [
+        path for path in glob.glob(os.path.join(directory, prefix + "*"))
+        if not os.path.basename(path).startswith(current) and not path.endswith(".tmp")
+    ]
+    for path in sorted(paths, key=lambda path: not path.endswith(".json")):
+        try:
+            os.remove(path)
+        except OSError:
+            # Already removed by another process.
+            pass
+
+
+class SearchIndex(object):
+
+    """
+    A nearest neighbour index over the grain features of a source database.
+
+    Rows of the feature matrix are the global grain indexes of the source
+    database (as calculated by Matcher.count_grains), so results of a query
+    can be mapped directly back to (file, grain) pairs.
+
+    Features are stored unweighted. The weighting of each feature is applied
+    as a scaling of both the indexed features and the query, so the index
+    can be reused with different weightings without recalculating features.
+
+    Indexes can be saved to a directory and loaded in later runs. When loaded,
+    the feature matrix is memory-mapped rather than read into memory.
+
+    Arguments:
+
+    - features: a (grains x analyses) array of grain features.
+
+    - weights: the weighting of each feature. Features are unweighted if not
+      provided.
+
+    - tree: a pre-built cKDTree of the weighted features. If not provided,
+      one will be built.
+
+    - leafsize: the leaf size used when building the tree.
+
+    - grain_indexes: the global grain index of each row of the features, for
+      indexes of a subset of the source database's grains. Rows are the
+      global grain indexes if not provided.
+    """
+
+    def __init__(self, features, weights=None, tree=None, leafsize=100, grain_indexes=None):
+        self.logger = logging.getLogger(__name__ + '.SearchIndex')
+        self.features = features
+        self.leafsize = leafsize
+        self.grain_indexes = grain_indexes
+        if weights is None:
+            weights = np.ones(features.shape[1])
+        self.weights = np.asarray(weights, dtype=float)
+        if tree is None:
+            tree = self.build_tree()
+        self.tree = tree
+
+    def __len__(self):
+        """Return the number of grains in the index."""
+        return self.features.shape[0]
+
+    def grains(self):
+        """Return the global grain index of every grain in the index."""
+        if self.grain_indexes is None:
+            return np.arange(self.features.shape[0])
+        return self.grain_indexes
+
+    def grain_features(self, grains):
+        """
+        Return the weighted features of grains in the index, from their
+        sorted global grain indexes.
+        """
+        rows = grains
+        if self.grain_indexes is not None:
+            rows = np.searchsorted(self.grain_indexes, grains)
+        return self.features[rows] * self.weights
+
+    def build_tree(self):
+        """Build a tree of the weighted features."""
+        return spatial.cKDTree(self.features * self.weights, leafsize=self.leafsize)
+
+    def set_weights(self, weights):
+        """
+        Set the weighting of each feature. The tree is rebuilt if the
+        weighting has changed.
+        """
+        weights = np.asarray(weights, dtype=float)
+        if not np.array_equal(weights, self.weights):
+            self.weights = weights
+            self.tree = self.build_tree()
+
+    def query(self, x, k, n_jobs=1):
+        """
+        Find the k closest grains to each row of x, using the index's
+        weighting.
+
+        Queries are run in n_jobs parallel threads. If n_jobs is -1, all
+        processors are used.
+
+        Returns an array of distances and an array of global grain indexes,
+        each with a row for each row of x and a column for each match.
+        """
+        # The tree can't return more matches than there are source grains.
+        k = min(k, self.features.shape[0])
+        distances, indexes = self.tree.query(np.asarray(x) * self.weights, k=k, p=2, n_jobs=n_jobs)
+        if len(distances.shape) < 2:
+            distances = np.array([distances]).T
+            indexes = np.array([indexes]).T
+        if self.grain_indexes is not None:
+            indexes = self.grain_indexes[indexes]
+        return distances, indexes
+
+    @staticmethod
+    def generate_key(**parameters):
+        """
+        Generate a key identifying an index built with the parameters given.
+
+        Parameters must be JSON serializable.
+        """
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def weights_key(cls, weights):
+        """
+        Generate a key identifying a weighting. A weighting of all ones is
+        the same as no weighting.
+        """
+        if weights is not None and np.any(np.asarray(weights) != 1):
+            weights = [float(weight) for weight in weights]
+        else:
+            weights = None
+        return cls.generate_key(weights=weights)
+
+    @classmethod
+    def index_paths(cls, directory, key, weights=None):
+        """
+        Return the paths of the files used to store the index for a key.
+
+        A tree is stored for each weighting, so the path of the tree depends
+        on the weighting given.
+        """
+        prefix = os.path.join(directory, "search_index_{0}".format(key))
+        return {
+            "features": prefix + ".npy",
+            "tree": "{0}_{1}.tree".format(prefix, cls.weights_key(weights)),
+            "grain_indexes": prefix + "_grains.npy",
+            "info": prefix + ".json"
+        }
+
+    def save(self, directory, key, info=None):
+        """
+        Save the index to the directory specified.
+
+        Each file is written to a temporary file and moved into place, and
+        the manifest, which lists the files of the index, is written last.
+        The tree is saved for the index's weighting. Trees of other
+        weightings are saved when the index is loaded with them.
+        An index is only loaded once its manifest exists, so a partially
+        saved index is never loaded.
+
+        Once the index has been saved, any indexes previously saved in the
+        directory for other keys are removed as they can't be valid for the
+        current state of the database.
+
+        Arguments:
+
+        - directory: the directory to save the index to. This is normally the
+          data directory of the source database.
+
+        - key: the key generated for the index using generate_key.
+
+        - info: a dictionary of parameters used to create the index. This is
+          saved in the manifest for reference.
+        """
+        paths = self.index_paths(directory, key)
+        files = ["features"]
+        with atomic_write(paths["features"]) as features_file:
+            np.save(features_file, np.asarray(self.features))
+        if self.grain_indexes is not None:
+            with atomic_write(paths["grain_indexes"]) as grains_file:
+                np.save(grains_file, self.grain_indexes)
+            files.append("grain_indexes")
+        self.save_tree(directory, key)
+        with atomic_write(paths["info"]) as info_file:
+            json.dump({"info": info or {}, "files": files}, info_file, sort_keys=True, indent=4)
+        remove_stale(directory, "search_index_", key)
+        self.logger.info("Saved search index to: {0}".format(paths["features"]))
+
+    def save_tree(self, directory, key):
+        """Save the tree of the index's weighting to the directory specified."""
+        path = self.index_paths(directory, key, self.weights)["tree"]
+        try:
+            # The weighting is saved with the tree to check that it matches
+            # when loaded.
+            with atomic_write(path) as tree_file:
+                pickle.dump((self.weights, self.tree), tree_file, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError) as err:
+            # Older versions of scipy can't pickle trees. The tree will be
+            # rebuilt from the saved features when loaded.
+            self.logger.warning("Search tree couldn't be saved: {0}".format(err))
+
+    @classmethod
+    def load(cls, directory, key, weights=None, leafsize=100):
+        """
+        Load the index saved for the key from the directory specified, with
+        the weighting given.
+
+        The tree saved for the weighting is used if there is one. Otherwise
+        the tree is built from the saved features and saved for later runs.
+
+        Returns None if no complete index has been saved for the key.
+        """
+        paths = cls.index_paths(directory, key, weights)
+        try:
+            with open(paths["info"], 'r') as info_file:
+                files = json.load(info_file).get("files", [])
+            if "features" not in files:
+                # Indexes saved before manifests were written.
+                return None
+            features = np.load(paths["features"], mmap_mode='r')
+            grain_indexes = None
+            if "grain_indexes" in files:
+                grain_indexes = np.load(paths["grain_indexes"])
+        except (IOError, OSError, ValueError):
+            # Files of the index are missing, were removed by another process
+            # that saved an index for a different key, or were written before
+            # saves were atomic.
+            return None
+        if weights is None:
+            weights = np.ones(features.shape[1])
+        tree = None
+        try:
+            with open(paths["tree"], 'rb') as tree_file:
+                tree_weights, tree = pickle.load(tree_file)
+            if not np.array_equal(tree_weights, weights):
+                tree = None
+        except (IOError, EOFError, pickle.UnpicklingError):
+            # No tree has been saved for the weighting.
+            pass
+        logger.info("Loaded search index from: {0}".format(paths["features"]))
+        index = cls(features, weights=weights, tree=tree, leafsize=leafsize, grain_indexes=grain_indexes)
+        if tree is None:
+            index.save_tree(directory, key)
+        return index
@@ -1,16 +1,32 @@
 """A set of unit tests to check the correct operation of the pysound module."""
 import unittest
 import numpy as np
-from sppysound import AudioFile, analysis
-from sppysound.database import AudioDatabase, Matcher
+from sppysound import AudioFile, AnalysedAudioFile, analysis
+from sppysound.database import AudioDatabase, Matcher, Synthesizer
+from sppysound.grain_reader import GrainReader
+from sppysound.sample_pool import SamplePool
+from sppysound.search_index import SearchIndex
+from sppysound.ann_index import ApproximateIndex
+from sppysound.range_index import RangeIndex
+from sppysound.projection import Projection
+from sppysound.feature_store import FeatureStore
+from sppysound.overlap_add import overlap_add, OverlapAddWriter
+from sppysound import pitch_shift
 import subprocess
-from scipy import signal
+import glob
+import gc
+import h5py
+from numpy.lib import stride_tricks
+from scipy import signal, spatial
 
 from fileops import pathops
 import pdb
 import os
 import config
 import math
+import argparse
+import logging
+import logging.handlers
 
 
 class NumericAssertions:
@@ -211,6 +227,111 @@ class ReadGrainTest(globalTests):
         pathops.delete_if_exists("./.TestAudio.wav")
 
 
+class GrainReaderTests(globalTests):
+
+    """Test reading multiple grains from database files."""
+
+    def setUp(self):
+        """Create functions and variables before each test is run."""
+        self.TestAudio = self.create_test_audio()
+        self.TestAudio.write_frames(np.linspace(-0.5, 0.5, 101))
+        self.TestAudio.switch_mode('r')
+
+    def test_ReadGrains(self):
+        """Check grains are returned in the order requested."""
+        database = argparse.Namespace(analysed_audio=[self.TestAudio])
+        start_indexes = [50, 0, 10, 90]
+        # The reader closes the files it reads, so grains are read from the
+        # file first.
+        expected_grains = [self.TestAudio.read_grain(start_index, 20) for start_index in start_indexes]
+        with GrainReader(database) as grain_reader:
+            grains = grain_reader.read_grains([0, 0, 0, 0], start_indexes, [20, 20, 20, 20])
+        for grain, expected_grain in zip(grains, expected_grains):
+            np.testing.assert_array_equal(grain, expected_grain)
+
+    def test_ReadGrainsFromPool(self):
+        """Check grains read from a sample pool match grains read from file."""
+        database = argparse.Namespace(
+            analysed_audio=[self.TestAudio],
+            subdirs={"data": "."},
+            db_dir="."
+        )
+        start_indexes = [50, 0, 10, 90]
+        expected_grains = [self.TestAudio.read_grain(start_index, 20) for start_index in start_indexes]
+        sample_pool = SamplePool(database).load()
+        self.assertTrue(sample_pool.is_valid())
+        with GrainReader(database, sample_pool=sample_pool) as grain_reader:
+            grains = grain_reader.read_grains([0, 0, 0, 0], start_indexes, [20, 20, 20, 20])
+        for grain, expected_grain in zip(grains, expected_grains):
+            self.assertEqual(grain.size, 20)
+            np.testing.assert_allclose(grain, expected_grain, atol=1e-6)
+
+    def test_SamplePoolStamp(self):
+        """
+        Check that a pool left by an interrupted build isn't used, and that
+        it's removed when the pool is rebuilt.
+        """
+        database = argparse.Namespace(
+            analysed_audio=[self.TestAudio],
+            subdirs={"data": "."},
+            db_dir="."
+        )
+        expected_samples = np.array(SamplePool(database).load().samples)
+        # A pool written by a build that was interrupted before it's index
+        # was replaced.
+        np.save("./sample_pool_interrupted.npy", np.zeros(expected_samples.size, dtype=np.float32))
+        sample_pool = SamplePool(database).load()
+        np.testing.assert_array_equal(sample_pool.samples, expected_samples)
+
+        # Modifying a file rebuilds the pool, removing previous pools.
+        mtime = os.path.getmtime(self.TestAudio.filepath)
+        os.utime(self.TestAudio.filepath, (mtime + 10, mtime + 10))
+        self.assertFalse(SamplePool(database).is_valid())
+        sample_pool = SamplePool(database).load()
+        np.testing.assert_array_equal(sample_pool.samples, expected_samples)
+        self.assertEqual(len(glob.glob("./sample_pool_*.npy")), 1)
+
+    def test_SamplePoolReplaced(self):
+        """
+        Check that loading is retried if the pool is removed by another
+        process after it's been checked.
+        """
+        database = argparse.Namespace(
+            analysed_audio=[self.TestAudio],
+            subdirs={"data": "."},
+            db_dir="."
+        )
+        expected_samples = np.array(SamplePool(database).load().samples)
+        for path in glob.glob("./sample_pool_*.npy"):
+            os.remove(path)
+        sample_pool = SamplePool(database)
+        # The pool is valid when first checked, then removed before it's
+        # opened.
+        is_valid = sample_pool.is_valid
+        checks = [True]
+        sample_pool.is_valid = lambda: checks.pop() if checks else is_valid()
+        sample_pool.load()
+        np.testing.assert_array_equal(sample_pool.samples, expected_samples)
+
+    def test_EmptySamplePool(self):
+        """Check that a pool can be built for a database without any files."""
+        database = argparse.Namespace(
+            analysed_audio=[],
+            subdirs={"data": "."},
+            db_dir="."
+        )
+        sample_pool = SamplePool(database).load()
+        self.assertEqual(sample_pool.samples.size, 0)
+        self.assertTrue(SamplePool(database).is_valid())
+
+    def tearDown(self):
+        """Delete temporary test audio files generated during the tests."""
+        del self.TestAudio
+        pathops.delete_if_exists("./.TestAudio.wav")
+        for path in glob.glob("./sample_pool*"):
+            pathops.delete_if_exists(path)
+
+
 class GenerateWhiteNoiseTest(globalTests):
 
     """Test white noise generation."""
@@ -642,6 +763,133 @@ class SpectralFlatnessAnalysisTests(globalTests, NumericAssertions):
         self.assertEqual(output1, 1.)
         self.assertEqual(output2, 0.)
 
+class SpectralDescriptorsTests(globalTests):
+    """Tests fused calculation of spectral descriptors."""
+
+    def setUp(self):
+        self.fft = np.fft.rfft(np.random.randn(100, 512))
+
+    def test_BlocksMatchSinglePass(self):
+        descriptors = analysis.AnalysisTools.SPECTRAL_DESCRIPTORS
+        output = analysis.AnalysisTools.spectral_descriptors(self.fft, descriptors, 44100, block_size=7)
+        expected_output = analysis.AnalysisTools.spectral_descriptors(self.fft, descriptors, 44100, block_size=100)
+        for name in descriptors:
+            np.testing.assert_array_equal(output[name], expected_output[name])
+        self.assertEqual(output["spcflux"].size, 99)
+
+class GrainAggregationTests(globalTests):
+    """Tests averaging of analysis frames over grains."""
+
+    def setUp(self):
+        self.times = np.arange(100) * 0.01
+        self.frames = np.random.rand(100)
+        self.frames[::7] = np.nan
+        self.start = np.array([0., 0.105, 0.5, 2.])
+        self.end = np.array([0.1, 0.4, 0.52, 3.])
+
+    def test_GrainAverages(self):
+        selection = analysis.Analysis.grain_frame_ranges(self.times, self.start, self.end)
+        valid_inds = np.isfinite(self.frames)
+        means = analysis.Analysis.grain_mean(self.frames, valid_inds, selection)
+        medians = analysis.Analysis.grain_median(self.frames, valid_inds, selection)
+        for ind, (start, end) in enumerate(zip(self.start, self.end)):
+            grain_inds = (self.times >= start) & (self.times <= end) & valid_inds
+            if grain_inds.any():
+                self.assertAlmostEqual(means[ind], np.mean(self.frames[grain_inds]))
+                self.assertEqual(medians[ind], np.median(self.frames[grain_inds]))
+            else:
+                self.assertTrue(np.isnan(means[ind]) and np.isnan(medians[ind]))
+
+class FrameCacheTests(globalTests):
+    """Tests the cache of framed audio shared between analyses."""
+
+    def setUp(self):
+        self.samples = np.random.uniform(low=-1.0, high=1.0, size=10000)
+
+    def reference_frames(self, window_size, overlapFac, window=None, centre=True):
+        """Frame the samples as each analysis did before frames were shared."""
+        hopSize = int(window_size - np.floor(overlapFac * window_size))
+        samples = self.samples
+        if centre:
+            # zeros at beginning (thus center of 1st window should be for sample nr. 0)
+            samples = np.append(np.zeros(window_size//2), samples)
+        # cols for windowing
+        cols = int(np.ceil((len(samples) - window_size) / float(hopSize)) + 1)
+        # zeros at end (thus samples can be fully covered by frames)
+        samples = np.append(samples, np.zeros(window_size))
+        frames = stride_tricks.as_strided(
+            samples,
+            shape=(cols, window_size),
+            strides=(samples.strides[0]*hopSize, samples.strides[0])
+        ).copy()
+        if window:
+            frames *= window(window_size)
+        return frames
+
+    def test_Frames(self):
+        """Check that cached frames are the frames each analysis created."""
+        frame_cache = analysis.AnalysisTools.FrameCache(self.samples)
+        settings = [
+            (512, 0.5, None, True),
+            (1024, 0.75, np.hanning, True),
+            (2048, 0.125, signal.triang, True),
+            (130, 1/16., signal.hanning, True),
+            (4096, 0.5, None, False)
+        ]
+        for window_size, overlapFac, window, centre in settings:
+            frames = frame_cache.frames(window_size, overlapFac, window=window, centre=centre)
+            np.testing.assert_array_equal(
+                frames,
+                self.reference_frames(window_size, overlapFac, window=window, centre=centre)
+            )
+            self.assertFalse(frames.flags.writeable)
+            # Frames are only created once for each setting.
+            self.assertIs(frame_cache.frames(window_size, overlapFac, window=window, centre=centre), frames)
+        np.testing.assert_array_equal(
+            analysis.AnalysisTools.frame_signal(self.samples, 512),
+            self.reference_frames(512, 0.5)
+        )
+
+    def test_CacheReleased(self):
+        """Check that cached frames are released once analyses are created."""
+        self.TestAudio = self.create_test_audio()
+        self.TestAudio.write_frames(self.samples)
+        del self.TestAudio
+        with h5py.File("./.TestAnalysis.hdf5", 'w') as data_file:
+            with AnalysedAudioFile(
+                "./.TestAudio.wav",
+                'r',
+                data_file=data_file,
+                analyses=["rms", "peak", "zerox", "f0"],
+                name="test",
+                config=config
+            ) as audio:
+                audio.create_analysis()
+                self.assertEqual(set(audio.analyses.keys()), {"rms", "peak", "zerox", "f0"})
+                gc.collect()
+                self.assertFalse([
+                    x for x in gc.get_objects()
+                    if isinstance(x, analysis.AnalysisTools.FrameCache)
+                ])
+
+    def tearDown(self):
+        """Delete temporary test files generated during the tests."""
+        pathops.delete_if_exists("./.TestAudio.wav")
+        pathops.delete_if_exists("./.TestAnalysis.hdf5")
+
+class ArrayCacheTests(globalTests):
+    """Tests the least recently used cache of analysis arrays."""
+
+    def test_LeastRecentlyUsedEviction(self):
+        # Create a cache large enough to store 2 arrays.
+        cache = analysis.AnalysisTools.ArrayCache(max_bytes=1600)
+        for key in ["a", "b", "a", "c"]:
+            output = cache.get(key, lambda: np.zeros(100))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertFalse(output.flags.writeable)
+
 class KurtosisAnalysisTests(globalTests):
     """Tests Kurtosis analysis generation."""
 
@@ -685,6 +933,24 @@ class F0AnalysisTests(globalTests):
         a = (average_output >= 437) & (average_output <= 443)
         self.assertTrue(a.all())
 
+    def test_BatchedF0MatchesPerFrame(self):
+        x = np.arange(88200)+1
+        square_wave = np.sign(np.sin(2*np.pi*150/self.sr*x))
+        pulse_wave = (x % 300 < 30).astype(float)
+        low_sine_wave = np.sin(2*np.pi*60/self.sr*x)
+        signal_parts = np.hstack((
+            self.sine_wave,
+            np.zeros(4096),
+            self.white_noise,
+            square_wave,
+            pulse_wave,
+            low_sine_wave
+        ))
+        for window_size in (512, 1024, 4096):
+            output = analysis.F0Analysis.create_f0_analysis(signal_parts, self.sr, window_size=window_size)
+            expected_output = analysis.F0Analysis.create_f0_analysis(signal_parts, self.sr, window_size=window_size, batched=False)
+            np.testing.assert_allclose(output, expected_output, rtol=1e-6)
+
     def tearDown(self):
         """
         Delete anything that is left over once tests are complete.
@@ -695,6 +961,358 @@ class F0AnalysisTests(globalTests):
         del self.TestAudio
         pathops.delete_if_exists("./.TestAudio.wav")
 
+class PitchShiftTests(globalTests):
+    """Tests pitch shifting of grains."""
+
+    def setUp(self):
+        self.sr = 44100.
+        self.sine_wave = np.sin(2*np.pi*440*np.arange(4410)/self.sr)
+
+    def test_ShiftGrains(self):
+        ratios = np.array([1.5, 0.75, np.nan])
+        grains = np.vstack((self.sine_wave, self.sine_wave, self.sine_wave))
+        output = pitch_shift.shift_grains(grains, ratios)
+        self.assertEqual(output.shape, grains.shape)
+        for grain, ratio in zip(output[:2], ratios[:2]):
+            spectrum = np.abs(np.fft.rfft(grain*np.hanning(grain.size), 10*grain.size))
+            peak_freq = np.argmax(spectrum) * self.sr / (10*grain.size)
+            self.assertAlmostEqual(peak_freq, 440*ratio, delta=1)
+        np.testing.assert_array_equal(output[2], self.sine_wave)
+
+    def test_ShiftGrainsRatios(self):
+        """
+        Check that a single ratio shifts every grain, and that a ratio must
+        be given for each grain otherwise.
+        """
+        grains = np.vstack((self.sine_wave, self.sine_wave))
+        np.testing.assert_array_equal(
+            pitch_shift.shift_grains(grains, 1.5),
+            pitch_shift.shift_grains(grains, [1.5, 1.5])
+        )
+        with self.assertRaises(ValueError):
+            pitch_shift.shift_grains(grains, [1.5])
+        with self.assertRaises(ValueError):
+            pitch_shift.shift_grains(grains, [1.5, 0.75, 2.])
+
+class OverlapAddTests(globalTests):
+    """Tests overlap-add of grain blocks."""
+
+    def test_OverlapAdd(self):
+        grains = [np.random.randn(8), np.random.randn(5), np.random.randn(8), np.random.randn(8)]
+        starts = np.array([0, 3, 6, 15])
+        block, grain_lengths = Synthesizer.grain_block(grains)
+        np.testing.assert_array_equal(grain_lengths, [8, 5, 8, 8])
+        output = overlap_add(np.zeros(20), block, starts, grain_lengths)
+
+        # The last grain doesn't fit in the output so is skipped.
+        expected_output = np.zeros(20)
+        for grain, start in zip(grains[:3], starts[:3]):
+            expected_output[start:start+grain.size] += grain
+        np.testing.assert_allclose(output, expected_output)
+
+    def test_OverlapAddWriter(self):
+        """Check that streamed output matches overlap-adding all at once."""
+        grains = np.random.randn(40, 10)
+        starts = np.arange(40) * 3
+        grain_lengths = np.repeat(10, 40)
+        blocks = []
+        writer = OverlapAddWriter(lambda start, samples: blocks.append(samples), 125)
+        for batch_start in xrange(0, 40, 7):
+            batch = slice(batch_start, batch_start+7)
+            writer.add(grains[batch], starts[batch], grain_lengths[batch])
+            if batch_start + 7 < 40:
+                writer.flush(starts[batch_start+7])
+        writer.close()
+
+        expected_output = overlap_add(np.zeros(125), grains, starts, grain_lengths)
+        output = np.hstack(blocks)
+        np.testing.assert_allclose(output, expected_output)
+        self.assertAlmostEqual(writer.peak, np.max(np.abs(expected_output)))
+
+class SearchIndexTests(globalTests):
+    """Tests weighting of search indexes."""
+
+    def test_Weights(self):
+        """
+        Check that querying with weights matches searching weighted
+        features.
+        """
+        features = np.random.randn(500, 3)
+        targets = np.random.randn(20, 3)
+        weights = np.array([1., 0.5, 2.])
+        search_index = SearchIndex(features)
+        search_index.set_weights(weights)
+        distances, indexes = search_index.query(targets, 4)
+
+        expected_indexes = np.argsort(
+            np.sum((targets[:, np.newaxis]*weights - features*weights)**2, axis=2),
+            axis=1
+        )[:, :4]
+        np.testing.assert_array_equal(indexes, expected_indexes)
+
+    def test_GrainIndexes(self):
+        """
+        Check that indexes of a subset of grains return global grain
+        indexes.
+        """
+        features = np.random.randn(500, 3)
+        targets = np.random.randn(20, 3)
+        grain_indexes = np.arange(0, 500, 2)
+        search_index = SearchIndex(features[grain_indexes], grain_indexes=grain_indexes)
+        distances, indexes = search_index.query(targets, 4)
+
+        expected_indexes = grain_indexes[np.argsort(
+            np.sum((targets[:, np.newaxis] - features[grain_indexes])**2, axis=2),
+            axis=1
+        )[:, :4]]
+        np.testing.assert_array_equal(indexes, expected_indexes)
+
+    def test_SaveLoad(self):
+        """
+        Check that saved indexes are only loaded when complete, and that
+        indexes saved for other keys are removed once an index is saved.
+        """
+        index_dir = "./.test_index"
+        pathops.dir_must_exist(index_dir)
+        features = np.random.randn(500, 3)
+        grain_indexes = np.arange(0, 500, 2)
+        search_index = SearchIndex(features[grain_indexes], grain_indexes=grain_indexes)
+        search_index.save(index_dir, "a")
+        paths = SearchIndex.index_paths(index_dir, "a")
+
+        loaded_index = SearchIndex.load(index_dir, "a")
+        np.testing.assert_array_equal(loaded_index.features, features[grain_indexes])
+        np.testing.assert_array_equal(loaded_index.grains(), grain_indexes)
+
+        # Files of a partially written index are ignored.
+        partial_path = SearchIndex.index_paths(index_dir, "b")["features"] + ".partial.tmp"
+        open(partial_path, 'wb').close()
+        os.rename(paths["grain_indexes"], paths["grain_indexes"] + ".moved")
+        self.assertIsNone(SearchIndex.load(index_dir, "a"))
+        os.rename(paths["grain_indexes"] + ".moved", paths["grain_indexes"])
+        os.remove(paths["info"])
+        self.assertIsNone(SearchIndex.load(index_dir, "a"))
+
+        search_index.save(index_dir, "b")
+        self.assertIsNotNone(SearchIndex.load(index_dir, "b"))
+        for path in paths.values():
+            self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(partial_path))
+
+    def test_TreeWeightings(self):
+        """
+        Check that loading an index with a new weighting saves a tree for
+        the weighting, keeping trees of other weightings.
+        """
+        index_dir = "./.test_index"
+        pathops.dir_must_exist(index_dir)
+        features = np.random.randn(500, 3)
+        targets = np.random.randn(20, 3)
+        weights = np.array([1., 0.5, 2.])
+        SearchIndex(features).save(index_dir, "a")
+        tree_path = SearchIndex.index_paths(index_dir, "a", weights)["tree"]
+        self.assertFalse(os.path.exists(tree_path))
+
+        search_index = SearchIndex.load(index_dir, "a", weights=weights)
+        self.assertTrue(os.path.exists(tree_path))
+        self.assertTrue(os.path.exists(SearchIndex.index_paths(index_dir, "a")["tree"]))
+        np.testing.assert_array_equal(
+            SearchIndex.load(index_dir, "a", weights=weights).query(targets, 4)[1],
+            search_index.query(targets, 4)[1]
+        )
+
+    def tearDown(self):
+        """Delete any saved indexes."""
+        pathops.delete_if_exists("./.test_index")
+
+class ApproximateIndexTests(globalTests):
+    """Tests approximate nearest neighbour indexes."""
+
+    def setUp(self):
+        self.features = np.random.randn(2000, 4)
+        self.targets = np.random.randn(50, 4)
+        self.weights = np.array([1., 0.5, 2., 1.])
+        self.exact_index = SearchIndex(self.features, weights=self.weights)
+
+    def test_ProbeAllLists(self):
+        """Check that probing every list gives exact results."""
+        ann_index = ApproximateIndex(self.features, weights=self.weights, lists=20)
+        distances, indexes = ann_index.query(self.targets, 3, probes=20)
+        expected_distances, expected_indexes = self.exact_index.query(self.targets, 3)
+        np.testing.assert_array_equal(indexes, expected_indexes)
+        np.testing.assert_allclose(distances, expected_distances)
+
+    def test_Recall(self):
+        """Check that recall is measured and increases with probes."""
+        ann_index = ApproximateIndex(self.features, weights=self.weights, lists=20)
+        low_recall = ann_index.measure_recall(self.targets, 3, probes=1)[0]
+        high_recall = ann_index.measure_recall(self.targets, 3, probes=10)[0]
+        self.assertTrue(0 < low_recall <= high_recall <= 1)
+        self.assertEqual(ann_index.measure_recall(self.targets, 3, probes=20)[0], 1)
+
+    def test_ParallelQuery(self):
+        """Check that queries split between jobs give the same results."""
+        ann_index = ApproximateIndex(self.features, weights=self.weights, lists=20)
+        distances, indexes = ann_index.query(self.targets, 3)
+        parallel_distances, parallel_indexes = ann_index.query(self.targets, 3, n_jobs=3)
+        np.testing.assert_array_equal(indexes, parallel_indexes)
+        np.testing.assert_allclose(distances, parallel_distances)
+
+    def test_SaveLoad(self):
+        """
+        Check that indexes saved with different weightings are kept, and
+        that indexes saved for other keys are removed.
+        """
+        index_dir = "./.test_index"
+        pathops.dir_must_exist(index_dir)
+        ann_index = ApproximateIndex(self.features, weights=self.weights, lists=20)
+        ann_index.save(index_dir, "a")
+        unweighted_index = ApproximateIndex(self.features, lists=20)
+        unweighted_index.save(index_dir, "a")
+
+        loaded_index = ApproximateIndex.load(index_dir, "a", weights=self.weights)
+        np.testing.assert_array_equal(
+            loaded_index.query(self.targets, 3)[1],
+            ann_index.query(self.targets, 3)[1]
+        )
+        self.assertIsNotNone(ApproximateIndex.load(index_dir, "a"))
+        self.assertIsNone(ApproximateIndex.load(index_dir, "a", weights=self.weights*2))
+
+        # Indexes are only loaded once their manifest is written.
+        os.remove(ApproximateIndex.index_paths(index_dir, "a")["info"])
+        self.assertIsNone(ApproximateIndex.load(index_dir, "a"))
+
+        unweighted_index.save(index_dir, "b")
+        self.assertIsNone(ApproximateIndex.load(index_dir, "a", weights=self.weights))
+        self.assertEqual(len(glob.glob(os.path.join(index_dir, "ann_index_a*"))), 0)
+
+    def tearDown(self):
+        """Delete any saved indexes."""
+        pathops.delete_if_exists("./.test_index")
+
+class RangeIndexTests(globalTests):
+    """Tests finding grains with analysis values in ranges."""
+
+    def setUp(self):
+        self.values = np.array([
+            [100., 1.],
+            [200., 2.],
+            [np.nan, 3.],
+            [150., 4.],
+            [400., 5.]
+        ])
+
+    def test_Candidates(self):
+        """Check that candidates are within all ranges."""
+        range_index = RangeIndex(self.values)
+        np.testing.assert_array_equal(
+            range_index.candidates([100., -np.inf], [200., np.inf]),
+            [0, 1, 3]
+        )
+        np.testing.assert_array_equal(
+            range_index.candidates([100., 1.5], [400., 4.]),
+            [1, 3]
+        )
+        self.assertEqual(range_index.candidates([500., 0.], [600., 10.]).size, 0)
+        self.assertIsNone(range_index.candidates([-np.inf, -np.inf], [np.inf, np.inf]))
+
+    def test_GrainIndexes(self):
+        """Check that only the grains given are included."""
+        range_index = RangeIndex(self.values, grain_indexes=np.array([1, 2, 4]))
+        np.testing.assert_array_equal(
+            range_index.candidates([-np.inf, 0.], [np.inf, 10.]),
+            [1, 2, 4]
+        )
+        np.testing.assert_array_equal(
+            range_index.candidates([0., -np.inf], [1000., np.inf]),
+            [1, 4]
+        )
+
+    def test_ConstraintBounds(self):
+        """Check that relative constraints scale target values."""
+        lows, highs = Matcher.constraint_bounds(
+            [("f0", {"relative": [0.5, 2.]}), ("spccntr", {"absolute": [10., 20.]})],
+            np.array([[100., 1.], [np.nan, 2.]])
+        )
+        np.testing.assert_array_equal(lows, [[50., 10.], [-np.inf, 10.]])
+        np.testing.assert_array_equal(highs, [[200., 20.], [np.inf, 20.]])
+
+class ProjectionTests(globalTests):
+    """Tests principal component projection of grain features."""
+
+    def setUp(self):
+        # Features with 3 independent dimensions and 3 correlated dimensions.
+        independent = np.random.randn(1000, 3)
+        self.features = np.hstack((independent, independent * [2., -1., 0.5]))
+        self.weights = np.array([1., 2., 1., 0.5, 1., 3.])
+
+    def test_Distances(self):
+        """
+        Check that projecting onto all components preserves weighted
+        distances.
+        """
+        projection = Projection.fit(self.features, self.weights, self.features.shape[1])
+        projected = projection.transform(self.features[:20])
+        np.testing.assert_allclose(
+            spatial.distance.cdist(projected, projected),
+            spatial.distance.cdist(self.features[:20] * self.weights, self.features[:20] * self.weights),
+            atol=1e-10
+        )
+
+    def test_ExplainedVariance(self):
+        """Check that components are chosen by the variance kept."""
+        projection = Projection.fit(self.features, self.weights, 0.99)
+        self.assertEqual(projection.components.shape, (3, 6))
+        self.assertAlmostEqual(projection.explained_variance(), 1.)
+
+    def test_SaveLoad(self):
+        """
+        Check that saved projections are loaded, and that projections saved
+        for other keys are removed.
+        """
+        index_dir = "./.test_index"
+        pathops.dir_must_exist(index_dir)
+        projection = Projection.fit(self.features, self.weights, 0.99)
+        projection.save(index_dir, "a")
+        loaded_projection = Projection.load(index_dir, "a")
+        np.testing.assert_allclose(
+            loaded_projection.transform(self.features[:20]),
+            projection.transform(self.features[:20])
+        )
+        projection.save(index_dir, "b")
+        self.assertIsNone(Projection.load(index_dir, "a"))
+        self.assertIsNotNone(Projection.load(index_dir, "b"))
+
+    def tearDown(self):
+        """Delete any saved projections."""
+        pathops.delete_if_exists("./.test_index")
+
+class FeatureNormalizationTests(globalTests):
+    """Tests normalization of grain features using corpus statistics."""
+
+    def test_Normalize(self):
+        features = np.array([
+            [1., np.nan, np.nan],
+            [2., 10., np.nan],
+            [3., 30., np.nan]
+        ])
+        statistics = {
+            "median": np.array([2., 20., np.nan]),
+            "mean": np.array([2., 20., np.nan]),
+            "std": np.array([1., 10., np.nan])
+        }
+        output = FeatureStore.normalize(features, statistics)
+        expected_output = np.array([
+            [-1., 0., 0.],
+            [0., -1., 0.],
+            [1., 1., 0.]
+        ])
+        np.testing.assert_allclose(output, expected_output)
+
+        # Without standardization only Nan values are replaced.
+        output = FeatureStore.normalize(features, statistics, standardize=False)
+        np.testing.assert_allclose(output[:, :2], [[1., 20.], [2., 10.], [3., 30.]])
+
 class DatabaseTests(globalTests):
     """Tests database creation and analysis."""
 
@@ -729,6 +1347,94 @@ class DatabaseTests(globalTests):
         # Create/load a pre-existing database
         database.load_database(reanalyse=True)
 
+    def read_analyses(self, database):
+        """Read every analysis dataset of a database."""
+        analyses = {}
+
+        def read_dataset(name, item):
+            if isinstance(item, h5py.Dataset):
+                analyses[name] = item[:]
+        database.data["analysis"].visititems(read_dataset)
+        return analyses
+
+    def load_parallel(self, analysis_list, reanalyse=True):
+        """Load the test database, analysing files in worker processes."""
+        database = AudioDatabase(
+            "./.test_db",
+            analysis_list=analysis_list,
+            config=config
+        )
+        config.analysis["processes"] = 2
+        try:
+            database.load_database(reanalyse=reanalyse)
+        finally:
+            del config.analysis["processes"]
+        return database
+
+    def test_ParallelAnalysis(self):
+        """
+        Check that analysing files in worker processes gives the same
+        analyses as analysing them in this process.
+        """
+        analysis_list = ["rms", "zerox", "fft", "spccntr", "spcsprd", "f0"]
+        database = AudioDatabase(
+            "./.test_db",
+            analysis_list=analysis_list,
+            config=config
+        )
+        database.load_database(reanalyse=True)
+        expected_analyses = self.read_analyses(database)
+        database.close()
+
+        database = self.load_parallel(analysis_list)
+        analyses = self.read_analyses(database)
+        database.close()
+
+        self.assertEqual(sorted(analyses.keys()), sorted(expected_analyses.keys()))
+        for name, expected_data in expected_analyses.iteritems():
+            np.testing.assert_array_equal(analyses[name], expected_data)
+
+    def test_ParallelAnalysisFailure(self):
+        """
+        Check that files that can't be analysed by a worker are skipped,
+        and that the worker's temporary file is removed.
+        """
+        self.empty_audio = self.create_test_audio(filename="./.test_db/test_empty.wav")
+        del self.empty_audio
+
+        database = self.load_parallel(["rms", "peak"])
+        names = [entry.name for entry in database.analysed_audio]
+        database.close()
+
+        self.assertEqual(sorted(names), ["test_noise.wav", "test_silent.wav", "test_sine.wav"])
+        self.assertFalse(glob.glob(os.path.join(database.subdirs["data"], ".analysis_worker_*")))
+
+    def test_ParallelAnalysisSkipsAnalysedFiles(self):
+        """
+        Check that files that already have all analyses aren't analysed
+        again.
+        """
+        database = self.load_parallel(["rms", "peak"])
+        versions = {
+            name: group.attrs["version"]
+            for name, group in database.data["analysis"].iteritems()
+        }
+        for group in database.data["analysis"].itervalues():
+            self.assertEqual(set(group.attrs["analyses"]), {"rms", "peak"})
+        database.close()
+
+        database = self.load_parallel(["rms", "peak"], reanalyse=False)
+        for name, group in database.data["analysis"].iteritems():
+            self.assertEqual(group.attrs["version"], versions[name])
+        self.assertEqual(len(database.analysed_audio), 3)
+        database.close()
+
+        # Files without all of the analyses are analysed again.
+        database = self.load_parallel(["rms", "peak", "zerox"], reanalyse=False)
+        for name, group in database.data["analysis"].iteritems():
+            self.assertEqual(group.attrs["version"], versions[name] + 1)
+        database.close()
+
     def tearDown(self):
         """
         Delete anything that is left over once tests are complete.
@@ -814,6 +1520,297 @@ class MatcherTests(globalTests):
        [ 16. ,  39.6,   9. ,   4. ,   1. ,   1. ,  39.6,   4. ,  39.6,   0. ]])
         np.testing.assert_array_equal(output, expected_output)
 
+    def test_DistanceLimits(self):
+        data1 = np.array([np.nan, 1,2,3,4, np.nan, np.nan, 7, 6, 5])
+        data2 = np.array([1, np.nan,2,3,4, 6, np.nan, 7, np.nan, 5])
+        nan_distance, max_distance = self.matcher.distance_limits(data1, data2)
+        self.assertAlmostEqual(nan_distance, 39.6)
+        self.assertAlmostEqual(
+            max_distance,
+            np.max(self.matcher.distance_calc(data1, data2))
+        )
+
+    def test_CalculateDBInds(self):
+        """Check that match indexes are mapped to the sample containing them."""
+        # Samples of 3, 0 and 2 grains.
+        sample_indexes = np.array([[0., 3.], [3., 3.], [3., 5.]])
+        match_indexes = np.array([[0, 2], [3, 4], [5, 1]])
+        db_inds = self.matcher.calculate_db_inds(match_indexes, sample_indexes)
+        np.testing.assert_array_equal(
+            db_inds,
+            [[[0, 0], [0, 2]], [[0, 3], [2, 1]], [[2, 2], [0, 1]]]
+        )
+        with self.assertRaises(ValueError):
+            self.matcher.calculate_db_inds(np.array([[6]]), sample_indexes)
+
+    def test_FeatureStore(self):
+        """Check that grain features are stored and reused."""
+        self.database1.close()
+        database = AudioDatabase("./.test_db1", analysis_list=["rms", "peak"], config=config)
+        database.load_database(reanalyse=True)
+        self.matcher.matcher_analyses = ["rms", "peak"]
+        for entry in database.analysed_audio:
+            entry.generate_grain_times(100, 4, save_times=True)
+        store = self.matcher.feature_store(database, 100, 4)
+        features = store.features()
+        self.assertEqual(features.shape[1], len(self.matcher.matcher_analyses))
+        self.assertIn(store.group_name, database.data)
+
+        entry = database.analysed_audio[0]
+        np.testing.assert_array_equal(
+            store.entry_features(entry)[:, 0],
+            entry.analysis_data_grains(
+                entry.times,
+                store.analyses[0],
+                format=store.formatting[0]
+            )[0]
+        )
+        np.testing.assert_array_equal(store.features(), features)
+        database.close()
+
+    def test_BruteForceSearch(self):
+        """
+        Check that tiled searching finds the same closest matches as
+        comparing all grains at once.
+        """
+        self.matcher.matcher_analyses = ["a", "b"]
+        self.matcher.match_quantity = 3
+        weightings = {"a": 1., "b": 0.5}
+        target_data = {
+            "a": np.random.randn(50),
+            "b": np.random.randn(50)
+        }
+        source_data = {
+            "a": np.random.randn(70),
+            "b": np.random.randn(70)
+        }
+        target_data["a"][::4] = np.nan
+        source_data["b"][::5] = np.nan
+        grain_counts = [30, 40]
+        source_entry_inds = np.repeat([0, 1], grain_counts)
+
+        distances = np.zeros((50, 70))
+        for analysis in ["a", "b"]:
+            entry_distances = [
+                self.matcher.distance_calc(
+                    target_data[analysis],
+                    source_data[analysis][source_entry_inds == i]
+                )
+                for i in xrange(2)
+            ]
+            data_max = max(np.max(x) for x in entry_distances)
+            distances += np.hstack(entry_distances) / data_max * weightings[analysis]
+
+        match_indexes = self.matcher.brute_force_search(
+            target_data,
+            source_data,
+            grain_counts,
+            weightings,
+            tile_size=16
+        )
+        self.assertEqual(match_indexes.shape, (50, 3))
+        np.testing.assert_allclose(
+            distances[np.arange(50)[:, np.newaxis], match_indexes],
+            np.sort(distances, axis=1)[:, :3]
+        )
+
+    def test_SilentGrainThresholds(self):
+        """
+        Check that each silence threshold is applied on it's own, and that
+        thresholds of missing analyses are ignored with a warning.
+        """
+        self.database1.close()
+        database = AudioDatabase("./.test_db1", analysis_list=["rms"], config=config)
+        database.load_database(reanalyse=True)
+        for entry in database.analysed_audio:
+            entry.generate_grain_times(100, 4, save_times=True)
+        handler = logging.handlers.BufferingHandler(10)
+        self.matcher.logger.addHandler(handler)
+        try:
+            config.matcher["silence_rms_threshold"] = -60
+            rms_silent = self.matcher.silent_grains(database, 100, 4)
+            config.matcher["silence_peak_threshold"] = -60
+            silent = self.matcher.silent_grains(database, 100, 4)
+        finally:
+            self.matcher.logger.removeHandler(handler)
+            config.matcher.pop("silence_rms_threshold", None)
+            config.matcher.pop("silence_peak_threshold", None)
+            database.close()
+
+        np.testing.assert_array_equal(silent, rms_silent)
+        grain_counts = [entry.times.shape[0] for entry in database.analysed_audio]
+        names = np.repeat([entry.name for entry in database.analysed_audio], grain_counts)
+        # Only grains of the silent file are silent. Grains without any RMS
+        # frames have no value, so aren't silent.
+        self.assertTrue(silent[names == "test_silent.wav"].any())
+        self.assertFalse(silent[names != "test_silent.wav"].any())
+        self.assertEqual(len(handler.buffer), 1)
+        self.assertIn("peak", handler.buffer[0].getMessage())
+
+    def tearDown(self):
+        """
+        Delete anything that is left over once tests are complete.
+
+        For example, remove all temporary test audio files generated during the
+        tests.
+        """
+        pathops.delete_if_exists("./.test_db1")
+        pathops.delete_if_exists("./.test_db2")
+
+
+class SynthesizerTests(globalTests):
+    """Tests synthesis of output from match data."""
+
+    def setUp(self):
+        """Create source, target and output databases to synthesize with."""
+        self.databases = []
+        for db_dir in ("./.test_db1", "./.test_db2"):
+            pathops.dir_must_exist(db_dir)
+            self.sine_audio = self.create_test_audio(filename=os.path.join(db_dir, "test_sine.wav"))
+            self.silent_audio = self.create_test_audio(filename=os.path.join(db_dir, "test_silent.wav"))
+            self.noise_audio = self.create_test_audio(filename=os.path.join(db_dir, "test_noise.wav"))
+            f = 440
+            x = np.arange(self.sine_audio.samplerate*2)+1
+            sine_wave = np.sin(2*np.pi*f/self.sine_audio.samplerate*x)
+            silence = np.zeros(self.silent_audio.samplerate*2)
+            white_noise = 2 * np.random.random(self.noise_audio.samplerate*2) - 1
+
+            self.sine_audio.write_frames(sine_wave)
+            del self.sine_audio
+
+            self.noise_audio.write_frames(white_noise)
+            del self.noise_audio
+
+            self.silent_audio.write_frames(silence)
+            del self.silent_audio
+
+            database = AudioDatabase(
+                db_dir,
+                analysis_list=["rms", "peak", "f0", "harm_ratio"],
+                config=config
+            )
+            database.load_database(reanalyse=True)
+            self.databases.append(database)
+
+        pathops.dir_must_exist("./.test_db3")
+        self.output_db = AudioDatabase("./.test_db3", config=config)
+        self.output_db.load_database(reanalyse=False)
+
+        self.source_db, self.target_db = self.databases
+        self.synthesizer = Synthesizer(
+            self.source_db,
+            self.output_db,
+            target_db=self.target_db,
+            config=config
+        )
+
+    def test_IntensityRatios(self):
+        """
+        Check that the intensity ratio of each matched grain is the ratio
+        of the mean of the grain's RMS and peak values to the mean of the
+        target grain's, as was calculated for each grain individually.
+        """
+        grain_size = 100
+        overlap = 4
+        for database in self.databases:
+            for entry in database.analysed_audio:
+                entry.generate_grain_times(grain_size, overlap, save_times=True)
+
+        target_sample = self.target_db.analysed_audio[0]
+        grain_count = target_sample.times.shape[0]
+        match_db_inds = np.random.randint(len(self.source_db.analysed_audio), size=grain_count)
+        match_grain_inds = np.array([
+            np.random.randint(self.source_db.analysed_audio[i].times.shape[0])
+            for i in match_db_inds
+        ])
+        # Grains without a match are left unchanged.
+        match_db_inds[:2] = -1
+        match_grain_inds[:2] = -1
+
+        ratios = self.synthesizer.intensity_ratios(
+            {},
+            match_db_inds,
+            match_grain_inds,
+            target_sample,
+            (grain_size, overlap)
+        )
+
+        def grain_intensity(sample, grain_ind):
+            # TODO: Make proper fix for grain index offset of 1
+            times = sample.times[grain_ind-1]
+            return np.mean([
+                sample.analysis_data_grains(times, "rms", format="mean")[0][0],
+                sample.analysis_data_grains(times, "peak", format="mean")[0][0]
+            ])
+
+        ratio_limit = config.synthesizer["enf_intensity_ratio_limit"]
+        self.assertEqual(ratios.shape, (grain_count,))
+        np.testing.assert_array_equal(ratios[:2], 1.)
+        for target_grain_ind in xrange(2, grain_count):
+            source_sample = self.source_db.analysed_audio[match_db_inds[target_grain_ind]]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                expected = (
+                    grain_intensity(target_sample, target_grain_ind) /
+                    grain_intensity(source_sample, match_grain_inds[target_grain_ind])
+                )
+            if not np.isfinite(expected):
+                expected = 1.
+            self.assertAlmostEqual(ratios[target_grain_ind], min(expected, ratio_limit))
+
+    def test_ParallelSynthesis(self):
+        """
+        Check that synthesizing targets in worker processes gives the same
+        output as synthesizing them in this process.
+        """
+        grain_size = 100
+        overlap = 4
+        # Store a single match for each grain, so that the same grains are
+        # used by every synthesis.
+        match_group = self.output_db.data.require_group("match")
+        for target_entry in self.target_db.analysed_audio:
+            target_entry.generate_grain_times(grain_size, overlap, save_times=True)
+            grain_count = target_entry.times.shape[0]
+            match_data = np.dstack((
+                np.random.randint(len(self.source_db.analysed_audio), size=(grain_count, 1)),
+                np.random.randint(1, grain_count, size=(grain_count, 1))
+            ))
+            # Unmatched grains.
+            match_data[:2] = -1
+            match_group.create_dataset(target_entry.name, data=match_data)
+            match_group[target_entry.name].attrs["grain_size"] = grain_size
+            match_group[target_entry.name].attrs["overlap"] = overlap
+
+        def read_outputs():
+            outputs = {}
+            for name in match_group:
+                filename, extension = os.path.splitext(name)
+                output_path = os.path.join(
+                    self.output_db.subdirs["audio"],
+                    ''.join((filename, '_output', extension))
+                )
+                with AudioFile(output_path, 'r') as output:
+                    outputs[name] = output.read_frames()
+            return outputs
+
+        self.synthesizer.synthesize(grain_size, overlap)
+        expected_outputs = read_outputs()
+
+        config.synthesizer["processes"] = 2
+        try:
+            self.synthesizer.synthesize(grain_size, overlap)
+        finally:
+            del config.synthesizer["processes"]
+        match_group = self.output_db.data["match"]
+        outputs = read_outputs()
+
+        self.assertEqual(len(outputs), len(self.target_db.analysed_audio))
+        for name, expected_output in expected_outputs.iteritems():
+            np.testing.assert_allclose(outputs[name], expected_output)
+        # The databases are reloaded once the workers have finished.
+        self.assertEqual(len(self.source_db.analysed_audio), 3)
+        self.assertEqual(len(self.target_db.analysed_audio), 3)
+        self.assertIn("match", self.output_db.data)
+
     def tearDown(self):
         """
         Delete anything that is left over once tests are complete.
@@ -823,6 +1820,7 @@ class MatcherTests(globalTests):
         """
         pathops.delete_if_exists("./.test_db1")
         pathops.delete_if_exists("./.test_db2")
+        pathops.delete_if_exists("./.test_db3")
 
 
 ReadGrainSuite = unittest.TestLoader().loadTestsFromTestCase(ReadGrainTest)
@@ -77,8 +77,8 @@ matcher = {
 }
 
 synthesizer = {
-    "enforce_rms": True,
-    "enf_rms_ratio_limit": 5.,
+    "enforce_intensity": True,
+    "enf_intensity_ratio_limit": 5.,
     "enforce_f0": True,
     "enf_f0_ratio_limit": 10.,
     "grain_size": 130,